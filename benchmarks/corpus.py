@@ -0,0 +1,97 @@
+"""Synthetic corpora for the benchmarks - froth sized camera frames and Ground Truth manifests."""
+import io
+import json
+
+import numpy as np
+from PIL import Image
+
+#the drop images are camera frames of roughly this size, cropped to 512x512 by feature engineering
+FROTH_FRAME_SIZE = (1024, 768)
+
+IMAGE_FORMATS = {"jpeg": ("JPEG", ".jpg"), "png": ("PNG", ".png")}
+
+
+def make_froth_frame(rng, size=FROTH_FRAME_SIZE):
+    """
+    Makes a froth like RGB frame - a smooth field of bubbles with fine grain over the top, so it compresses like a
+    real frame rather than like pure noise.
+    :param rng: numpy Generator, the same seed gives the same frame.
+    :param size: (width, height) of the frame.
+    :return: PIL image.
+    """
+    width, height = size
+    coarse = rng.integers(40, 220, (max(1, height // 24), max(1, width // 24), 3), dtype=np.uint8)
+    field = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC), dtype=np.int16)
+    grain = rng.integers(-12, 12, (height, width, 1), dtype=np.int16)
+    return Image.fromarray(np.clip(field + grain, 0, 255).astype(np.uint8))
+
+
+def make_image_corpus(count, image_format="jpeg", size=FROTH_FRAME_SIZE, cameras=2, seed=0):
+    """
+    Generate count encoded frames, named like the drop images, "<camera> <timestamp><ext>".
+    :return: (name, encoded bytes) tuples.
+    """
+    pil_format, extension = IMAGE_FORMATS[image_format]
+    rng = np.random.default_rng(seed)
+    for index in range(count):
+        buffer = io.BytesIO()
+        make_froth_frame(rng, size).save(buffer, pil_format)
+        yield "CAM{:02d} 2021-06-01T{:08d}{}".format(index % cameras, index, extension), buffer.getvalue()
+
+
+#PIL save options of the kinds of JPEG cameras write, the row limited decode of fast_decode must crop each exactly as
+#a full decode does
+JPEG_VARIANTS = {
+    "baseline": {},
+    "progressive": {"progressive": True},
+    "optimized": {"optimize": True},
+    "4:4:4": {"subsampling": 0},
+    "4:2:2": {"subsampling": 1},
+    "4:2:0": {"subsampling": 2},
+    "greyscale": {},
+}
+
+
+def make_jpeg_variants(size=FROTH_FRAME_SIZE, seed=0):
+    """
+    Generate the same froth frame encoded as each of JPEG_VARIANTS.
+    :return: (variant, encoded bytes) tuples.
+    """
+    frame = make_froth_frame(np.random.default_rng(seed), size)
+    for variant, save_options in JPEG_VARIANTS.items():
+        buffer = io.BytesIO()
+        (frame.convert("L") if variant == "greyscale" else frame).save(buffer, "JPEG", **save_options)
+        yield variant, buffer.getvalue()
+
+
+def make_output_manifest(count, bucket="input-bucket", label_attribute_name="froth-labels", labeled_fraction=0.6,
+                         failed_fraction=0.05, duplicate_fraction=0.02, seed=0):
+    """
+    Generate the lines of a synthetic Ground Truth output manifest - labeled entries with semantic segmentation
+    metadata, failed entries, bare unlabeled entries and a sprinkling of duplicate source-refs.
+    :return: manifest lines, without line endings.
+    """
+    rng = np.random.default_rng(seed)
+    for index in range(count):
+        if index and rng.random() < duplicate_fraction:
+            source = int(rng.integers(0, index))
+        else:
+            source = index
+        entry = {"source-ref": "s3://{}/CAM{:02d} 2021-06-01T{:08d}.png".format(bucket, source % 2, source)}
+        draw = rng.random()
+        if draw < labeled_fraction:
+            entry[label_attribute_name] = "s3://{}/annotations/consolidated-annotation/output/{}_0.png".format(bucket, source)
+            entry["{}-metadata".format(label_attribute_name)] = {
+                "internal-color-map": {"0": {"class-name": "BACKGROUND", "hex-color": "#ffffff", "confidence": 0.0},
+                                       "1": {"class-name": "Froth", "hex-color": "#2ca02c", "confidence": 0.0}},
+                "type": "groundtruth/semantic-segmentation",
+                "human-annotated": "yes",
+                "creation-date": "2021-06-01T00:00:00.000000",
+                "job-name": "labeling-job/froth-chain-1",
+            }
+        elif draw < labeled_fraction + failed_fraction:
+            entry["{}-metadata".format(label_attribute_name)] = {
+                "failure-reason": "ClientError: Annotation tasks expired.",
+                "human-annotated": "true",
+            }
+        yield json.dumps(entry)
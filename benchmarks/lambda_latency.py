@@ -0,0 +1,185 @@
+"""Measures cold and warm invocation latency of the trigger_sagemaker_pipeline Lambda handler, with stubbed clients.
+
+Useage:
+    python benchmarks/lambda_latency.py --cold-runs 10 --warm-runs 200 --output results/lambda.json
+
+Each cold run is a fresh interpreter, as a new Lambda container is - it times importing index, the Lambda init
+phase, then the first invocation, then --warm-runs further invocations in the same process. The SageMaker and S3
+clients are stubbed with botocore's Stubber, so requests are still built and validated but never sent, and the times
+are our own code and botocore's, not the API's.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+LAMBDA_DIR = os.path.join(REPO_DIR, "lambda", "src", "python", "trigger_sagemaker_pipeline")
+
+REGION = "us-east-1"
+PROJECT_PREFIX = "benchmark"
+DROP_BUCKET = "{}-drop".format(PROJECT_PREFIX)
+ACCOUNT = "000000000000"
+
+EVENT_TYPES = ["sqs_batch", "s3", "job_state_change"]
+
+
+def make_s3_record(index):
+    return {
+        'eventSource': "aws:s3",
+        'eventName': "ObjectCreated:Put",
+        's3': {'bucket': {'name': "{}-drop".format(PROJECT_PREFIX)}, 'object': {'key': "CAM00 2021-06-01T{:08d}.jpg".format(index)}},
+    }
+
+
+def make_event(event_type, invocation, batch_size):
+    """The event the Lambda is invoked with, a different labeling job each time for job state changes."""
+    if event_type == "sqs_batch":
+        from trigger_coalescer import make_sqs_batch_event
+        return make_sqs_batch_event([json.dumps({'Records': [make_s3_record(index)]}) for index in range(batch_size)])
+    if event_type == "s3":
+        return {'Records': [make_s3_record(0)]}
+    return {
+        'detail-type': "SageMaker Ground Truth Labeling Job State Change",
+        'resources': [job_arn(invocation)],
+        'detail': {'LabelingJobStatus': "Stopped", 'LabelCounters': {'TotalLabeled': 90, 'HumanLabeled': 90, 'MachineLabeled': 0, 'FailedNonRetryableError': 0, 'Unlabeled': 10}},
+    }
+
+
+def job_arn(invocation):
+    return "arn:aws:sagemaker:{}:{}:labeling-job/{}-chain-{}".format(REGION, ACCOUNT, PROJECT_PREFIX, invocation)
+
+
+def stub_responses(stubber, event_type, invocation):
+    """Queues the responses one invocation of the handler will ask for."""
+    #job state change events carry the job's status and label counters, so the index answers without describe_labeling_job
+    #the last execution has finished, so the handler starts the next
+    stubber.add_response("list_pipeline_executions", {'PipelineExecutionSummaries': [{
+        'PipelineExecutionArn': "arn:aws:sagemaker:{}:{}:pipeline/{}/execution/previous".format(REGION, ACCOUNT, PROJECT_PREFIX),
+        'StartTime': datetime.datetime(2021, 6, 1),
+        'PipelineExecutionStatus': "Succeeded",
+    }]})
+    stubber.add_response("start_pipeline_execution", {'PipelineExecutionArn': "arn:aws:sagemaker:{}:{}:pipeline/{}/execution/{}".format(REGION, ACCOUNT, PROJECT_PREFIX, invocation)})
+
+
+def stub_drop_listing(stubber, batch_size):
+    """Queues the one page of drop bucket listing the handler counts the backlog from."""
+    stubber.add_response("list_objects_v2", {
+        'KeyCount': batch_size,
+        'Contents': [{'Key': "CAM01 {:06d}.jpg".format(index), 'Size': 1024} for index in range(batch_size)],
+        'IsTruncated': False,
+    }, {'Bucket': DROP_BUCKET, 'Delimiter': "/"})
+
+
+def run_container(event_type, warm_runs, batch_size):
+    """
+    One Lambda container's worth of invocations - runs in the child process.
+    :return: dict of init, cold and warm invocation times in seconds.
+    """
+    import logging
+    os.environ.update({'PROJECT_PREFIX': PROJECT_PREFIX, 'DROP_BUCKET': DROP_BUCKET, 'AWS_DEFAULT_REGION': REGION,
+                       'AWS_ACCESS_KEY_ID': "benchmark", 'AWS_SECRET_ACCESS_KEY': "benchmark"})
+    os.environ.pop('JOB_STATE_TABLE', None)
+    sys.path.insert(0, LAMBDA_DIR)
+
+    started = time.perf_counter()
+    import index
+    init_seconds = time.perf_counter() - started
+    #the Lambda runtime sends logs to CloudWatch, here they would only measure the terminal
+    logging.getLogger().handlers = [logging.NullHandler()]
+
+    from botocore.stub import Stubber
+    stubber = Stubber(index.sm_client)
+    stubber.activate()
+    s3_stubber = Stubber(index.get_client("s3"))
+    s3_stubber.activate()
+    invocation_seconds = []
+    for invocation in range(warm_runs + 1):
+        event = make_event(event_type, invocation, batch_size)
+        stub_responses(stubber, event_type, invocation)
+        stub_drop_listing(s3_stubber, batch_size)
+        started = time.perf_counter()
+        index.handler(event, None)
+        invocation_seconds.append(time.perf_counter() - started)
+    stubber.assert_no_pending_responses()
+    s3_stubber.assert_no_pending_responses()
+    return {'init': init_seconds, 'cold_invocation': invocation_seconds[0], 'warm_invocations': invocation_seconds[1:]}
+
+
+def percentile_ms(latencies, percentile):
+    if not latencies:
+        return None
+    return round(float(np.percentile(latencies, percentile)) * 1000, 3)
+
+
+def summarise(latencies):
+    return {'runs': len(latencies), 'p50_ms': percentile_ms(latencies, 50), 'p99_ms': percentile_ms(latencies, 99), 'max_ms': percentile_ms(latencies, 100)}
+
+
+def measure(event_type, cold_runs, warm_runs, batch_size):
+    """Runs cold_runs fresh containers of the handler, each followed by warm_runs warm invocations."""
+    inits, colds, warms, process_starts = [], [], [], []
+    for _ in range(cold_runs):
+        started = time.perf_counter()
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--container", event_type,
+                                          "--warm-runs", str(warm_runs), "--batch-size", str(batch_size)])
+        process_starts.append(time.perf_counter() - started)
+        container = json.loads(output)
+        inits.append(container['init'])
+        colds.append(container['init'] + container['cold_invocation'])
+        warms.extend(container['warm_invocations'])
+    return {
+        'event_type': event_type,
+        'init': summarise(inits),
+        'cold_start': summarise(colds),
+        'warm_invocation': summarise(warms),
+        'process': summarise(process_starts),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--event-types", type=str, default=",".join(EVENT_TYPES), help="Comma separated events to invoke with, from: {}".format(", ".join(EVENT_TYPES)))
+    parser.add_argument("--cold-runs", type=int, default=10, help="Number of fresh containers per event type")
+    parser.add_argument("--warm-runs", type=int, default=100, help="Number of warm invocations per container")
+    parser.add_argument("--batch-size", type=int, default=100, help="Number of drop events in each SQS batch")
+    parser.add_argument("--container", type=str, choices=EVENT_TYPES, help=argparse.SUPPRESS)
+    parser.add_argument("--output", type=str, help="File to write the JSON results to, stdout by default")
+    options = parser.parse_args()
+
+    if options.container:
+        print(json.dumps(run_container(options.container, options.warm_runs, options.batch_size)))
+        sys.exit(0)
+
+    event_types = [event_type.strip() for event_type in options.event_types.split(",") if event_type.strip()]
+    unknown = [event_type for event_type in event_types if event_type not in EVENT_TYPES]
+    assert not unknown, "Unknown event types: {}".format(", ".join(unknown))
+
+    report = {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": vars(options),
+        "results": [],
+    }
+    for event_type in event_types:
+        result = measure(event_type, options.cold_runs, options.warm_runs, options.batch_size)
+        report["results"].append(result)
+        print("{}: init p50 {} ms, cold start p50 {} ms p99 {} ms, warm invocation p50 {} ms p99 {} ms".format(
+            event_type, result['init']['p50_ms'], result['cold_start']['p50_ms'], result['cold_start']['p99_ms'],
+            result['warm_invocation']['p50_ms'], result['warm_invocation']['p99_ms']), file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if options.output:
+        os.makedirs(os.path.dirname(os.path.abspath(options.output)), exist_ok=True)
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
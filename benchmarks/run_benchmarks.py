@@ -0,0 +1,539 @@
+"""Benchmarks the feature engineering and manifest hot paths against a local S3 stand-in.
+
+Useage:
+    python benchmarks/run_benchmarks.py --images 200 --format jpeg --output results/run.json
+    python benchmarks/run_benchmarks.py --stages crop_fast_decode,compact_manifests --manifest-entries 500000
+
+Every stage runs in a fresh process, so its peak RSS is its own, and results are written as JSON so runs can be
+compared over time.
+"""
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import boto3
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+SCRIPTS_DIR = os.path.join(REPO_DIR, "smpipelines", "src", "python")
+
+sys.path[:0] = [BENCHMARKS_DIR, SCRIPTS_DIR]
+from corpus import make_image_corpus, make_jpeg_variants, make_output_manifest  # noqa: E402
+from stage_metrics import LatencyHistogram  # noqa: E402
+from work_scheduler import WorkScheduler, load_schedule_policy  # noqa: E402
+
+REGION = "us-east-1"
+DROP_BUCKET = "benchmark-drop"
+INPUT_BUCKET = "benchmark-input"
+OUTPUT_BUCKET = "benchmark-output"
+#cameras the input bucket keys of the listing stages are spread over, the manifest listing runs a shard per camera
+LISTING_CAMERAS = 8
+
+
+def load_script(module_name, file_name):
+    """
+    Imports one of the pipeline step scripts, their file names are not importable module names.
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SCRIPTS_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    #registered before running so the process pool workers can unpickle its functions
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def feature_engineering():
+    return load_script("feature_engineering", "1_feature_engineering.py")
+
+
+def groundtruth_chain_job():
+    return load_script("groundtruth_chain_job", "2_groundtruth_chain_job.py")
+
+
+@contextlib.contextmanager
+def local_s3():
+    """
+    Local S3 stand-in, moto's in-process mock of the S3 API.
+    """
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit("The benchmarks need moto for their local S3 stand-in, pip install moto")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", REGION)
+    with mock_aws():
+        s3_client = boto3.client("s3", region_name=REGION)
+        for bucket in (DROP_BUCKET, INPUT_BUCKET, OUTPUT_BUCKET):
+            s3_client.create_bucket(Bucket=bucket)
+        yield s3_client
+
+
+def percentile_ms(latencies, percentile):
+    if not latencies:
+        return None
+    return round(float(np.percentile(latencies, percentile)) * 1000, 3)
+
+
+def peak_rss_mb(who):
+    #ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024.0, 1)
+
+
+def current_rss_mb():
+    """RSS of this process now, from /proc, or its peak where there is no /proc."""
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024.0, 1)
+    except OSError:
+        return peak_rss_mb(resource.RUSAGE_SELF)
+
+
+def stage_result(items, nbytes, seconds, latencies=None, unit="images"):
+    """
+    Summarises one stage run.
+    :param items: the number of items the stage worked through.
+    :param nbytes: the number of input bytes the stage worked through.
+    :param seconds: wall time of the stage.
+    :param latencies: optional per item latencies, in seconds.
+    """
+    return {
+        "unit": unit,
+        "items": items,
+        "megabytes": round(nbytes / 1e6, 3),
+        "seconds": round(seconds, 4),
+        "items_per_sec": round(items / seconds, 2) if seconds else None,
+        "mb_per_sec": round(nbytes / 1e6 / seconds, 3) if seconds else None,
+        "latency_p50_ms": percentile_ms(latencies, 50),
+        "latency_p99_ms": percentile_ms(latencies, 99),
+    }
+
+
+def put_corpus(s3_client, bucket, corpus, prefix=""):
+    nbytes = 0
+    for name, data in corpus:
+        s3_client.put_object(Bucket=bucket, Key=prefix + name, Body=data)
+        nbytes += len(data)
+    return nbytes
+
+
+def bench_crop(options, fast_decode):
+    fe = feature_engineering()
+    corpus = list(make_image_corpus(options.images, options.format, seed=options.seed))
+    latencies = []
+    started = time.perf_counter()
+    for name, data in corpus:
+        image_started = time.perf_counter()
+        fe.preprocess_images(io.BytesIO(data), name, fast_decode=fast_decode)
+        latencies.append(time.perf_counter() - image_started)
+    return stage_result(len(corpus), sum(len(data) for _, data in corpus), time.perf_counter() - started, latencies)
+
+
+def bench_crop_full_decode(options):
+    """crop_image on fully decoded frames - the original feature engineering path."""
+    return bench_crop(options, fast_decode=False)
+
+
+def bench_crop_fast_decode(options):
+    """Crops decoding only the rows of each frame above the bottom of the crop."""
+    return bench_crop(options, fast_decode=True)
+
+
+def bench_fast_decode_equivalence(options):
+    """
+    Checks fast_decode crops are byte for byte those of a full decode, through preprocess_images and
+    crop_and_encode_batch, for each kind of JPEG and crops ending at, just above and inside the last MCU rows.
+    Raises, failing the benchmark run, on any difference.
+    """
+    fe = feature_engineering()
+    crops = 0
+    nbytes = 0
+    mismatches = []
+    started = time.perf_counter()
+    #1000x750 is not a whole number of MCUs high
+    for width, height in ((1024, 768), (1000, 750)):
+        geometries = {
+            "default": fe.DEFAULT_CROP_GEOMETRY,
+            "bottom_on_mcu_row": fe.CropGeometry(width=512, height=512, top=16),
+            "bottom_inside_mcu_row": fe.CropGeometry(width=512, height=512, top=13),
+            "bottom_one_row_up": fe.CropGeometry(width=512, height=512, top=height - 513),
+            "bottom_last_mcu_row": fe.CropGeometry(width=512, height=512, top=height - 517),
+            "bottom_edge": fe.CropGeometry(width=512, height=512, top=height - 512),
+        }
+        for variant, data in make_jpeg_variants((width, height), seed=options.seed):
+            name = "CAM00 2021-06-01T00000000.jpg"
+            for geometry_name, geometry in geometries.items():
+                case = "{}x{} {} {}".format(width, height, variant, geometry_name)
+                full = fe.preprocess_images(io.BytesIO(data), name, geometry, fast_decode=False).getvalue()
+                if fe.preprocess_images(io.BytesIO(data), name, geometry, fast_decode=True).getvalue() != full:
+                    mismatches.append("preprocess_images " + case)
+                batch_crops = [fe.crop_and_encode_batch([(name, data)], geometry, fast_decode=fast_decode)[0]
+                               for fast_decode in (False, True)]
+                if any(error is not None for _, _, error, _, _ in batch_crops):
+                    mismatches.append("crop_and_encode_batch {} failed: {}".format(case, [error for _, _, error, _, _ in batch_crops]))
+                elif batch_crops[0][1] != batch_crops[1][1]:
+                    mismatches.append("crop_and_encode_batch " + case)
+                crops += 1
+                nbytes += len(data)
+    assert not mismatches, "fast_decode crops differ from a full decode: {}".format(", ".join(mismatches))
+    result = stage_result(crops, nbytes, time.perf_counter() - started, unit="crops")
+    result["equivalent"] = True
+    return result
+
+
+def bench_crop_batch(options):
+    """crop_and_encode_batch, the process pool worker, on batches of frames from one camera."""
+    fe = feature_engineering()
+    corpus = list(make_image_corpus(options.images, options.format, cameras=1, seed=options.seed))
+    batch_metrics = fe.StageMetrics(output_format="off")
+    latencies = []
+    started = time.perf_counter()
+    for offset in range(0, len(corpus), options.batch_size):
+        batch = corpus[offset:offset + options.batch_size]
+        batch_started = time.perf_counter()
+        results, batch_timings = fe.crop_and_encode_batch_with_metrics(batch)
+        latencies.extend([(time.perf_counter() - batch_started) / len(batch)] * len(batch))
+        batch_metrics.merge(batch_timings)
+    result = stage_result(len(corpus), sum(len(data) for _, data in corpus), time.perf_counter() - started, latencies)
+    #where the time goes inside the worker, from the script's own instrumentation
+    result["substages"] = {}
+    for stage, state in batch_metrics.snapshot()["histograms"].items():
+        histogram = LatencyHistogram()
+        histogram.merge(state)
+        result["substages"][stage] = {"items": histogram.count,
+                                      "latency_p50_ms": round(histogram.percentile(50) * 1000, 3),
+                                      "latency_p99_ms": round(histogram.percentile(99) * 1000, 3)}
+    return result
+
+
+def bench_encode_profiles(options):
+    """Encodes the crops with each encoding profile into each output format, and copies them with lossless_crop."""
+    fe = feature_engineering()
+    corpus = list(make_image_corpus(options.images, options.format, cameras=1, seed=options.seed))
+    crops = [fe.crop_image(fe.open_image(io.BytesIO(data))) for _, data in corpus]
+    for crop in crops:
+        crop.load()
+    source_format = fe.get_safe_ext(corpus[0][0])
+    profiles = {}
+    started = time.perf_counter()
+    for profile_name, profile in fe.ENCODING_PROFILES.items():
+        for image_format in sorted({source_format, "PNG", "WEBP"}):
+            nbytes, latencies = 0, []
+            for crop in crops:
+                image_started = time.perf_counter()
+                nbytes += len(fe.encode_image(crop, "crop." + image_format.lower(), profile).getvalue())
+                latencies.append(time.perf_counter() - image_started)
+            profiles["{}/{}".format(profile_name, image_format)] = {"latency_p50_ms": percentile_ms(latencies, 50),
+                                                                   "bytes_per_image": nbytes // len(crops)}
+    #copies, where jpegtran is installed and the geometry is on the MCU grid, or the crop is the whole frame
+    for geometry_name, geometry in [("default_geometry", fe.DEFAULT_CROP_GEOMETRY), ("mcu_aligned_geometry", fe.CropGeometry(width=512, height=512, top=0))]:
+        nbytes, latencies, copied = 0, [], 0
+        for name, data in corpus:
+            image_started = time.perf_counter()
+            image = fe.open_image(io.BytesIO(data), geometry)
+            copied_bytes = fe.lossless_crop(data, image, geometry.rectangle(*image.size), source_format)
+            latencies.append(time.perf_counter() - image_started)
+            if copied_bytes is not None:
+                copied += 1
+                nbytes += len(copied_bytes)
+        profiles["lossless_crop/{}".format(geometry_name)] = {"latency_p50_ms": percentile_ms(latencies, 50), "copied": copied,
+                                                              "bytes_per_image": nbytes // copied if copied else None}
+    result = stage_result(len(corpus), sum(len(data) for _, data in corpus), time.perf_counter() - started)
+    result["profiles"] = profiles
+    return result
+
+
+def bench_memory_soak(options):
+    """
+    Feature engineering over --soak-images frames, cycling through the corpus: each frame is fetched from the drop
+    bucket with S3TransferPool.get, as process_drop_bucket fetches it, opened from the fetched bytes with
+    open_for_crop and cropped and encoded with crop_and_encode_batch, every other batch through preprocess_images.
+    Samples peak RSS, ru_maxrss, every 1000 frames. Raises, failing the benchmark run, if peak RSS grows by more than
+    --soak-rss-tolerance-mb after the first 1000 frames, by which time the allocator has warmed up.
+    """
+    fe = feature_engineering()
+    corpus = list(make_image_corpus(min(options.images, 200), options.format, cameras=1, seed=options.seed))
+    batch_metrics = fe.StageMetrics(output_format="off")
+    rss_samples = []
+    processed, nbytes = 0, 0
+    with local_s3() as s3_client:
+        put_corpus(s3_client, DROP_BUCKET, corpus)
+        keys = [name for name, _ in corpus]
+        transfer = fe.S3TransferPool(boto3.session.Session(region_name=REGION), max_workers=options.parallel_jobs)
+        started = time.perf_counter()
+        try:
+            while processed < options.soak_images:
+                for batch_index, offset in enumerate(range(0, len(keys), options.batch_size)):
+                    batch_keys = keys[offset:offset + options.batch_size][:options.soak_images - processed]
+                    downloads = [transfer.submit(transfer.get, DROP_BUCKET, key) for key in batch_keys]
+                    batch = [(key, download.result()) for key, download in zip(batch_keys, downloads)]
+                    if batch_index % 2:
+                        for key, data in batch:
+                            fe.preprocess_images(io.BytesIO(data), key).close()
+                    else:
+                        fe.crop_and_encode_batch(batch, batch_metrics=batch_metrics)
+                        batch_metrics.snapshot()
+                    processed += len(batch)
+                    nbytes += sum(len(data) for _, data in batch)
+                    if processed // 1000 > len(rss_samples) or processed == options.soak_images:
+                        rss_samples.append({"images": processed, "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF), "rss_mb": current_rss_mb()})
+                    if processed == options.soak_images:
+                        break
+        finally:
+            transfer.shutdown()
+    result = stage_result(processed, nbytes, time.perf_counter() - started)
+    result["rss_samples"] = rss_samples
+    result["peak_rss_growth_mb"] = round(rss_samples[-1]["peak_rss_mb"] - rss_samples[0]["peak_rss_mb"], 1)
+    result["rss_flat"] = result["peak_rss_growth_mb"] <= options.soak_rss_tolerance_mb
+    assert result["rss_flat"], "Peak RSS grew by {} MB from {} to {} images, over the {} MB tolerance: {}".format(
+        result["peak_rss_growth_mb"], rss_samples[0]["images"], processed, options.soak_rss_tolerance_mb, rss_samples)
+    return result
+
+
+def bench_download_dir(options):
+    """download_dir of the drop images, in parallel on an S3TransferPool."""
+    fe = feature_engineering()
+    with local_s3() as s3_client, tempfile.TemporaryDirectory() as target:
+        nbytes = put_corpus(s3_client, DROP_BUCKET, make_image_corpus(options.images, options.format, seed=options.seed), prefix="drop/")
+        transfer = fe.S3TransferPool(boto3.session.Session(region_name=REGION), max_workers=options.parallel_jobs)
+        started = time.perf_counter()
+        try:
+            fe.download_dir(s3_client, DROP_BUCKET, "drop", target, transfer=transfer)
+        finally:
+            transfer.shutdown()
+        return stage_result(options.images, nbytes, time.perf_counter() - started)
+
+
+def bench_process_drop_bucket(options):
+    """The streaming feature engineering pipeline end to end - list, GET, crop, PUT and delete."""
+    fe = feature_engineering()
+    processor = fe.start_processor(options.processing_workers)
+    try:
+        with local_s3() as s3_client:
+            nbytes = put_corpus(s3_client, DROP_BUCKET, make_image_corpus(options.images, options.format, seed=options.seed))
+            transfer = fe.S3TransferPool(boto3.session.Session(region_name=REGION), max_workers=options.parallel_jobs)
+            started = time.perf_counter()
+            try:
+                processed = fe.process_drop_bucket(s3_client, transfer, processor, DROP_BUCKET, INPUT_BUCKET, batch_size=options.batch_size)
+            finally:
+                transfer.shutdown()
+            return stage_result(processed, nbytes, time.perf_counter() - started)
+    finally:
+        if processor is not None:
+            processor.shutdown()
+
+
+def put_listing_corpus(s3_client, count):
+    for index in range(count):
+        s3_client.put_object(Bucket=INPUT_BUCKET, Key="CAM{:02d} 2021-06-01T{:08d}.png".format(index % LISTING_CAMERAS, index), Body=b"")
+
+
+def bench_get_matching_s3_objects(options):
+    """Lists the GroundTruth input bucket, the listing behind the input manifest."""
+    chain = groundtruth_chain_job()
+    with local_s3() as s3_client:
+        put_listing_corpus(s3_client, options.listing_keys)
+        started = time.perf_counter()
+        found = sum(1 for _ in chain.get_matching_s3_objects(s3_client, INPUT_BUCKET, suffixes=[".png", ".jpg", ".jpeg"]))
+        return stage_result(found, 0, time.perf_counter() - started, unit="keys")
+
+
+def bench_build_input_manifest(options):
+    """Writes the input manifest of a new job from a sharded listing of the input bucket."""
+    chain = groundtruth_chain_job()
+    with local_s3() as s3_client:
+        put_listing_corpus(s3_client, options.listing_keys)
+        started = time.perf_counter()
+        written = chain.build_input_manifest(s3_client, INPUT_BUCKET, "manifests/input.manifest", [".png", ".jpg", ".jpeg"])
+        seconds = time.perf_counter() - started
+        nbytes = s3_client.head_object(Bucket=INPUT_BUCKET, Key="manifests/input.manifest")['ContentLength']
+        return stage_result(written, nbytes, seconds, unit="entries")
+
+
+def bench_compact_manifests(options):
+    """Splits a prior job's output manifest into the labeled dataset and the remaining work."""
+    chain = groundtruth_chain_job()
+    with local_s3() as s3_client:
+        manifest = "".join(line + "\n" for line in make_output_manifest(options.manifest_entries, seed=options.seed)).encode("utf-8")
+        s3_client.put_object(Bucket=OUTPUT_BUCKET, Key="job/manifests/output/output.manifest", Body=manifest)
+        nbytes = len(manifest)
+        del manifest
+        # moto holds the manifests in memory, so the stage's peak RSS is mostly the fixture. RSS is sampled during
+        # compaction for how much it grows by, which still counts the manifests moto is given to hold
+        rss_before_mb = current_rss_mb()
+        rss_peak_mb = [rss_before_mb]
+        compacted = threading.Event()
+
+        def sample_rss():
+            while not compacted.wait(0.01):
+                rss_peak_mb[0] = max(rss_peak_mb[0], current_rss_mb())
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            counts = chain.compact_manifests(s3_client,
+                                             "s3://{}/job/manifests/output/output.manifest".format(OUTPUT_BUCKET),
+                                             "s3://{}/manifests/labeled.manifest".format(OUTPUT_BUCKET),
+                                             "s3://{}/manifests/remaining.manifest".format(OUTPUT_BUCKET),
+                                             "froth-labels")
+        finally:
+            compacted.set()
+            sampler.join()
+        result = stage_result(sum(counts.values()), nbytes, time.perf_counter() - started, unit="entries")
+        result["compaction_rss_growth_mb"] = round(rss_peak_mb[0] - rss_before_mb, 1)
+        return result
+
+
+def bench_work_scheduler(options):
+    """Orders and samples a backlog of --schedule-items images, from 50 cameras over a day, with each schedule order."""
+    rng = np.random.default_rng(options.seed)
+    cameras = rng.integers(0, 50, options.schedule_items)
+    times = rng.uniform(0, 86400, options.schedule_items)
+    schedules = {}
+    started = time.perf_counter()
+    for schedule in ('{"order": "listing"}', '{"order": "newest-first"}', '{"order": "round-robin"}',
+                     '{"order": "round-robin", "per_camera_window": 100, "per_window": 2000}'):
+        scheduler = WorkScheduler(load_schedule_policy(schedule))
+        schedule_started = time.perf_counter()
+        for index in range(options.schedule_items):
+            scheduler.add(index, int(cameras[index]), float(times[index]))
+        scheduled = sum(1 for _ in scheduler.drain())
+        seconds = time.perf_counter() - schedule_started
+        schedules[schedule] = {"seconds": round(seconds, 4), "items_per_sec": round(options.schedule_items / seconds, 2), "scheduled": scheduled}
+    result = stage_result(options.schedule_items * len(schedules), 0, time.perf_counter() - started, unit="items")
+    result["schedules"] = schedules
+    return result
+
+
+def bench_startup(file_name, options):
+    """Cold starts of a step script, to its parsed arguments, as a processing job starts it."""
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(options.startup_runs):
+        run_started = time.perf_counter()
+        subprocess.check_call([sys.executable, os.path.join(SCRIPTS_DIR, file_name), "--help"], stdout=subprocess.DEVNULL)
+        latencies.append(time.perf_counter() - run_started)
+    return stage_result(len(latencies), 0, time.perf_counter() - started, latencies, unit="starts")
+
+
+def bench_startup_feature_engineering(options):
+    """Cold starts of the feature engineering script."""
+    return bench_startup("1_feature_engineering.py", options)
+
+
+def bench_startup_groundtruth_chain_job(options):
+    """Cold starts of the chain job script."""
+    return bench_startup("2_groundtruth_chain_job.py", options)
+
+
+STAGES = {
+    "crop_full_decode": bench_crop_full_decode,
+    "crop_fast_decode": bench_crop_fast_decode,
+    "fast_decode_equivalence": bench_fast_decode_equivalence,
+    "crop_batch": bench_crop_batch,
+    "encode_profiles": bench_encode_profiles,
+    "memory_soak": bench_memory_soak,
+    "download_dir": bench_download_dir,
+    "process_drop_bucket": bench_process_drop_bucket,
+    "get_matching_s3_objects": bench_get_matching_s3_objects,
+    "build_input_manifest": bench_build_input_manifest,
+    "compact_manifests": bench_compact_manifests,
+    "work_scheduler": bench_work_scheduler,
+    "startup_feature_engineering": bench_startup_feature_engineering,
+    "startup_groundtruth_chain_job": bench_startup_groundtruth_chain_job,
+}
+
+
+def run_stage(name, options):
+    """
+    Runs one stage, in its own process, silencing the per image prints of the scripts.
+    """
+    #the stage process is spawned, but the scripts' own worker pools fork as they do in a processing job, a spawned
+    #worker could not import the scripts, which are loaded from their files rather than as modules
+    multiprocessing.set_start_method("fork", force=True)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = STAGES[name](options)
+    result["peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_SELF)
+    result["peak_children_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+
+def run_isolated(name, options):
+    #spawn rather than fork, so the stage starts from a clean interpreter and its peak RSS is its own
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_stage, name, options).result()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", type=str, default=",".join(STAGES), help="Comma separated stages to run, from: {}".format(", ".join(STAGES)))
+    parser.add_argument("--images", type=int, default=100, help="Number of synthetic frames in the image corpus")
+    parser.add_argument("--format", type=str, choices=["jpeg", "png"], default="jpeg")
+    parser.add_argument("--listing-keys", type=int, default=5000, help="Number of objects in the input bucket for the listing and manifest stages")
+    parser.add_argument("--manifest-entries", type=int, default=100000, help="Number of lines in the synthetic output manifest")
+    parser.add_argument("--schedule-items", type=int, default=1000000, help="Number of images in the backlog the work_scheduler stage orders")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--parallel-jobs", type=int, default=16)
+    parser.add_argument("--processing-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--startup-runs", type=int, default=10, help="Number of cold starts of each script in the startup stages")
+    parser.add_argument("--soak-images", type=int, default=10000, help="Number of frames the memory_soak stage crops")
+    parser.add_argument("--soak-rss-tolerance-mb", type=float, default=16, help="Most MB peak RSS may grow by after the first 1000 frames of the memory_soak stage, more fails the run")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs of each stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, help="File to write the JSON results to, stdout by default")
+    options = parser.parse_args()
+
+    stages = [stage.strip() for stage in options.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    assert not unknown, "Unknown stages: {}".format(", ".join(unknown))
+
+    report = {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": vars(options),
+        "results": [],
+    }
+    for stage in stages:
+        for run in range(options.repeat):
+            result = run_isolated(stage, options)
+            result.update({"stage": stage, "run": run})
+            report["results"].append(result)
+            print("{stage} run {run}: {items_per_sec} {unit}/s, {mb_per_sec} MB/s, p50 {latency_p50_ms} ms, p99 {latency_p99_ms} ms, peak RSS {peak_rss_mb} MB".format(**result), file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if options.output:
+        os.makedirs(os.path.dirname(os.path.abspath(options.output)), exist_ok=True)
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
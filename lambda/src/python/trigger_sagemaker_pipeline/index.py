@@ -3,13 +3,84 @@ import os
 import datetime
 import logging
 
+from botocore.config import Config
+
+from job_state_index import DynamoDBJobStateBackend, InMemoryJobStateBackend, JobStateIndex
+from instance_sizing import count_drop_backlog, size_processing_instances
+from trigger_coalescer import batch_token, batch_item_failures, count_new_objects, count_restart_requests, is_sqs_batch, make_restart_message
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 project_prefix=os.environ['PROJECT_PREFIX']
 sagemaker_pipeline_name="{}-groundtruth-pipeline".format(project_prefix)
+images_per_processing_instance=int(os.environ.get('IMAGES_PER_PROCESSING_INSTANCE', 2000))
+max_processing_instances=int(os.environ.get('MAX_PROCESSING_INSTANCES', 4))
+#the backlog is counted in the drop bucket, the number of drop events in a batch is only a lower bound of it
+drop_bucket=os.environ.get('DROP_BUCKET')
+#images rejected by the feature engineering quality gate are moved here in the drop bucket, they are not new work
+quarantine_prefix=os.environ.get('QUARANTINE_PREFIX', "quarantine/")
+
+#an execution in one of these states still lists, crops and chains from the drop bucket, a second one would race it
+ACTIVE_PIPELINE_EXECUTION_STATUSES = ["Executing", "Stopping"]
+
+#restarts that find the pipeline busy are queued with the drop events, to be retried once it is free
+drop_event_queue_url = os.environ.get('DROP_EVENT_QUEUE_URL')
+restart_retry_delay_seconds = int(os.environ.get('RESTART_RETRY_DELAY_SECONDS', 300))
+
+#Fail over to a retry well inside the function timeout rather than waiting out botocore's 60s defaults
+client_config = Config(
+    connect_timeout=int(os.environ.get('CLIENT_CONNECT_TIMEOUT', 2)),
+    read_timeout=int(os.environ.get('CLIENT_READ_TIMEOUT', 3)),
+    retries={'max_attempts': int(os.environ.get('CLIENT_MAX_ATTEMPTS', 2)), 'mode': 'standard'}
+)
+
+sm_client = boto3.client("sagemaker", config=client_config)
+#clients only some events need, created on first use
+clients = {}
+
+#Job state is kept in DynamoDB when a table is configured, otherwise cached for the life of this container
+job_state_table = os.environ.get('JOB_STATE_TABLE')
+job_state_index = None
+
+def get_job_state_index():
+    """
+    The job state index, created on first use - only EventBridge job state events need it, so drop events don't pay
+    for loading the DynamoDB client on a cold start.
+    """
+    global job_state_index
+    if job_state_index is None:
+        if job_state_table:
+            job_state_backend = DynamoDBJobStateBackend(boto3.client("dynamodb", config=client_config), job_state_table)
+        else:
+            job_state_backend = InMemoryJobStateBackend()
+        job_state_index = JobStateIndex(job_state_backend, sm_client)
+    return job_state_index
 
-sm_client = boto3.client("sagemaker")
+class PipelineBusy(Exception):
+    """Raised to have Lambda retry an event once the pipeline execution in progress has finished."""
+
+
+def get_active_pipeline_execution():
+    """
+    The pipeline execution still in progress, if any. The function runs one invocation at a time, reserved
+    concurrency 1, so no other invocation can start an execution between this check and our own start.
+    :return: the execution summary, or None.
+    """
+    response = sm_client.list_pipeline_executions(PipelineName=sagemaker_pipeline_name, SortBy="CreationTime", SortOrder="Descending", MaxResults=10)
+    for summary in response.get('PipelineExecutionSummaries', []):
+        if summary.get('PipelineExecutionStatus') in ACTIVE_PIPELINE_EXECUTION_STATUSES:
+            return summary
+    return None
+
+def get_client(service_name):
+    if service_name not in clients:
+        clients[service_name] = boto3.client(service_name, config=client_config)
+    return clients[service_name]
+
+def queue_restart(labeling_job_arn):
+    """Queues a restart for the labeling job with the drop events."""
+    get_client("sqs").send_message(QueueUrl=drop_event_queue_url, MessageBody=make_restart_message(labeling_job_arn), DelaySeconds=restart_retry_delay_seconds)
 
 def round_time(dt=None, date_delta=datetime.timedelta(minutes=1), to='average'):
     """
@@ -20,7 +91,7 @@ def round_time(dt=None, date_delta=datetime.timedelta(minutes=1), to='average'):
     """
     round_to = date_delta.total_seconds()
     if dt is None:
-        dt = datetime.now()
+        dt = datetime.datetime.now()
     seconds = (dt - dt.min).seconds
 
     if seconds % round_to == 0 and dt.microsecond == 0:
@@ -37,63 +108,103 @@ def round_time(dt=None, date_delta=datetime.timedelta(minutes=1), to='average'):
     return dt + datetime.timedelta(0, rounding - seconds, - dt.microsecond)
 
 def handler(event, context):
-    print("--starting script--")
-    print("event:\n{}".format(event))
+    #one timestamp for the request token and display name, so they can't straddle a minute boundary
+    now = datetime.datetime.now()
+    logger.debug("event: {}".format(event))
 
     restart_labeling_job=True
+    #number of new drop images in the event, and of drop images waiting, the backlog this execution is started for
+    new_drop_count=0
+    pending_backlog_size=0
+    #whether the only reason to start is new drop images, which an execution since may already have picked up
+    only_new_drops=False
+    # Make a unique token that only allows one request to SageMaker Pipelines every 10 minutes using a time rounding function
+    l_clientRequestToken = "{}-triggerpipeline-{}".format(project_prefix, str(round_time(now, date_delta=datetime.timedelta(minutes=10), to="up")))
 
     if 'detail-type' in event and 'resources' in event and event['detail-type'] == "SageMaker Ground Truth Labeling Job State Change":
         logger.info("Event triggered via EventBridge event - SageMaker Ground Truth Labeling Job State Change, resource: {}".format(event['resources'][0]))
         groundTruthLabelingJobArn = event['resources'][0]
-        labelingjobs = sm_client.list_labeling_jobs(
-            SortBy='CreationTime',
-            SortOrder='Descending',
-            NameContains=project_prefix,
-            MaxResults=10
-        )
         #If triggered from EventBridge set to not run unless we find missing labels from this job.
         restart_labeling_job=False
-        labelingJobName=""
-        
-        if len(labelingjobs['LabelingJobSummaryList']) > 0:
-            for job in labelingjobs['LabelingJobSummaryList']:
-                if job['LabelingJobArn']==groundTruthLabelingJobArn:
-                    labelingJobName = job['LabelingJobName']
-                    labelingJobStatus = job['LabelingJobStatus']
-                    logger.info("Found job from lookup: {}, status=".format(labelingJobName, labelingJobStatus))
-                    #If job is failed this is usually not good, we only want to proceed if Stopped or Completed and there are still remaining items to label
-                    total_labeled=job['LabelCounters']['TotalLabeled']
-                    total_unlabeled=job['LabelCounters']['Unlabeled']
-                    total_failed_nonretryable_error=job['LabelCounters']['FailedNonRetryableError']
-                    logger.info('Total Labeled: {}'.format(total_labeled))
-                    logger.info('Total Unlabeled: {}'.format(total_unlabeled))
-                    logger.info('Total Failed Non-Retryable Error: {}'.format(total_failed_nonretryable_error))
-
-                    if (labelingJobStatus=="Completed" or labelingJobStatus=="Stopped"):
-                        if (total_unlabeled>0 or total_failed_nonretryable_error>0):
-                            restart_labeling_job=True
-                            logger.info("As Unlabeled or Non-retryable errors exist in job, start a new chained job")
-                    break
+
+        #the event carries the job's new status, and its label counters when it has them
+        job = get_job_state_index().lookup(groundTruthLabelingJobArn, event.get('detail'))
+        if job is not None and project_prefix not in job['LabelingJobName']:
+            logger.info("Job {} does not belong to project_prefix={}, ignoring".format(job['LabelingJobName'], project_prefix))
+        elif job is not None:
+            labelingJobName = job['LabelingJobName']
+            labelingJobStatus = job['LabelingJobStatus']
+            logger.info("Found job from lookup: {}, status={}".format(labelingJobName, labelingJobStatus))
+            #If job is failed this is usually not good, we only want to proceed if Stopped or Completed and there are still remaining items to label
+            total_labeled=job['LabelCounters']['TotalLabeled']
+            total_unlabeled=job['LabelCounters']['Unlabeled']
+            total_failed_nonretryable_error=job['LabelCounters']['FailedNonRetryableError']
+            logger.info('Total Labeled: {}, Unlabeled: {}, Failed Non-Retryable Error: {}'.format(total_labeled, total_unlabeled, total_failed_nonretryable_error))
+
+            if (labelingJobStatus=="Completed" or labelingJobStatus=="Stopped"):
+                if (total_unlabeled>0 or total_failed_nonretryable_error>0):
+                    restart_labeling_job=True
+                    logger.info("As Unlabeled or Non-retryable errors exist in job, start a new chained job")
+    elif is_sqs_batch(event):
+        #Drop bucket notifications are buffered in SQS, the event source only invokes us once enough have arrived or the oldest has waited long enough
+        new_drop_count=count_new_objects(event, [quarantine_prefix])
+        restart_requests=count_restart_requests(event)
+        logger.info("Event triggered via SQS batch of {} messages, new drop objects: {}, queued restarts: {}".format(len(event['Records']), new_drop_count, restart_requests))
+        only_new_drops=restart_requests==0
+        if new_drop_count==0 and restart_requests==0:
+            restart_labeling_job=False
+        #the event source already coalesced the burst, a batch that arrives once the last execution has finished is
+        #new work that needs its own execution. A time bucketed token would have SageMaker dedupe it, leaving its
+        #images in the drop bucket, so the token is the batch's, which still dedupes a redelivery of the same messages
+        l_clientRequestToken = "{}-triggerpipeline-{}".format(project_prefix, batch_token(event))
     else:
         logger.info("Assumed triggered by S3 or manual Lambda Test")
+        new_drop_count=count_new_objects(event, [quarantine_prefix])
+        only_new_drops=new_drop_count>0
 
     if restart_labeling_job:
-        # Make a unique token that only allows one request to SageMaker Pipelines every 10 minutes using a time rounding function
-        l_clientRequestToken = "{}-triggerpipeline-{}".format(project_prefix, str(round_time(datetime.datetime.now(), date_delta=datetime.timedelta(minutes=10), to="up")))
+        active_execution = get_active_pipeline_execution()
+        if active_execution is not None:
+            #the running execution lists the drop bucket again until it is empty, so it picks up most of what arrived
+            #since it started. Whatever arrives after its last listing is retried here once it has finished.
+            logger.info("Pipeline execution {} is {}, not starting another".format(active_execution['PipelineExecutionArn'], active_execution['PipelineExecutionStatus']))
+            if is_sqs_batch(event):
+                #the batch goes back to the queue and is delivered again once its visibility timeout is up
+                return batch_item_failures(event)
+            if 'detail-type' in event and drop_event_queue_url:
+                #a job state change event is not delivered again, so the restart is queued to be retried
+                queue_restart(event['resources'][0])
+                logger.info("Restart for {} queued, retried in {}s".format(event['resources'][0], restart_retry_delay_seconds))
+                return
+            raise PipelineBusy("Pipeline execution {} is still {}".format(active_execution['PipelineExecutionArn'], active_execution['PipelineExecutionStatus']))
+
+        pending_backlog_size=new_drop_count
+        if drop_bucket:
+            #every execution processes the whole drop bucket, so it is sized from what is waiting there. Counting stops
+            #at the most images the step is ever sized for.
+            backlog_limit=images_per_processing_instance * max_processing_instances
+            pending_backlog_size=count_drop_backlog(get_client("s3"), drop_bucket, limit=backlog_limit)
+            logger.info("Drop images waiting: {}{}".format(pending_backlog_size, " or more" if pending_backlog_size >= backlog_limit else ""))
+            if pending_backlog_size==0 and only_new_drops:
+                logger.info("The new drop images were already picked up by an earlier execution. Pipeline not triggered.")
+                return
+
+        pipeline_parameters=[
+            {'Name': 'PendingBacklogSize', 'Value': str(pending_backlog_size)},
+        ]
+        if pending_backlog_size>0:
+            #scale the sharded feature engineering step with the backlog, otherwise leave the pipeline default
+            processing_instance_count=size_processing_instances(pending_backlog_size, images_per_processing_instance, max_processing_instances)
+            pipeline_parameters.append({'Name': 'ProcessingInstanceCount', 'Value': str(processing_instance_count)})
+            logger.info("Processing instance count for backlog: {}".format(processing_instance_count))
 
         response = sm_client.start_pipeline_execution(
             PipelineName=sagemaker_pipeline_name,
-            PipelineExecutionDisplayName="{}-{}{:02d}{:02d}{}{}{}".format(
-                project_prefix,datetime.datetime.now().year, 
-                datetime.datetime.now().month, 
-                datetime.datetime.now().day,
-                datetime.datetime.now().hour, 
-                datetime.datetime.now().minute, 
-                datetime.datetime.now().second, 
-            ),
+            PipelineExecutionDisplayName="{}-{}".format(project_prefix, now.strftime("%Y%m%d%H%M%S")),
             PipelineExecutionDescription="Task to prepare new drop images for Froth Labeling with Ground Truth",
-            ClientRequestToken=l_clientRequestToken
+            ClientRequestToken=l_clientRequestToken,
+            PipelineParameters=pipeline_parameters
         )
-        logger.info("New sagemaker pipeline triggered - {}".format(l_clientRequestToken))
+        logger.info("New sagemaker pipeline triggered - {}, pending backlog: {}".format(l_clientRequestToken, pending_backlog_size))
     else:
         logger.info("Pipeline not triggered.")
\ No newline at end of file
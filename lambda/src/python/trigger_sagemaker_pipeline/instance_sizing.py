@@ -0,0 +1,34 @@
+"""Sizes the feature engineering step of the pipeline from the backlog of drop images."""
+import math
+
+
+def size_processing_instances(backlog_size, images_per_instance=2000, max_instances=4):
+    """
+    Picks the processing instance count for a backlog, one instance per images_per_instance images. The feature
+    engineering step shards the drop bucket across its instances, so wall time falls in proportion until
+    max_instances is reached.
+    :param backlog_size: number of drop images waiting, 0 when not known.
+    :param images_per_instance: the number of images one instance is left to work through.
+    :param max_instances: the most instances to start, also bounded by the account's processing instance quota.
+    :return: the instance count, at least 1.
+    """
+    if backlog_size <= 0:
+        return 1
+    return max(1, min(max_instances, int(math.ceil(backlog_size / float(images_per_instance)))))
+
+
+def count_drop_backlog(s3_client, bucket, limit=0):
+    """
+    Counts the images waiting directly under the root of the drop bucket, the work a pipeline execution will do.
+    Anything under a prefix, such as the images feature engineering quarantines, is not counted, as it is not listed
+    by feature engineering either.
+    :param limit: stop counting once this many are found, enough to size the step with, 0 counts them all.
+    :return: the count, at most limit when one is given.
+    """
+    count = 0
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Delimiter='/'):
+        count += len(page.get('Contents', []))
+        if limit and count >= limit:
+            return limit
+    return count
@@ -0,0 +1,153 @@
+"""Index of the state of a project's GroundTruth labeling jobs, keyed by job ARN."""
+import logging
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+logger = logging.getLogger()
+
+#once a job reaches one of these states its status and label counters never change again
+TERMINAL_JOB_STATUSES = ["Completed", "Stopped", "Failed"]
+
+
+def get_job_name_from_arn(labeling_job_arn):
+    """
+    arn:aws:sagemaker:region:account:labeling-job/my-job-name -> my-job-name
+    """
+    return labeling_job_arn.split('/')[-1]
+
+
+class InMemoryJobStateBackend(object):
+    """Useage:
+        backend = InMemoryJobStateBackend()
+        backend.put({'LabelingJobArn': 'arn:...', 'LabelingJobStatus': 'InProgress'})
+        backend.get('arn:...')
+
+    Stand-in for the DynamoDB table, for local runs and tests. Kept at module scope in the Lambda it also acts as a
+    per container cache when no table is configured.
+    """
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, labeling_job_arn):
+        return self.items.get(labeling_job_arn)
+
+    def put(self, item):
+        self.items[item['LabelingJobArn']] = dict(item)
+
+
+class DynamoDBJobStateBackend(object):
+    """Useage:
+        backend = DynamoDBJobStateBackend(boto3.client('dynamodb'), 'myproject-image-labeling-labeling-job-state')
+
+    Stores job state items in a DynamoDB table with a LabelingJobArn string partition key.
+    """
+
+    def __init__(self, dynamodb_client, table_name):
+        self.dynamodb = dynamodb_client
+        self.table_name = table_name
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def get(self, labeling_job_arn):
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={'LabelingJobArn': {'S': labeling_job_arn}},
+            ConsistentRead=True
+        )
+        if 'Item' not in response:
+            return None
+        return self._to_python({key: self._deserializer.deserialize(value) for key, value in response['Item'].items()})
+
+    def put(self, item):
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={key: self._serializer.serialize(value) for key, value in item.items() if value is not None}
+        )
+
+    def _to_python(self, value):
+        #DynamoDB hands numbers back as Decimal, all of ours are whole numbers
+        if isinstance(value, dict):
+            return {key: self._to_python(item) for key, item in value.items()}
+        if hasattr(value, 'to_integral_value'):
+            return int(value)
+        return value
+
+
+class JobStateIndex(object):
+    """Useage:
+        index = JobStateIndex(InMemoryJobStateBackend(), sm_client)
+        job = index.lookup(labeling_job_arn, event['detail'])
+        job['LabelingJobStatus'], job['LabelCounters']['Unlabeled']
+
+    Looks up labeling jobs by ARN. The status and label counters a job state change event carries are written to
+    the index and the job answered from it. describe_labeling_job is only a fallback, for a job that isn't in the
+    index yet or whose label counters were never recorded, and its answer is written back to the index.
+    """
+
+    def __init__(self, backend, sm_client):
+        self.backend = backend
+        self.sm_client = sm_client
+
+    def lookup(self, labeling_job_arn, detail=None):
+        """
+        :param detail: the detail of the job state change event, if the lookup is for one.
+        :return: the job state item, or None if the job does not exist.
+        """
+        job = self.backend.get(labeling_job_arn)
+        if detail:
+            job = self.record_event(labeling_job_arn, detail, job)
+            current = 'LabelingJobStatus' in job and 'LabelCounters' in job
+        else:
+            #without an event only a job in a terminal state is known not to have moved on
+            current = job is not None and job.get('LabelingJobStatus') in TERMINAL_JOB_STATUSES and 'LabelCounters' in job
+        if current:
+            logger.info("Job state index hit: {}".format(labeling_job_arn))
+            return job
+        return self.refresh(labeling_job_arn)
+
+    def record_event(self, labeling_job_arn, detail, job=None):
+        """
+        Writes the status and label counters of a job state change event over the job's entry in the index.
+        :param job: the job's entry, as already read from the index.
+        :return: the updated job state item.
+        """
+        updated = dict(job) if job is not None else {'LabelingJobArn': labeling_job_arn, 'LabelingJobName': get_job_name_from_arn(labeling_job_arn)}
+        if 'LabelingJobStatus' in detail and detail['LabelingJobStatus'] != updated.get('LabelingJobStatus'):
+            updated['LabelingJobStatus'] = detail['LabelingJobStatus']
+            #counters recorded under an earlier status no longer hold
+            updated.pop('LabelCounters', None)
+        if 'LabelCounters' in detail:
+            updated['LabelCounters'] = {key: value for key, value in detail['LabelCounters'].items()}
+        if updated != job:
+            self.backend.put(updated)
+        return updated
+
+    def refresh(self, labeling_job_arn):
+        """
+        Reads the current state of a job with describe_labeling_job and stores it in the index.
+        :return: the job state item, or None if the job does not exist.
+        """
+        try:
+            description = self.sm_client.describe_labeling_job(LabelingJobName=get_job_name_from_arn(labeling_job_arn))
+        except self.sm_client.exceptions.ResourceNotFound:
+            logger.info("Labeling job not found: {}".format(labeling_job_arn))
+            return None
+        job = make_job_state_item(description)
+        self.backend.put(job)
+        return job
+
+
+def make_job_state_item(description):
+    """
+    Builds a job state item from a describe_labeling_job response or a list_labeling_jobs summary.
+    """
+    output = description.get('LabelingJobOutput') or {}
+    return {
+        'LabelingJobArn': description['LabelingJobArn'],
+        'LabelingJobName': description['LabelingJobName'],
+        'LabelingJobStatus': description['LabelingJobStatus'],
+        'CreationTime': description['CreationTime'].isoformat() if description.get('CreationTime') else None,
+        'LabelCounters': {key: value for key, value in (description.get('LabelCounters') or {}).items()},
+        'OutputDatasetS3Uri': output.get('OutputDatasetS3Uri'),
+    }
@@ -0,0 +1,168 @@
+"""Coalesces drop bucket events so a burst of uploads starts a single pipeline execution."""
+import hashlib
+import json
+import logging
+import time
+import uuid
+from urllib.parse import unquote_plus
+
+logger = logging.getLogger()
+
+
+def get_s3_records(event):
+    """
+    Collects the S3 event records from a direct S3 notification, or from the notifications buffered in a batch of
+    SQS messages.
+    :param event: Lambda event
+    """
+    records = []
+    for record in event.get('Records', []):
+        if record.get('eventSource') == "aws:sqs":
+            body = json.loads(record['body'])
+            #S3 sends a s3:TestEvent, without Records, when the notification is first configured
+            records.extend(body.get('Records', []))
+        elif record.get('eventSource') == "aws:s3":
+            records.append(record)
+    return records
+
+
+def is_sqs_batch(event):
+    records = event.get('Records', [])
+    return len(records) > 0 and records[0].get('eventSource') == "aws:sqs"
+
+
+def batch_token(event):
+    """
+    Identifies an SQS batch by its message ids, the same for a redelivery of the same messages, and different for
+    every other batch however close together they arrive.
+    :return: 32 hex characters.
+    """
+    message_ids = sorted(record['messageId'] for record in event.get('Records', []))
+    return hashlib.sha256("\n".join(message_ids).encode("utf-8")).hexdigest()[:32]
+
+
+def make_restart_message(labeling_job_arn):
+    """
+    A drop event queue message asking for a pipeline execution to chain from a labeling job, for a restart that
+    could not start one straight away. It is delivered with the drop events and retried with them.
+    """
+    return json.dumps({'RestartLabelingJob': labeling_job_arn})
+
+
+def count_restart_requests(event):
+    return len([
+        record for record in event.get('Records', [])
+        if record.get('eventSource') == "aws:sqs" and 'RestartLabelingJob' in json.loads(record['body'])
+    ])
+
+
+def batch_item_failures(event):
+    """
+    The response that hands every message of an SQS batch back to the queue, to be delivered again once its
+    visibility timeout is up. Needs ReportBatchItemFailures on the event source.
+    """
+    return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in event.get('Records', [])]}
+
+
+def count_new_objects(event, ignored_prefixes=()):
+    """
+    Counts the objects created in the drop bucket in an event, this is the backlog the pipeline is started for.
+    :param ignored_prefixes: prefixes of keys that are not new drop images, such as where feature engineering
+        quarantines the images its quality gate rejects.
+    """
+    ignored_prefixes = tuple(ignored_prefixes)
+    return len([
+        record for record in get_s3_records(event)
+        if record.get('eventName', '').startswith("ObjectCreated:")
+        #keys in S3 event notifications are URL encoded
+        and not (ignored_prefixes and unquote_plus(record.get('s3', {}).get('object', {}).get('key', '')).startswith(ignored_prefixes))
+    ])
+
+
+def make_sqs_batch_event(message_bodies, queue_arn="arn:aws:sqs:local:000000000000:drop-events"):
+    """
+    Wraps message bodies in the event the Lambda SQS event source sends, each message with its own id as SQS gives it.
+    """
+    return {'Records': [
+        {
+            'messageId': str(uuid.uuid4()),
+            'body': body,
+            'eventSource': "aws:sqs",
+            'eventSourceARN': queue_arn,
+        } for body in message_bodies
+    ]}
+
+
+class LocalEventQueue(object):
+    """Useage:
+        queue = LocalEventQueue(handler, batch_size=100, max_wait_seconds=120)
+        queue.send(json.dumps(s3_notification))
+        queue.poll()
+        ...
+        queue.flush()
+
+    Local stand-in for the drop event SQS queue and the Lambda event source batching in front of it. Messages are
+    buffered until batch_size messages are waiting or the oldest has waited max_wait_seconds, then handed to the
+    handler as a single SQS batch event. Messages the handler reports back in batchItemFailures are hidden for
+    visibility_timeout seconds, then buffered again to be delivered in a later batch.
+    """
+
+    def __init__(self, handler, batch_size=100, max_wait_seconds=120, visibility_timeout=360, clock=time.monotonic):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.visibility_timeout = visibility_timeout
+        self.clock = clock
+        self.messages = []
+        self.first_message_time = None
+        # (time visible again, message body) of the messages handed back by the handler
+        self.hidden = []
+        self.batches_delivered = 0
+        self.messages_redelivered = 0
+
+    def send(self, message_body):
+        if not self.messages:
+            self.first_message_time = self.clock()
+        self.messages.append(message_body)
+        return self.poll()
+
+    def next_visible_time(self):
+        """When the first hidden message is visible again, None if none are hidden."""
+        return min(visible_time for visible_time, _ in self.hidden) if self.hidden else None
+
+    def ready(self):
+        if not self.messages:
+            return False
+        return len(self.messages) >= self.batch_size or self.clock() - self.first_message_time >= self.max_wait_seconds
+
+    def poll(self):
+        """
+        Delivers the buffered messages if the batch is full or has waited long enough.
+        :return: the handler result, or None if nothing was delivered.
+        """
+        now = self.clock()
+        visible = [message_body for visible_time, message_body in self.hidden if visible_time <= now]
+        if visible:
+            self.hidden = [(visible_time, message_body) for visible_time, message_body in self.hidden if visible_time > now]
+            self.messages_redelivered += len(visible)
+            if not self.messages:
+                self.first_message_time = now
+            self.messages.extend(visible)
+        if not self.ready():
+            return None
+        return self.flush()
+
+    def flush(self):
+        if not self.messages:
+            return None
+        batch, self.messages = self.messages[:self.batch_size], self.messages[self.batch_size:]
+        self.first_message_time = self.clock() if self.messages else None
+        self.batches_delivered += 1
+        logger.info("Delivering batch of {} drop events".format(len(batch)))
+        event = make_sqs_batch_event(batch)
+        result = self.handler(event, None)
+        failed_ids = set(failure['itemIdentifier'] for failure in (result or {}).get('batchItemFailures', []))
+        if failed_ids:
+            visible_time = self.clock() + self.visibility_timeout
+            self.hidden.extend((visible_time, record['body']) for record in event['Records'] if record['messageId'] in failed_ids)
+        return result
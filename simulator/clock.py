@@ -0,0 +1,94 @@
+"""Simulated time for the local simulator - a clock the simulation moves forward, which datetime.now() follows."""
+import contextlib
+import datetime
+import heapq
+import itertools
+
+_real_datetime = datetime.datetime
+
+
+class SimClock(object):
+    """Useage:
+        clock = SimClock(datetime.datetime(2021, 6, 1))
+        clock.at(60, callback)
+        clock.run_until(3600)
+
+    Seconds since the start of the simulation, and the events scheduled on them. Events run in time order, those
+    scheduled for the same second in the order they were scheduled, and the clock stands still while each runs.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.seconds = 0.0
+        self._events = []
+        self._sequence = itertools.count()
+
+    def now(self):
+        """The simulated time, naive UTC as Lambda and the processing containers run in UTC."""
+        return self.start + datetime.timedelta(seconds=self.seconds)
+
+    def monotonic(self):
+        return self.seconds
+
+    def at(self, seconds, callback, *args):
+        """Schedules callback(*args) at the given simulated second, now if that is already past."""
+        heapq.heappush(self._events, (max(seconds, self.seconds), next(self._sequence), callback, args))
+
+    def after(self, delay_seconds, callback, *args):
+        self.at(self.seconds + delay_seconds, callback, *args)
+
+    def run_until(self, end_seconds):
+        """
+        Runs the events scheduled up to end_seconds, including any they schedule, then moves the clock to end_seconds.
+        :return: the number of events run.
+        """
+        count = 0
+        while self._events and self._events[0][0] <= end_seconds:
+            seconds, _, callback, args = heapq.heappop(self._events)
+            self.seconds = seconds
+            callback(*args)
+            count += 1
+        self.seconds = max(self.seconds, end_seconds)
+        return count
+
+
+class _SimulatedDatetimeType(type):
+    #real datetimes, made before the patch or by C code, are still instances
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, _real_datetime)
+
+    def __subclasscheck__(cls, subclass):
+        return issubclass(subclass, _real_datetime)
+
+
+def _make_simulated_datetime(clock):
+    class SimulatedDatetime(_real_datetime, metaclass=_SimulatedDatetimeType):
+        @classmethod
+        def now(cls, tz=None):
+            if tz is None:
+                return clock.now()
+            return clock.now().replace(tzinfo=datetime.timezone.utc).astimezone(tz)
+
+        @classmethod
+        def utcnow(cls):
+            return clock.now()
+
+        @classmethod
+        def today(cls):
+            return clock.now()
+
+    return SimulatedDatetime
+
+
+@contextlib.contextmanager
+def simulated_datetime(clock):
+    """
+    Makes datetime.datetime.now() follow the clock, for code that reads datetime.datetime when called, as index.py
+    does, and code that does "from datetime import datetime" while the patch is in place, as the step scripts do when
+    the simulator runs them. time.time() is untouched, wall clock timings stay wall clock.
+    """
+    datetime.datetime = _make_simulated_datetime(clock)
+    try:
+        yield clock
+    finally:
+        datetime.datetime = _real_datetime
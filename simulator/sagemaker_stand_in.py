@@ -0,0 +1,397 @@
+"""Stand-in for the SageMaker APIs the pipeline calls - labeling jobs worked through by a simulated workforce, and pipeline executions."""
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import re
+import uuid
+from collections import namedtuple
+
+import boto3
+import botocore.handlers
+import numpy as np
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+
+logger = logging.getLogger()
+
+ACCOUNT = "000000000000"
+
+#CreateLabelingJob's LabelingJobName constraint, which botocore does not check
+LABELING_JOB_NAME = re.compile(r"^[a-zA-Z0-9](-*[a-zA-Z0-9]){0,62}$")
+
+TERMINAL_JOB_STATUSES = ("Completed", "Failed", "Stopped")
+
+#the failure reason Ground Truth records for tasks nobody took before TaskAvailabilityLifetimeInSeconds ran out
+EXPIRED_REASON = "ClientError: Annotation tasks expired."
+FAILED_REASON = "ClientError: Annotation consolidation failed."
+
+
+class SageMakerError(Exception):
+    """An error response, raised by the client as the modeled exception for code, such as ResourceNotFound."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class Workforce(namedtuple('Workforce', ['labels_per_hour', 'failure_rate', 'tick_seconds'])):
+    """
+    The private workforce labeling a job's tasks.
+    labels_per_hour: tasks the workforce completes an hour, from the oldest available first.
+    failure_rate: fraction of the tasks taken that fail, as FailedNonRetryableError.
+    tick_seconds: simulated seconds between the workforce's rounds of work.
+    """
+
+
+class SimulatedLabelingJob(object):
+    """
+    A streaming labeling job. Items from the input manifest, and those fed through its SNS topic, queue up in arrival
+    order and become tasks once the job is InProgress. Entries of the input manifest already holding a label are
+    carried through to the output manifest without being worked, as Ground Truth does when chaining.
+    """
+
+    def __init__(self, request, arn, created_seconds):
+        self.request = request
+        self.name = request['LabelingJobName']
+        self.arn = arn
+        self.status = "Initializing"
+        self.failure_reason = None
+        self.created_seconds = created_seconds
+        self.in_progress_seconds = None
+        self.ended_seconds = None
+        self.last_modified_seconds = created_seconds
+        self.last_activity_seconds = created_seconds
+        self.label_attribute_name = request['LabelAttributeName']
+        self.topic_arn = request['InputConfig']['DataSource'].get('SnsDataSource', {}).get('SnsTopicArn')
+        self.task_config = request['HumanTaskConfig']
+        #output manifest entries, in the order they reached the job, updated in place as they are worked
+        self.entries = []
+        #(entry, arrival second) of the entries waiting to be labeled, oldest first
+        self.pending = collections.deque()
+        self.items_received = 0
+        self.counters = {'TotalLabeled': 0, 'HumanLabeled': 0, 'MachineLabeled': 0, 'FailedNonRetryableError': 0, 'Unlabeled': 0}
+        self.labels_owed = 0.0
+
+    def add(self, entry, seconds):
+        """
+        Queues an entry for labeling.
+        :return: True if it is work, False if it already holds a label.
+        """
+        self.entries.append(entry)
+        if self.label_attribute_name in entry:
+            return False
+        self.pending.append((entry, seconds))
+        self.items_received += 1
+        self.counters['Unlabeled'] += 1
+        self.last_activity_seconds = seconds
+        return True
+
+    def available_seconds(self, arrival_seconds):
+        """When an entry that arrived at arrival_seconds became, or will become, a task."""
+        return max(arrival_seconds, self.in_progress_seconds)
+
+    def fail(self, entry, reason, seconds):
+        entry["{}-metadata".format(self.label_attribute_name)] = {"failure-reason": reason, "human-annotated": "true"}
+        self.counters['FailedNonRetryableError'] += 1
+        self.counters['Unlabeled'] -= 1
+        self.last_activity_seconds = seconds
+
+    def label(self, entry, creation_date, seconds):
+        index = self.counters['TotalLabeled']
+        entry[self.label_attribute_name] = "{}/{}/annotations/consolidated-annotation/output/{}_{}.png".format(
+            self.request['OutputConfig']['S3OutputPath'].rstrip("/"), self.name, index, creation_date.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+        entry["{}-metadata".format(self.label_attribute_name)] = {
+            "type": "groundtruth/semantic-segmentation",
+            "human-annotated": "yes",
+            "creation-date": creation_date.isoformat(),
+            "job-name": "labeling-job/{}".format(self.name),
+        }
+        self.counters['TotalLabeled'] += 1
+        self.counters['HumanLabeled'] += 1
+        self.counters['Unlabeled'] -= 1
+        self.last_activity_seconds = seconds
+
+    def output_manifest_uri(self):
+        return "{}/{}/manifests/output/output.manifest".format(self.request['OutputConfig']['S3OutputPath'].rstrip("/"), self.name)
+
+
+class SageMakerStandIn(object):
+    """Useage:
+        sagemaker = SageMakerStandIn(clock, s3_client, Workforce(120, 0.02, 60), on_pipeline_execution=run_pipeline)
+        with sagemaker.installed():
+            sm_client = boto3.client("sagemaker")
+            sm_client.list_labeling_jobs(NameContains="my-project")
+
+    Answers the SageMaker calls of every boto3 client created while installed, through botocore's before-call event,
+    so requests are still built and validated by botocore, and errors are raised as the client's modeled exceptions.
+    Labeling jobs move from Initializing to InProgress after job_startup_seconds, are worked by the workforce, and
+    finish as Completed once nothing has arrived for idle_seconds, as streaming jobs do, or as Stopped when stopped,
+    or stop_after_seconds after they started if set. Their output manifests are written to S3 as they finish.
+
+    :param clock: SimClock the jobs run on.
+    :param s3_client: client of the S3 the manifests are read from and written to.
+    :param on_pipeline_execution: called with each new pipeline execution, a dict of its request and parameters. It
+        is Executing until finish_pipeline_execution is called with it.
+    :param on_job_state_change: called with each job whose status changes, as EventBridge would.
+    :param on_task_available: called with (source-ref, second, job name) as each item becomes a task.
+    """
+
+    def __init__(self, clock, s3_client, workforce, region="us-east-1", job_startup_seconds=180, idle_seconds=864000,
+                 stop_after_seconds=0, stop_seconds=60, seed=0, on_pipeline_execution=None, on_job_state_change=None,
+                 on_task_available=None):
+        self.clock = clock
+        self.s3_client = s3_client
+        self.workforce = workforce
+        self.region = region
+        self.job_startup_seconds = job_startup_seconds
+        self.idle_seconds = idle_seconds
+        self.stop_after_seconds = stop_after_seconds
+        self.stop_seconds = stop_seconds
+        self.on_pipeline_execution = on_pipeline_execution
+        self.on_job_state_change = on_job_state_change
+        self.on_task_available = on_task_available
+        self.jobs = collections.OrderedDict()
+        self.pipeline_executions = collections.OrderedDict()
+        self.duplicate_pipeline_requests = 0
+        self.max_active_jobs = 0
+        self.calls = collections.Counter()
+        self._rng = np.random.default_rng(seed)
+        self._ticking = False
+
+    @contextlib.contextmanager
+    def installed(self):
+        """Answers SageMaker calls of boto3 clients created inside the block, the default session included."""
+        handler = ('before-call.sagemaker', self._before_call)
+        botocore.handlers.BUILTIN_HANDLERS.append(handler)
+        boto3.DEFAULT_SESSION = None
+        try:
+            yield self
+        finally:
+            botocore.handlers.BUILTIN_HANDLERS.remove(handler)
+            boto3.DEFAULT_SESSION = None
+
+    def _before_call(self, model, params, **kwargs):
+        operation = getattr(self, "_{}".format(xform_name(model.name)), None)
+        if operation is None:
+            raise NotImplementedError("The simulator does not stand in for SageMaker {}".format(model.name))
+        self.calls[model.name] += 1
+        request = json.loads(params['body'] or b"{}")
+        metadata = {'RequestId': str(uuid.uuid4()), 'HTTPHeaders': {}, 'RetryAttempts': 0}
+        try:
+            response = operation(request)
+        except SageMakerError as e:
+            metadata['HTTPStatusCode'] = 400
+            return AWSResponse("", 400, {}, None), {'Error': {'Code': e.code, 'Message': str(e)}, 'ResponseMetadata': metadata}
+        metadata['HTTPStatusCode'] = 200
+        response['ResponseMetadata'] = metadata
+        return AWSResponse("", 200, {}, None), response
+
+    #labeling jobs
+
+    def _create_labeling_job(self, request):
+        name = request['LabelingJobName']
+        if not LABELING_JOB_NAME.match(name):
+            raise SageMakerError("ValidationException", "LabelingJobName {} must match {} and be at most 63 characters".format(name, LABELING_JOB_NAME.pattern))
+        if name in self.jobs:
+            raise SageMakerError("ResourceInUse", "Labeling job {} already exists".format(name))
+        job = SimulatedLabelingJob(request, "arn:aws:sagemaker:{}:{}:labeling-job/{}".format(self.region, ACCOUNT, name.lower()), self.clock.monotonic())
+        self.jobs[name] = job
+        self.max_active_jobs = max(self.max_active_jobs, len([other for other in self.jobs.values() if other.status not in TERMINAL_JOB_STATUSES]))
+
+        manifest_uri = request['InputConfig']['DataSource'].get('S3DataSource', {}).get('ManifestS3Uri')
+        if manifest_uri:
+            try:
+                for line in self._read_lines(manifest_uri):
+                    job.add(json.loads(line), job.created_seconds)
+            except Exception as e:
+                job.failure_reason = "ClientError: Unable to read the input manifest {}: {}".format(manifest_uri, e)
+        logger.info("Labeling job %s created, %s items from %s", name, job.items_received, manifest_uri)
+        self.clock.after(self.job_startup_seconds, self._start_job, job)
+        return {'LabelingJobArn': job.arn}
+
+    def _describe_labeling_job(self, request):
+        job = self._get_job(request['LabelingJobName'])
+        description = self._summarise(job)
+        description.update({
+            'JobReferenceCode': job.name,
+            'LabelingJobName': job.name,
+            'LabelAttributeName': job.label_attribute_name,
+            'InputConfig': job.request['InputConfig'],
+            'OutputConfig': job.request['OutputConfig'],
+            'RoleArn': job.request['RoleArn'],
+            'LabelCategoryConfigS3Uri': job.request.get('LabelCategoryConfigS3Uri'),
+            'HumanTaskConfig': job.task_config,
+            'Tags': job.request.get('Tags', []),
+        })
+        return description
+
+    def _list_labeling_jobs(self, request):
+        jobs = [job for job in self.jobs.values() if request.get('NameContains', "") in job.name
+                and request.get('StatusEquals', job.status) == job.status]
+        sort_key = (lambda job: job.name) if request.get('SortBy') == "Name" else (lambda job: job.created_seconds)
+        jobs.sort(key=sort_key, reverse=request.get('SortOrder', "Ascending") == "Descending")
+        return {'LabelingJobSummaryList': [self._summarise(job) for job in jobs]}
+
+    def _stop_labeling_job(self, request):
+        job = self._get_job(request['LabelingJobName'])
+        if job.status in ("Initializing", "InProgress"):
+            self._stop_job(job)
+        return {}
+
+    def _get_job(self, name):
+        if name not in self.jobs:
+            raise SageMakerError("ResourceNotFound", "Could not find labeling job {}".format(name))
+        return self.jobs[name]
+
+    def _summarise(self, job):
+        summary = {
+            'LabelingJobName': job.name,
+            'LabelingJobArn': job.arn,
+            'CreationTime': self._datetime(job.created_seconds),
+            'LastModifiedTime': self._datetime(job.last_modified_seconds),
+            'LabelingJobStatus': job.status,
+            'LabelCounters': dict(job.counters),
+            'WorkteamArn': job.task_config['WorkteamArn'],
+            'PreHumanTaskLambdaArn': job.task_config['PreHumanTaskLambdaArn'],
+            'InputConfig': job.request['InputConfig'],
+        }
+        if job.status in ("Completed", "Stopped"):
+            summary['LabelingJobOutput'] = {'OutputDatasetS3Uri': job.output_manifest_uri()}
+        if job.failure_reason:
+            summary['FailureReason'] = job.failure_reason
+        return summary
+
+    def _datetime(self, seconds):
+        return self.clock.start + datetime.timedelta(seconds=seconds)
+
+    def feed(self, source_ref):
+        """
+        Publishes an item to the streaming labeling topic, every job subscribed to it that is still taking items gets it.
+        :return: the names of the jobs that received it.
+        """
+        received = []
+        for job in self.jobs.values():
+            if job.status in ("Initializing", "InProgress") and job.topic_arn:
+                if job.add({'source-ref': source_ref}, self.clock.monotonic()) and job.status == "InProgress":
+                    self._task_available(job, source_ref, self.clock.monotonic())
+                received.append(job.name)
+        return received
+
+    def _task_available(self, job, source_ref, seconds):
+        if self.on_task_available is not None:
+            self.on_task_available(source_ref, seconds, job.name)
+
+    def _set_status(self, job, status):
+        job.status = status
+        job.last_modified_seconds = self.clock.monotonic()
+        logger.info("Labeling job %s is %s, %s", job.name, status, job.counters)
+        if status in TERMINAL_JOB_STATUSES:
+            job.ended_seconds = job.last_modified_seconds
+        if status in ("Completed", "Stopped"):
+            self._write_output_manifest(job)
+        if self.on_job_state_change is not None:
+            self.on_job_state_change(job)
+
+    def _start_job(self, job):
+        if job.status != "Initializing":
+            return
+        if job.failure_reason:
+            self._set_status(job, "Failed")
+            return
+        job.in_progress_seconds = self.clock.monotonic()
+        job.last_activity_seconds = job.in_progress_seconds
+        self._set_status(job, "InProgress")
+        for entry, _ in job.pending:
+            self._task_available(job, entry['source-ref'], job.in_progress_seconds)
+        if self.stop_after_seconds:
+            self.clock.after(self.stop_after_seconds, self._stop_job, job)
+        if not self._ticking:
+            self._ticking = True
+            self.clock.after(self.workforce.tick_seconds, self._work)
+
+    def _stop_job(self, job):
+        if job.status in TERMINAL_JOB_STATUSES or job.status == "Stopping":
+            return
+        self._set_status(job, "Stopping")
+        self.clock.after(self.stop_seconds, self._set_status, job, "Stopped")
+
+    def _work(self):
+        """One round of the workforce on every InProgress job."""
+        now = self.clock.monotonic()
+        creation_date = self.clock.now()
+        for job in list(self.jobs.values()):
+            if job.status != "InProgress":
+                continue
+            lifetime = job.task_config['TaskAvailabilityLifetimeInSeconds']
+            while job.pending and now - job.available_seconds(job.pending[0][1]) >= lifetime:
+                job.fail(job.pending.popleft()[0], EXPIRED_REASON, now)
+            if not job.pending:
+                #nobody waits on work that isn't there, the rate doesn't build up while the job is empty
+                job.labels_owed = 0.0
+                if now - job.last_activity_seconds >= self.idle_seconds:
+                    self._set_status(job, "Completed")
+                continue
+            job.labels_owed += self.workforce.labels_per_hour * self.workforce.tick_seconds / 3600.0
+            labels = min(int(job.labels_owed), len(job.pending), job.task_config['MaxConcurrentTaskCount'])
+            job.labels_owed -= labels
+            for _ in range(labels):
+                entry, _ = job.pending.popleft()
+                if self._rng.random() < self.workforce.failure_rate:
+                    job.fail(entry, FAILED_REASON, now)
+                else:
+                    job.label(entry, creation_date, now)
+        if any(job.status not in TERMINAL_JOB_STATUSES for job in self.jobs.values()):
+            self.clock.after(self.workforce.tick_seconds, self._work)
+        else:
+            self._ticking = False
+
+    def _write_output_manifest(self, job):
+        bucket, _, key = job.output_manifest_uri()[len("s3://"):].partition("/")
+        body = "".join(json.dumps(entry) + "\n" for entry in job.entries)
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"))
+
+    def _read_lines(self, s3_uri):
+        bucket, _, key = s3_uri[len("s3://"):].partition("/")
+        body = self.s3_client.get_object(Bucket=bucket, Key=key)['Body']
+        for line in body.iter_lines():
+            if line.strip():
+                yield line
+
+    #pipelines
+
+    def _start_pipeline_execution(self, request):
+        #a request with a token already used returns that execution, which is how the trigger Lambda limits executions
+        token = request.get('ClientRequestToken')
+        if token in self.pipeline_executions:
+            self.duplicate_pipeline_requests += 1
+            return {'PipelineExecutionArn': self.pipeline_executions[token]['PipelineExecutionArn']}
+        execution = {
+            'PipelineExecutionArn': "arn:aws:sagemaker:{}:{}:pipeline/{}/execution/{}".format(
+                self.region, ACCOUNT, request['PipelineName'].lower(), uuid.uuid4().hex[:12]),
+            'PipelineName': request['PipelineName'],
+            'PipelineExecutionDisplayName': request.get('PipelineExecutionDisplayName'),
+            'Parameters': {parameter['Name']: parameter['Value'] for parameter in request.get('PipelineParameters', [])},
+            'StartSeconds': self.clock.monotonic(),
+            'Status': "Executing",
+        }
+        self.pipeline_executions[token or execution['PipelineExecutionArn']] = execution
+        logger.info("Pipeline execution %s started, parameters %s", execution['PipelineExecutionArn'], execution['Parameters'])
+        if self.on_pipeline_execution is not None:
+            self.on_pipeline_execution(execution)
+        return {'PipelineExecutionArn': execution['PipelineExecutionArn']}
+
+    def _list_pipeline_executions(self, request):
+        executions = [execution for execution in self.pipeline_executions.values() if execution['PipelineName'] == request['PipelineName']]
+        executions.sort(key=lambda execution: execution['StartSeconds'], reverse=request.get('SortOrder', "Descending") == "Descending")
+        return {'PipelineExecutionSummaries': [{
+            'PipelineExecutionArn': execution['PipelineExecutionArn'],
+            'StartTime': self._datetime(execution['StartSeconds']),
+            'PipelineExecutionStatus': execution['Status'],
+            'PipelineExecutionDisplayName': execution['PipelineExecutionDisplayName'],
+        } for execution in executions[:request.get('MaxResults', 50)]]}
+
+    def finish_pipeline_execution(self, execution, status="Succeeded"):
+        execution['Status'] = status
+        logger.info("Pipeline execution %s %s", execution['PipelineExecutionArn'], status)
@@ -0,0 +1,59 @@
+"""Runs simulator scenarios and checks the loop ends where it must, exiting non zero if any scenario fails.
+
+Useage:
+    python simulator/scenarios.py
+    python simulator/scenarios.py --scenarios burst_drains
+
+Each scenario is a simulate.py run, in its own process so the handler and the scripts start from fresh modules, with
+the checks its report must pass.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+SIMULATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger("simulator")
+
+
+def drop_bucket_drained(report):
+    """Every image dropped was picked up by a pipeline execution, none is left waiting in the drop bucket."""
+    return report['images'].get('waiting_in_drop_bucket', 0) == 0
+
+
+SCENARIOS = {
+    #a burst fills a batch early, the trailing drops go out in a second batch within the same 10 minutes
+    "burst_drains": (["--duration", "900", "--drop-rate", "1", "--burst", "60:150", "--drain", "7200"], [drop_bucket_drained]),
+    #small batches, several of them in every 10 minutes
+    "small_batches_drain": (["--duration", "1500", "--drop-rate", "3", "--trigger-batch-size", "20", "--drain", "7200"], [drop_bucket_drained]),
+}
+
+
+def run_scenario(name):
+    sys.path.insert(0, SIMULATOR_DIR)
+    from simulate import Simulation, make_parser
+    return Simulation(make_parser().parse_args(SCENARIOS[name][0])).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", type=str, default=",".join(SCENARIOS), help="Comma separated scenarios to run, from: {}".format(", ".join(SCENARIOS)))
+    options = parser.parse_args()
+
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    failed = []
+    for name in options.scenarios.split(","):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            report = executor.submit(run_scenario, name).result()
+        failed_checks = [check.__name__ for check in SCENARIOS[name][1] if not check(report)]
+        logger.info("%s: %s, images %s, pipeline executions %s, duplicate start requests %s", name, "FAILED " + ", ".join(failed_checks) if failed_checks else "passed",
+                    json.dumps(report['images']), report['pipeline']['executions'], report['pipeline']['duplicate_start_requests'])
+        if failed_checks:
+            failed.append(name)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,553 @@
+"""Runs the drop -> feature engineering -> chain job -> Lambda loop offline, on a simulated clock, and reports how it behaved.
+
+Useage:
+    python simulator/simulate.py --duration 14400 --drop-rate 2 --burst 3600:500 --output simulator/results/run.json
+
+Synthetic frames are dropped at --drop-rate a minute, plus any --burst, and each drop's S3 notification goes through
+the SQS batching of the trigger Lambda, LocalEventQueue, to index.handler. The pipeline executions it starts run
+1_feature_engineering.py, once per ProcessingInstanceCount shard, then 2_groundtruth_chain_job.py, both in this
+process with their own arguments, and the labeling jobs those create are worked by a simulated workforce, their state
+changes invoking the handler again as EventBridge would. moto stands in for S3, SNS, SQS and DynamoDB, and
+sagemaker_stand_in.py for SageMaker. Every second is simulated: the scripts and the handler see the simulated time
+through datetime.now(), and the time each script takes to run, on this machine, is added to its step.
+"""
+import argparse
+import collections
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import runpy
+import sys
+import time
+from urllib.parse import quote_plus
+
+import boto3
+import numpy as np
+
+from clock import SimClock, simulated_datetime
+from sagemaker_stand_in import TERMINAL_JOB_STATUSES, SageMakerStandIn, Workforce
+
+SIMULATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SIMULATOR_DIR)
+SCRIPTS_DIR = os.path.join(REPO_DIR, "smpipelines", "src", "python")
+LAMBDA_DIR = os.path.join(REPO_DIR, "lambda", "src", "python", "trigger_sagemaker_pipeline")
+BENCHMARKS_DIR = os.path.join(REPO_DIR, "benchmarks")
+FEATURE_ENGINEERING_SCRIPT = os.path.join(SCRIPTS_DIR, "1_feature_engineering.py")
+CHAIN_JOB_SCRIPT = os.path.join(SCRIPTS_DIR, "2_groundtruth_chain_job.py")
+INSTRUCTION_TEMPLATE = os.path.join(REPO_DIR, "public", "instruction-template.template")
+
+sys.path.extend([LAMBDA_DIR, BENCHMARKS_DIR])
+from corpus import make_froth_frame
+
+#the simulator's own progress, the root logger the scripts, the handler and the stand-in log to goes to --script-log
+logger = logging.getLogger("simulator")
+
+ACCOUNT = "000000000000"
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp")
+#where feature engineering moves the images its quality gate rejects or its schedule leaves out, as
+#<prefix><reason>/<key>, the default of --quarantine-prefix
+QUARANTINE_PREFIX = "quarantine/"
+SAMPLED_OUT = "sampled"
+JOB_STATE_CHANGE = "SageMaker Ground Truth Labeling Job State Change"
+#retries Lambda makes of an asynchronous invocation that fails, such as an EventBridge event
+ASYNC_RETRY_ATTEMPTS = 2
+
+
+def drop_schedule(duration_seconds, drops_per_minute, bursts, seed=0):
+    """
+    The seconds images are dropped at, a Poisson process of drops_per_minute plus the bursts.
+    :param bursts: list of (second, count) tuples, count images dropped at once.
+    :return: sorted list of seconds.
+    """
+    rng = np.random.default_rng(seed)
+    seconds = []
+    if drops_per_minute > 0:
+        arrival = rng.exponential(60.0 / drops_per_minute)
+        while arrival < duration_seconds:
+            seconds.append(arrival)
+            arrival += rng.exponential(60.0 / drops_per_minute)
+    for second, count in bursts:
+        seconds.extend([float(second)] * count)
+    return sorted(seconds)
+
+
+def parse_burst(value):
+    second, _, count = value.partition(":")
+    return int(second), int(count)
+
+
+def parse_frame_size(value):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height)
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+    return {'count': len(values), 'p50': round(float(np.percentile(values, 50)), 1), 'p90': round(float(np.percentile(values, 90)), 1),
+            'p99': round(float(np.percentile(values, 99)), 1), 'max': round(float(max(values)), 1)}
+
+
+def image_stem(key):
+    """Drop images keep their name through feature engineering, only the extension may change, eg to .webp."""
+    return os.path.splitext(key)[0]
+
+
+class Simulation(object):
+    """Useage:
+        simulation = Simulation(options)
+        report = simulation.run()
+
+    Sets up the project's buckets, topic, queue and job state table in moto, then plays the drops through the loop.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.prefix = options.project_prefix
+        self.region = options.region
+        self.buckets = {name: "{}-{}".format(self.prefix, name) for name in ["drop", "input", "output", "instructions"]}
+        self.topic_arn = None
+        self.feed_queue_url = None
+        self.job_state_table = None if options.no_job_state_table else "{}-labeling-job-state".format(self.prefix)
+        self.clock = SimClock(datetime.datetime(2021, 6, 1))
+        self.rng = np.random.default_rng(options.seed)
+        self.frame_size = parse_frame_size(options.frame_size)
+        #simulated second each drop image was dropped at, and first became a labeling task at, by image stem
+        self.dropped = {}
+        self.available = {}
+        self.tasks = 0
+        self.fed_keys = set()
+        self.feeds = collections.Counter()
+        self.invocations = collections.Counter()
+        self.handler_errors = 0
+        self.handler_seconds = []
+        self.steps = collections.defaultdict(list)
+        self.failed_steps = []
+        self.event_queue = None
+        self.sagemaker = None
+        self.s3_client = None
+        self.index = None
+        self.script_output = None
+
+    #set up
+
+    def create_resources(self):
+        self.s3_client = boto3.client("s3", region_name=self.region)
+        for bucket in self.buckets.values():
+            self.s3_client.create_bucket(Bucket=bucket)
+        self.s3_client.upload_file(INSTRUCTION_TEMPLATE, self.buckets['instructions'], "instruction-template.template")
+
+        sns_client = boto3.client("sns", region_name=self.region)
+        self.topic_arn = sns_client.create_topic(Name="{}-streaming-labeling".format(self.prefix))['TopicArn']
+        if self.options.feed_mode == "sns-publish":
+            #what the feature engineering step publishes is collected here and fed to the subscribed labeling jobs
+            sqs_client = boto3.client("sqs", region_name=self.region)
+            self.feed_queue_url = sqs_client.create_queue(QueueName="{}-streaming-labeling".format(self.prefix))['QueueUrl']
+            queue_arn = sqs_client.get_queue_attributes(QueueUrl=self.feed_queue_url, AttributeNames=["QueueArn"])['Attributes']['QueueArn']
+            sns_client.subscribe(TopicArn=self.topic_arn, Protocol="sqs", Endpoint=queue_arn, Attributes={'RawMessageDelivery': "true"})
+
+        if self.job_state_table:
+            boto3.client("dynamodb", region_name=self.region).create_table(
+                TableName=self.job_state_table, BillingMode="PAY_PER_REQUEST",
+                AttributeDefinitions=[{'AttributeName': "LabelingJobArn", 'AttributeType': "S"}],
+                KeySchema=[{'AttributeName': "LabelingJobArn", 'KeyType': "HASH"}])
+
+    def load_handler(self):
+        """Imports index as the Lambda runtime would, with the function's environment, once SageMaker is stood in for."""
+        os.environ['PROJECT_PREFIX'] = self.prefix
+        os.environ['IMAGES_PER_PROCESSING_INSTANCE'] = str(self.options.images_per_processing_instance)
+        os.environ['MAX_PROCESSING_INSTANCES'] = str(self.options.max_processing_instances)
+        os.environ['DROP_BUCKET'] = self.buckets['drop']
+        if self.job_state_table:
+            os.environ['JOB_STATE_TABLE'] = self.job_state_table
+        else:
+            os.environ.pop('JOB_STATE_TABLE', None)
+        import index
+        self.index = index
+        self.event_queue = LocalEventQueueOnClock(self.invoke_handler, self.clock, batch_size=self.options.trigger_batch_size,
+                                                  max_wait_seconds=self.options.trigger_max_wait_seconds, visibility_timeout=self.options.trigger_visibility_timeout)
+
+    @contextlib.contextmanager
+    def script_logging(self):
+        """
+        The scripts add their own handler to the root logger each time they run, so it is the only one while they run,
+        and it and what they print go to the script log. The root logger's handlers are put back afterwards.
+        """
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+        root.handlers = []
+        try:
+            with contextlib.redirect_stdout(self.script_output), contextlib.redirect_stderr(self.script_output):
+                yield
+        finally:
+            root.handlers = handlers
+            root.setLevel(level)
+
+    #drops and the trigger Lambda
+
+    def drop(self, index):
+        camera = index % self.options.cameras
+        key = "CAM{:02d} {:%Y-%m-%dT%H%M%S}-{:06d}.jpg".format(camera, self.clock.now(), index)
+        buffer = io.BytesIO()
+        make_froth_frame(self.rng, self.frame_size).save(buffer, "JPEG")
+        self.s3_client.put_object(Bucket=self.buckets['drop'], Key=key, Body=buffer.getvalue())
+        self.dropped[image_stem(key)] = self.clock.monotonic()
+        self.event_queue.send(json.dumps({'Records': [{
+            'eventSource': "aws:s3",
+            'eventName': "ObjectCreated:Put",
+            'eventTime': self.clock.now().isoformat() + "Z",
+            's3': {'bucket': {'name': self.buckets['drop']}, 'object': {'key': quote_plus(key), 'size': len(buffer.getvalue())}},
+        }]}))
+
+    def invoke_handler(self, event, context, attempt=0):
+        self.invocations['job_state_change' if 'detail-type' in event else 'sqs_batch'] += 1
+        started = time.perf_counter()
+        try:
+            return self.index.handler(event, context)
+        except Exception as e:
+            self.handler_errors += 1
+            logger.warning("Handler failed on %s: %s", event.get('detail-type', "SQS batch"), e)
+            if 'detail-type' in event and attempt < ASYNC_RETRY_ATTEMPTS:
+                #Lambda retries an asynchronous invocation twice, a minute and then two minutes later
+                self.invocations['async_retries'] += 1
+                self.clock.after(60 * (attempt + 1), self.invoke_handler, event, context, attempt + 1)
+            #the SQS event source would redeliver a failed batch, the simulation does not replay it
+        finally:
+            self.handler_seconds.append(time.perf_counter() - started)
+
+    def job_state_changed(self, job):
+        event = {
+            'version': "0",
+            'detail-type': JOB_STATE_CHANGE,
+            'source': "aws.sagemaker",
+            'account': ACCOUNT,
+            'time': self.clock.now().isoformat() + "Z",
+            'region': self.region,
+            'resources': [job.arn],
+            'detail': {'LabelingJobStatus': job.status, 'LabelCounters': dict(job.counters)},
+        }
+        self.clock.after(self.options.event_delay_seconds, self.invoke_handler, event, None)
+
+    def task_available(self, source_ref, seconds, job_name):
+        self.tasks += 1
+        stem = image_stem(source_ref.split("/", 3)[-1])
+        if stem in self.dropped and stem not in self.available:
+            self.available[stem] = seconds
+
+    #the pipeline
+
+    def pipeline_started(self, execution):
+        self.clock.after(self.options.processing_startup_seconds, self.run_feature_engineering, execution)
+
+    def run_script(self, step, script, arguments):
+        """
+        Runs a step script as its processing job would, with its arguments, in this process.
+        :return: wall seconds it took.
+        """
+        argv, path = sys.argv, list(sys.path)
+        sys.argv = [script] + arguments
+        started = time.perf_counter()
+        try:
+            with self.script_logging():
+                runpy.run_path(script, run_name="__main__")
+        except (Exception, SystemExit) as e:
+            self.failed_steps.append({'step': step, 'second': round(self.clock.monotonic(), 1), 'error': "{}: {}".format(type(e).__name__, e)})
+            logger.warning("%s failed at %.0fs: %s: %s", step, self.clock.monotonic(), type(e).__name__, e)
+        finally:
+            sys.argv, sys.path[:] = argv, path
+        seconds = time.perf_counter() - started
+        self.steps[step].append(seconds)
+        return seconds
+
+    def run_feature_engineering(self, execution):
+        parameters = execution['Parameters']
+        shard_count = int(parameters.get('ProcessingInstanceCount', 1))
+        arguments = [
+            "--project-prefix", self.prefix,
+            "--s3bucketname-drop", self.buckets['drop'],
+            "--s3bucketname-groundtruth-job-input", self.buckets['input'],
+            "--feed-mode", self.options.feed_mode,
+            "--sns-topic-arn-streaming-labeling", self.topic_arn,
+            "--pending-backlog-size", parameters.get('PendingBacklogSize', "0"),
+            "--quality-gate", self.options.quality_gate,
+            "--schedule", self.options.schedule,
+            "--processing-workers", str(self.options.processing_workers),
+            "--metrics-format", "off",
+            "--shard-count", str(shard_count),
+        ]
+        #the shards run one after the other here, on their own instances in the pipeline, the step takes the longest
+        seconds = max(self.run_script("feature_engineering", FEATURE_ENGINEERING_SCRIPT, arguments + ["--shard-index", str(shard)])
+                      for shard in range(shard_count))
+        self.clock.after(seconds, self.feature_engineering_done, execution)
+
+    def feature_engineering_done(self, execution):
+        self.feed_new_images()
+        self.clock.after(self.options.processing_startup_seconds, self.run_chain_job, execution)
+
+    def feed_new_images(self):
+        """Feeds the streaming labeling topic with what feature engineering sent it, or the input bucket notified it of."""
+        if self.feed_queue_url:
+            sqs_client = boto3.client("sqs", region_name=self.region)
+            while True:
+                messages = sqs_client.receive_message(QueueUrl=self.feed_queue_url, MaxNumberOfMessages=10).get('Messages', [])
+                if not messages:
+                    break
+                for message in messages:
+                    self.feed(json.loads(message['Body'])['source-ref'])
+                sqs_client.delete_message_batch(QueueUrl=self.feed_queue_url, Entries=[
+                    {'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']} for index, message in enumerate(messages)])
+            return
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.buckets['input']):
+            for obj in page.get('Contents', []):
+                if obj['Key'].lower().endswith(IMAGE_SUFFIXES) and obj['Key'] not in self.fed_keys:
+                    self.fed_keys.add(obj['Key'])
+                    self.feed("s3://{}/{}".format(self.buckets['input'], obj['Key']))
+
+    def feed(self, source_ref):
+        received = self.sagemaker.feed(source_ref)
+        self.feeds['received' if received else 'no_active_job'] += 1
+        if len(received) > 1:
+            self.feeds['received_by_several_jobs'] += 1
+
+    def run_chain_job(self, execution):
+        arguments = [
+            "--project-friendly-name", self.prefix,
+            "--project-prefix", self.prefix,
+            "--region", self.region,
+            "--s3bucketname-groundtruth-labelinginstructions", self.buckets['instructions'],
+            "--s3bucketname-groundtruth-job-input", self.buckets['input'],
+            "--s3bucketname-groundtruth-job-output", self.buckets['output'],
+            "--urlwebsite-labelinginstructions", "https://{}.s3-website-{}.amazonaws.com".format(self.buckets['instructions'], self.region),
+            "--sns-topic-arn-streaming-labeling", self.topic_arn,
+            "--groundtruth-execution-role-arn", "arn:aws:iam::{}:role/{}-groundtruth".format(ACCOUNT, self.prefix),
+            "--groundtruth-private-workforce-arn", "arn:aws:sagemaker:{}:{}:workteam/private-crowd/{}".format(self.region, ACCOUNT, self.prefix),
+            "--task-policy", self.options.task_policy,
+            "--schedule", self.options.schedule,
+            "--compact-chain-manifest", self.options.compact_chain_manifest,
+            "--metrics-format", "off",
+        ]
+        if self.job_state_table:
+            arguments += ["--job-state-table", self.job_state_table]
+        self.run_script("chain_job", CHAIN_JOB_SCRIPT, arguments)
+        self.sagemaker.finish_pipeline_execution(execution)
+
+    #running and reporting
+
+    def run(self):
+        options = self.options
+        from moto import mock_aws
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "simulator")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "simulator")
+        os.environ['AWS_DEFAULT_REGION'] = self.region
+        started = time.perf_counter()
+        with open(options.script_log or os.devnull, "w") as self.script_output, mock_aws(), simulated_datetime(self.clock):
+            root = logging.getLogger()
+            root.handlers = [logging.StreamHandler(self.script_output)]
+            root.setLevel(logging.INFO)
+            self.create_resources()
+            self.sagemaker = SageMakerStandIn(
+                self.clock, self.s3_client, Workforce(options.labels_per_hour, options.failure_rate, options.workforce_tick_seconds),
+                region=self.region, job_startup_seconds=options.labeling_job_startup_seconds, idle_seconds=options.job_idle_seconds,
+                stop_after_seconds=options.stop_jobs_after_seconds, seed=options.seed, on_pipeline_execution=self.pipeline_started,
+                on_job_state_change=self.job_state_changed, on_task_available=self.task_available)
+            with self.sagemaker.installed():
+                self.load_handler()
+                bursts = [parse_burst(burst) for burst in options.burst]
+                for index, second in enumerate(drop_schedule(options.duration, options.drop_rate, bursts, options.seed)):
+                    self.clock.at(second, self.drop, index)
+                end_seconds = options.duration + options.drain
+                hour = 0
+                while self.clock.seconds < end_seconds:
+                    hour += 1
+                    self.clock.run_until(min(hour * 3600, end_seconds))
+                    logger.info("%.0fh simulated: %s dropped, %s labeling tasks, %s jobs", self.clock.seconds / 3600.0,
+                                len(self.dropped), len(self.available), len(self.sagemaker.jobs))
+                report = self.report()
+        #after the with, datetime is the wall clock again
+        report['created'] = datetime.datetime.utcnow().isoformat() + "Z"
+        report['wall_seconds'] = round(time.perf_counter() - started, 1)
+        return report
+
+    def report(self):
+        drop_stems = set()
+        # stem -> reason, of the images moved under the quarantine prefix
+        quarantined = {}
+        for key in self.list_keys(self.buckets['drop']):
+            if key.startswith(QUARANTINE_PREFIX):
+                reason, _, image_key = key[len(QUARANTINE_PREFIX):].partition("/")
+                quarantined[image_stem(image_key)] = reason
+            else:
+                drop_stems.add(image_stem(key))
+        input_stems = set(image_stem(key) for key in self.list_keys(self.buckets['input']) if key.lower().endswith(IMAGE_SUFFIXES))
+        outcomes = collections.Counter()
+        for stem in self.dropped:
+            if stem in self.available:
+                outcomes['labeling_task'] += 1
+            elif stem in input_stems:
+                #in the input bucket, yet no job ever made a task of it
+                outcomes['stranded_in_input_bucket'] += 1
+            elif quarantined.get(stem) == SAMPLED_OUT:
+                outcomes['sampled_out'] += 1
+            elif stem in quarantined:
+                outcomes['quarantined'] += 1
+            elif stem in drop_stems:
+                outcomes['waiting_in_drop_bucket'] += 1
+            else:
+                #deleted from the drop bucket without reaching the input bucket, as a duplicate
+                outcomes['deleted_as_duplicate'] += 1
+
+        jobs = list(self.sagemaker.jobs.values())
+        return {
+            'python': platform.python_version(),
+            'options': vars(self.options),
+            'simulated_seconds': self.clock.seconds,
+            'images': dict(dropped=len(self.dropped), **outcomes),
+            'drop_to_task_seconds': percentiles([self.available[stem] - self.dropped[stem] for stem in self.available]),
+            'labeling_tasks': self.tasks,
+            'streaming_feed': dict(self.feeds),
+            'lambda': {
+                'invocations': dict(self.invocations),
+                'errors': self.handler_errors,
+                'sqs_batches': self.event_queue.batches_delivered,
+                'sqs_messages_redelivered': self.event_queue.messages_redelivered,
+                'wall_ms_p50': round(float(np.percentile(self.handler_seconds, 50)) * 1000, 2) if self.handler_seconds else None,
+            },
+            'pipeline': {
+                'executions': len(self.sagemaker.pipeline_executions),
+                'duplicate_start_requests': self.sagemaker.duplicate_pipeline_requests,
+                'failed_steps': self.failed_steps,
+                'step_wall_seconds': {step: percentiles(seconds) for step, seconds in self.steps.items()},
+            },
+            'labeling_jobs': {
+                'created': len(jobs),
+                'new': len([job for job in jobs if "-chained-from-" not in job.name]),
+                'chained': len([job for job in jobs if "-chained-from-" in job.name]),
+                'max_active_at_once': self.sagemaker.max_active_jobs,
+                'still_active': len([job for job in jobs if job.status not in TERMINAL_JOB_STATUSES]),
+                'jobs': [{
+                    'name': job.name,
+                    'status': job.status,
+                    'created_second': round(job.created_seconds, 1),
+                    'in_progress_second': None if job.in_progress_seconds is None else round(job.in_progress_seconds, 1),
+                    'ended_second': None if job.ended_seconds is None else round(job.ended_seconds, 1),
+                    'items': job.items_received,
+                    'label_counters': dict(job.counters),
+                    'task_settings': {key: job.task_config[key] for key in ["MaxConcurrentTaskCount", "TaskTimeLimitInSeconds", "TaskAvailabilityLifetimeInSeconds"]},
+                    'failure_reason': job.failure_reason,
+                } for job in jobs],
+            },
+            'sagemaker_calls': dict(self.sagemaker.calls),
+        }
+
+    def list_keys(self, bucket):
+        keys = []
+        for page in self.s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+
+class LocalEventQueueOnClock(object):
+    """
+    The trigger Lambda's SQS batching, LocalEventQueue, on the simulated clock - a batch that isn't filled is delivered
+    once its oldest message has waited max_wait_seconds, as the event source's batching window does, and messages the
+    handler hands back are delivered again once their visibility timeout is up.
+    """
+
+    def __init__(self, handler, clock, batch_size, max_wait_seconds, visibility_timeout):
+        from trigger_coalescer import LocalEventQueue
+        self.queue = LocalEventQueue(handler, batch_size=batch_size, max_wait_seconds=max_wait_seconds, visibility_timeout=visibility_timeout,
+                                     clock=clock.monotonic)
+        self.clock = clock
+        self.scheduled_seconds = None
+
+    @property
+    def batches_delivered(self):
+        return self.queue.batches_delivered
+
+    @property
+    def messages_redelivered(self):
+        return self.queue.messages_redelivered
+
+    def deadline(self):
+        return self.queue.first_message_time + self.queue.max_wait_seconds
+
+    def send(self, message_body):
+        self.queue.send(message_body)
+        self.schedule()
+
+    def poll(self):
+        self.queue.poll()
+        #delivered at the deadline itself, now - first_message_time may round to just under max_wait_seconds
+        if self.queue.messages and self.clock.monotonic() >= self.deadline():
+            self.queue.flush()
+        self.schedule()
+
+    def schedule(self):
+        due = [self.deadline()] if self.queue.messages else []
+        if self.queue.hidden:
+            due.append(self.queue.next_visible_time())
+        if due and min(due) != self.scheduled_seconds:
+            self.scheduled_seconds = min(due)
+            self.clock.at(self.scheduled_seconds, self.poll)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=int, default=4 * 3600, help="Simulated seconds images are dropped for")
+    parser.add_argument("--drain", type=int, default=2 * 3600, help="Simulated seconds to keep running after the last drop")
+    parser.add_argument("--drop-rate", type=float, default=1.0, help="Images dropped a minute, on average")
+    parser.add_argument("--burst", type=str, action="append", default=[], help="SECOND:COUNT, COUNT images dropped at once at SECOND, may be repeated")
+    parser.add_argument("--cameras", type=int, default=4)
+    parser.add_argument("--frame-size", type=str, default="1024x768")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--project-prefix", type=str, default="sim")
+    parser.add_argument("--region", type=str, default="us-east-1", help="Region of the project, one the chain job has Ground Truth ARNs for")
+    parser.add_argument("--trigger-batch-size", type=int, default=100, help="TriggerBatchSize of the stack")
+    parser.add_argument("--trigger-max-wait-seconds", type=int, default=120, help="TriggerMaxWaitSeconds of the stack")
+    parser.add_argument("--trigger-visibility-timeout", type=int, default=360, help="VisibilityTimeout of the drop event queue, how long a batch handed back waits to be delivered again")
+    parser.add_argument("--images-per-processing-instance", type=int, default=2000, help="ImagesPerProcessingInstance of the stack")
+    parser.add_argument("--max-processing-instances", type=int, default=4, help="MaxProcessingInstances of the stack")
+    parser.add_argument("--feed-mode", type=str, choices=["s3-notification", "sns-publish"], default="s3-notification", help="StreamingFeedMode of the pipeline")
+    parser.add_argument("--quality-gate", type=str, default="off", help="QualityGate of the pipeline, off by default as in the pipeline")
+    parser.add_argument("--task-policy", type=str, choices=["adaptive", "fixed"], default="adaptive")
+    parser.add_argument("--schedule", type=str, default="off", help="WorkSchedule of the pipeline, the order and sampling of the images fed for labeling")
+    parser.add_argument("--compact-chain-manifest", type=str, choices=["on", "off"], default="off", help="CompactChainManifest of the pipeline, off by default as in the pipeline")
+    parser.add_argument("--no-job-state-table", action="store_true", help="Run without the DynamoDB job state index, listing labeling jobs instead")
+    parser.add_argument("--processing-workers", type=int, default=0, help="Crop/encode worker processes of the feature engineering step, 0 crops inline")
+    parser.add_argument("--processing-startup-seconds", type=int, default=120, help="Simulated seconds a processing job takes to start, before its script runs")
+    parser.add_argument("--labeling-job-startup-seconds", type=int, default=180, help="Simulated seconds a labeling job is Initializing")
+    parser.add_argument("--event-delay-seconds", type=int, default=5, help="Simulated seconds from a job state change to its EventBridge event")
+    parser.add_argument("--labels-per-hour", type=float, default=120, help="Tasks the workforce completes an hour")
+    parser.add_argument("--failure-rate", type=float, default=0.02, help="Fraction of the tasks taken that fail")
+    parser.add_argument("--workforce-tick-seconds", type=int, default=60)
+    parser.add_argument("--stop-jobs-after-seconds", type=int, default=0, help="Stop each labeling job this long after it starts, as an operator or the job's expiry would, 0 never")
+    parser.add_argument("--job-idle-seconds", type=int, default=864000, help="A streaming job Completes once nothing has arrived for this long, 10 days on Ground Truth")
+    parser.add_argument("--script-log", type=str, help="File to write the logs of the scripts and the handler to, discarded by default")
+    parser.add_argument("--output", type=str, help="File to write the JSON report to, stdout by default")
+    return parser
+
+
+if __name__ == "__main__":
+    options = make_parser().parse_args()
+
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    report = Simulation(options).run()
+    latency = report['drop_to_task_seconds']
+    logger.info("%s images dropped, %s became labeling tasks, drop to task p50 %ss p99 %ss, %s pipeline executions, %s labeling jobs (%s chained), %s wall seconds",
+                report['images']['dropped'], latency['count'], latency['p50'], latency['p99'], report['pipeline']['executions'],
+                report['labeling_jobs']['created'], report['labeling_jobs']['chained'], report['wall_seconds'])
+
+    output = json.dumps(report, indent=2, default=str)
+    if options.output:
+        os.makedirs(os.path.dirname(os.path.abspath(options.output)), exist_ok=True)
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
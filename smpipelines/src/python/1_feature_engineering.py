@@ -1,19 +1,22 @@
 """Feature engineering for froth-anomaly-detection dataset."""
-import subprocess
+import time
+script_started = time.perf_counter()
+
 import sys
+import os
+
+#modules shared by the step scripts, the pipeline provides them at /opt/ml/processing/input/lib
+sys.path.extend([os.path.dirname(os.path.abspath(__file__)), "/opt/ml/processing/input/lib"])
+from step_startup import check_dependencies, log_startup
+check_dependencies(__file__)
 
 import argparse
 import logging
-import pathlib
-
-def install(package):
-    subprocess.call([sys.executable, "-m", "pip", "install", package])
-install('sagemaker')
 
 import boto3
 import boto3.session
-
-import time
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 import numpy as np
 from PIL import Image, ImageOps
@@ -21,9 +24,24 @@ from PIL import ImageFile
 
 # from IPython.display import display # to display images
 from io import BytesIO
-import os
 
 import errno
+import functools
+import glob
+import hashlib
+import json
+import queue
+import resource
+import shutil
+import subprocess
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from memory_budget import MEGABYTE, MemoryBudget
+from quality_gate import QUARANTINE_PREFIX, FrameQuality, QualityGate, is_truncated, load_quality_thresholds, measure_frames
+from stage_metrics import OUTPUT_FORMATS, StageMetrics
+from work_scheduler import SAMPLED_OUT, WorkScheduler, get_camera_name, load_schedule_policy
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -31,6 +49,17 @@ logger.addHandler(logging.StreamHandler())
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+#only collected until the script configures how metrics are written
+metrics = StageMetrics(output_format="off")
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg"]
+
+#image modes that survive a round trip through a NumPy array unchanged
+ARRAY_IMAGE_MODES = ["L", "RGB", "RGBA"]
+
+#marks the end of a stream of items passed between pipeline stages
+_END_OF_STREAM = object()
+
 class S3ImagesInvalidExtension(Exception):
     pass
 
@@ -41,35 +70,633 @@ class S3Images(object):
     """Useage:
         images = S3Images(boto_session=my_session)
         im = images.from_s3('my-example-bucket-9933668', 'pythonlogo.png')
-        im
         images.to_s3(im, 'my-example-bucket-9933668', 'pythonlogo2.png')
+        im.close()
+
+        Pass transfer=S3TransferPool(...) to send the GETs and PUTs through the shared transfer pool, and
+        encoding=ImageEncoding(...) to pick the encoding profile and output format.
     """
     
-    def __init__(self, boto_session):
+    def __init__(self, boto_session, transfer=None, encoding=None):
         self.s3 = boto_session.client('s3')
+        self.transfer = transfer
+        self.encoding = encoding or DEFAULT_IMAGE_ENCODING
         
 
     def from_s3(self, bucket, key):
-        file_byte_string = self.s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        """The image at key, for the caller to close() once done with, which frees its pixels."""
+        if self.transfer is not None:
+            file_byte_string = self.transfer.get(bucket, key)
+        else:
+            file_byte_string = self.s3.get_object(Bucket=bucket, Key=key)['Body'].read()
         return Image.open(BytesIO(file_byte_string))
     
 
     def to_s3(self, img, bucket, key):
-        buffer = BytesIO()
-        img.save(buffer, self.__get_safe_ext(key))
-        buffer.seek(0)
+        """Encodes and uploads img, to key with the extension of the output format."""
+        output_key = self.encoding.output_key(key)
+        self.put(self.encode(img, output_key), bucket, output_key)
+        return output_key
+
+    def encode(self, img, key):
+        return encode_image(img, key, self.encoding.profile)
+
+    def put(self, buffer, bucket, key):
+        if self.transfer is not None:
+            self.transfer.put(bucket, key, buffer)
+            return
         sent_data = self.s3.put_object(Bucket=bucket, Key=key, Body=buffer)
         if sent_data['ResponseMetadata']['HTTPStatusCode'] != 200:
             raise S3ImagesUploadFailed('Failed to upload image {} to bucket {}'.format(key, bucket))
-        
-    def __get_safe_ext(self, key):
-        ext = os.path.splitext(key)[-1].strip('.').upper()
-        if ext in ['JPG', 'JPEG']:
-            return 'JPEG' 
-        elif ext in ['PNG']:
-            return 'PNG' 
+
+
+def get_safe_ext(key):
+    ext = os.path.splitext(key)[-1].strip('.').upper()
+    if ext in ['JPG', 'JPEG']:
+        return 'JPEG' 
+    elif ext in ['PNG']:
+        return 'PNG' 
+    elif ext in ['WEBP']:
+        return 'WEBP'
+    else:
+        raise S3ImagesInvalidExtension('Extension is invalid')
+
+
+#PIL save options per format. default is PIL's own defaults, left to PIL as they differ by mode (JPEG subsampling
+#only applies to colour images), fast trades size for encode time, small the reverse
+ENCODING_PROFILES = {
+    "default": {
+        "JPEG": {},
+        "PNG": {},
+        "WEBP": {},
+    },
+    "fast": {
+        "JPEG": {},
+        "PNG": {"compress_level": 1},
+        "WEBP": {"method": 0},
+    },
+    "small": {
+        "JPEG": {"optimize": True, "progressive": True},
+        "PNG": {"compress_level": 9, "optimize": True},
+        "WEBP": {"method": 6},
+    },
+}
+
+#source keeps the format of each drop image, webp needs a labeling UI that accepts WebP
+IMAGE_OUTPUT_FORMATS = ["source", "webp"]
+
+
+def load_encoding_profile(encoding_profile):
+    """
+    Looks up a profile by name, or parses JSON save options per format, eg '{"PNG": {"compress_level": 3}}', over
+    the default profile.
+    :return: dict of PIL format to save options.
+    """
+    if encoding_profile is None or encoding_profile in ENCODING_PROFILES:
+        return ENCODING_PROFILES[encoding_profile or "default"]
+    profile = {image_format: dict(options) for image_format, options in ENCODING_PROFILES["default"].items()}
+    for image_format, options in json.loads(encoding_profile).items():
+        profile.setdefault(image_format.upper(), {}).update(options)
+    return profile
+
+
+class ImageEncoding(namedtuple('ImageEncoding', ['profile', 'output_format', 'lossless_crop'])):
+    """
+    How crops are encoded for the GroundTruth input bucket - the save options per format, the output format, and
+    whether crops are copied without re-encoding where that is possible, see lossless_crop.
+    """
+
+    def output_key(self, key):
+        """The key of the encoded crop of the drop image key."""
+        if self.output_format == "webp":
+            return os.path.splitext(key)[0] + ".webp"
+        return key
+
+
+DEFAULT_IMAGE_ENCODING = ImageEncoding(profile=ENCODING_PROFILES["default"], output_format="source", lossless_crop=False)
+
+
+def encode_image(img, key, profile=None):
+    """
+    Encodes the image in the format matching the extension of key.
+    :param profile: save options per format, see ENCODING_PROFILES, the default profile if not given.
+    :return: buffer holding the encoded image, rewound ready for upload.
+    """
+    image_format = get_safe_ext(key)
+    buffer = BytesIO()
+    img.save(buffer, image_format, **(profile or ENCODING_PROFILES["default"]).get(image_format, {}))
+    buffer.seek(0)
+    return buffer
+
+
+def jpeg_mcu_size(image):
+    """The (width, height) of the MCUs of a JPEG, 8 pixels times its largest horizontal and vertical sampling factors."""
+    return (8 * max(h for _, h, _, _ in image.layer), 8 * max(v for _, _, v, _ in image.layer))
+
+
+def lossless_crop(image_bytes, image, rectangle, output_format):
+    """
+    Crops an encoded image without decoding and re-encoding it, where that is possible. The crop has to lie wholly
+    inside the frame, Image.crop pads a crop past its edges where jpegtran would trim it, then either:
+    - the crop is the whole frame, already in the output format, so the bytes are used as they are.
+    - the image is a JPEG, output as a JPEG, with the top left of the crop on the MCU grid, and jpegtran on the
+      PATH, which copies the DCT blocks of the crop across untouched. Pixels match a crop of the decoded frame,
+      bar chroma upsampling along the crop's edges, and the frame loses nothing to a second lossy encode.
+    :param image: the image opened from image_bytes, only its header is used.
+    :param rectangle: (left, top, right, bottom) of the crop.
+    :param output_format: PIL format the crop is to be encoded in.
+    :return: the bytes of the cropped image, or None when it needs re-encoding.
+    """
+    if image.format != output_format:
+        return None
+    left_position, top_position, right_position, bottom_position = rectangle
+    # open_for_crop shortens the size of JPEGs to the rows it decodes, the header has the frame's own
+    width, height = Image.open(BytesIO(image_bytes)).size if image.format == "JPEG" else image.size
+    if left_position < 0 or top_position < 0 or right_position > width or bottom_position > height:
+        return None
+    if rectangle == (0, 0, width, height):
+        return image_bytes
+    jpegtran = shutil.which("jpegtran")
+    if image.format != "JPEG" or jpegtran is None:
+        return None
+    mcu_width, mcu_height = jpeg_mcu_size(image)
+    if left_position % mcu_width or top_position % mcu_height:
+        return None
+    crop_spec = "{}x{}+{}+{}".format(right_position - left_position, bottom_position - top_position, left_position, top_position)
+    try:
+        return subprocess.run([jpegtran, "-crop", crop_spec, "-copy", "none", "-optimize"],
+                              input=image_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        logger.debug("jpegtran could not crop, re-encoding instead: %s", e.stderr)
+        return None
+
+
+class S3TransferPool(object):
+    """Useage:
+        transfer = S3TransferPool(boto_session=my_session, max_workers=16)
+        future = transfer.submit(transfer.get, 'my-example-bucket-9933668', 'pythonlogo.png')
+        file_byte_string = future.result()
+        transfer.shutdown()
+
+    Runs S3 GETs, PUTs and deletes on a pool of worker threads. Every worker gets its own client, all built from
+    the one session so they share its credentials, with a tunable connection pool and adaptive retries that back
+    off when S3 throttles. Other AWS calls made from the pool, such as SNS publishes, get per worker clients too.
+    """
+
+    def __init__(self, boto_session, max_workers=16, max_pool_connections=10, max_attempts=10):
+        self.boto_session = boto_session
+        self.config = Config(
+            max_pool_connections=max_pool_connections,
+            retries={'max_attempts': max_attempts, 'mode': 'adaptive'}
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='s3-transfer')
+        self._local = threading.local()
+        # boto3 sessions are not thread safe, only the clients they create are
+        self._client_lock = threading.Lock()
+
+    @property
+    def s3(self):
+        """The S3 client belonging to the calling thread."""
+        return self.client('s3')
+
+    def client(self, service_name):
+        """The client for service_name belonging to the calling thread."""
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+        if service_name not in clients:
+            with self._client_lock:
+                clients[service_name] = self.boto_session.client(service_name, config=self.config)
+        return clients[service_name]
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def get(self, bucket, key):
+        with metrics.timer("get") as timing:
+            data = self.s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+            timing.nbytes = len(data)
+        return data
+
+    def put(self, bucket, key, body):
+        with metrics.timer("put", nbytes=len(body)):
+            sent_data = self.s3.put_object(Bucket=bucket, Key=key, Body=body)
+        if sent_data['ResponseMetadata']['HTTPStatusCode'] != 200:
+            raise S3ImagesUploadFailed('Failed to upload image {} to bucket {}'.format(key, bucket))
+
+    def copy(self, bucket, key, target_key, metadata=None):
+        """Server side copy of an object to target_key in the same bucket, replacing its metadata when given."""
+        kwargs = {'MetadataDirective': 'REPLACE', 'Metadata': metadata} if metadata is not None else {}
+        with metrics.timer("copy"):
+            self.s3.copy_object(Bucket=bucket, Key=target_key, CopySource={'Bucket': bucket, 'Key': key}, **kwargs)
+
+    def delete(self, bucket, key):
+        with metrics.timer("delete"):
+            self.s3.delete_object(Bucket=bucket, Key=key)
+
+    def download_file(self, bucket, key, filename):
+        with metrics.timer("get"):
+            self.s3.download_file(bucket, key, filename)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class S3DeleteBatcher(object):
+    """Useage:
+        deleter = S3DeleteBatcher(transfer, 'my-example-bucket-9933668')
+        deleter.add('pythonlogo.png')
+        failed_keys = deleter.flush()
+
+    Collects keys to delete and removes them with DeleteObjects, up to 1000 keys per request, on the transfer pool.
+    Keys reported back in the Errors of a response, or of a request that fails outright, are retried with backoff,
+    keys still failing after max_attempts are logged, left in the bucket and handed back by flush.
+    """
+
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, transfer, bucket, batch_size=MAX_BATCH_SIZE, max_attempts=5):
+        self.transfer = transfer
+        self.bucket = bucket
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.max_attempts = max_attempts
+        self.deleted_count = 0
+        self._pending = []
+        self._requests = []
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self._pending.append(key)
+            if len(self._pending) >= self.batch_size:
+                self._submit()
+
+    def flush(self):
+        """
+        Deletes any keys still pending and waits for every delete request to finish.
+        :return: list of the keys that could not be deleted.
+        """
+        with self._lock:
+            self._submit()
+            requests, self._requests = self._requests, []
+        failed_keys = []
+        for keys, request in requests:
+            try:
+                failed_keys.extend(request.result())
+            except Exception as e:
+                # every request is waited on, so one failing can't leave the others running
+                logger.warning("Failed to delete %s files from bucket: %s, %s", len(keys), self.bucket, e)
+                failed_keys.extend(keys)
+        return failed_keys
+
+    def _submit(self):
+        if self._pending:
+            self._requests.append((self._pending, self.transfer.submit(self._delete_batch, self._pending)))
+            self._pending = []
+
+    def _delete_batch(self, keys):
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                time.sleep(min(2 ** attempt * 0.1, 5))
+            try:
+                with metrics.timer("delete"):
+                    response = self.transfer.s3.delete_objects(
+                        Bucket=self.bucket,
+                        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+                    )
+            except (BotoCoreError, ClientError) as e:
+                # throttled past the client's own retries, or denied, the whole batch is tried again
+                failed = {key: {'Message': str(e)} for key in keys}
+                continue
+            failed = {error['Key']: error for error in response.get('Errors', [])}
+            with self._lock:
+                self.deleted_count += len(keys) - len(failed)
+            keys = [key for key in keys if key in failed]
+            if not keys:
+                return []
+        for key in keys:
+            logger.warning("Failed to delete file: %s from bucket: %s, %s", key, self.bucket, failed[key].get('Message'))
+        return keys
+
+
+class SNSBatchPublisher(object):
+    """Useage:
+        publisher = SNSBatchPublisher(transfer, sns_topic_arn_streaming_labeling)
+        publisher.publish({"source-ref": "s3://my-example-bucket-9933668/pythonlogo.png"}, on_published=callback)
+        failed_count = publisher.flush()
+
+    Publishes messages to an SNS topic with PublishBatch, 10 messages per request, on the transfer pool. Entries
+    reported back as Failed through no fault of the sender, or of a request that fails outright, are retried with
+    backoff. on_published is called, from a pool thread, once its message is accepted by SNS. max_messages_per_second
+    throttles the feed, 0 is unlimited.
+    """
+
+    MAX_BATCH_SIZE = 10
+
+    def __init__(self, transfer, topic_arn, max_messages_per_second=0, max_attempts=5):
+        self.transfer = transfer
+        self.topic_arn = topic_arn
+        self.max_attempts = max_attempts
+        self.published_count = 0
+        self._interval = 1.0 / max_messages_per_second if max_messages_per_second else 0
+        self._next_send_time = 0
+        self._pending = []
+        self._requests = []
+        self._lock = threading.Lock()
+
+    def publish(self, message, on_published=None):
+        with self._lock:
+            self._pending.append((json.dumps(message), on_published))
+            if len(self._pending) >= self.MAX_BATCH_SIZE:
+                self._submit()
+
+    def flush(self):
+        """
+        Publishes any messages still pending and waits for every publish request to finish.
+        :return: the number of messages that could not be published.
+        """
+        with self._lock:
+            self._submit()
+            requests, self._requests = self._requests, []
+        failed_count = 0
+        for messages, request in requests:
+            try:
+                failed_count += request.result()
+            except Exception as e:
+                # every request is waited on, so one failing can't leave the others running
+                logger.warning("Failed to publish %s messages, %s", len(messages), e)
+                failed_count += len(messages)
+        return failed_count
+
+    def _submit(self):
+        if self._pending:
+            self._requests.append((self._pending, self.transfer.submit(self._publish_batch, self._pending)))
+            self._pending = []
+
+    def _throttle(self, message_count):
+        if not self._interval:
+            return
+        with self._lock:
+            send_time = max(self._next_send_time, time.time())
+            self._next_send_time = send_time + self._interval * message_count
+        time.sleep(max(0, send_time - time.time()))
+
+    def _publish_batch(self, messages):
+        entries = {str(index): message for index, message in enumerate(messages)}
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                time.sleep(min(2 ** attempt * 0.1, 5))
+            self._throttle(len(entries))
+            try:
+                with metrics.timer("publish"):
+                    response = self.transfer.client('sns').publish_batch(
+                        TopicArn=self.topic_arn,
+                        PublishBatchRequestEntries=[{'Id': entry_id, 'Message': message} for entry_id, (message, on_published) in entries.items()]
+                    )
+            except (BotoCoreError, ClientError) as e:
+                # throttled past the client's own retries, or denied, the whole batch is tried again
+                logger.debug("Publish request of %s messages failed, %s", len(entries), e)
+                continue
+            for success in response.get('Successful', []):
+                message, on_published = entries.pop(success['Id'])
+                with self._lock:
+                    self.published_count += 1
+                if on_published is not None:
+                    on_published()
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault'):
+                    logger.warning("Failed to publish message: %s, %s", entries.pop(failure['Id'])[0], failure.get('Message'))
+            if not entries:
+                return 0
+        for message, on_published in entries.values():
+            logger.warning("Failed to publish message: %s after %s attempts", message, self.max_attempts)
+        return len(entries)
+
+
+def read_state_object(s3_client, location):
+    """
+    Reads a state file kept between runs, from S3 when location is an s3:// URI, otherwise from local disk.
+    :param s3_client: S3 client to use.
+    :param location: s3://bucket/key URI or local path of the file.
+    :return: the file contents, or None if there is no file yet.
+    """
+    if location.startswith("s3://"):
+        bucket, key = location[len("s3://"):].split("/", 1)
+        try:
+            return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except s3_client.exceptions.NoSuchKey:
+            return None
+    if not os.path.exists(location):
+        return None
+    with open(location, "rb") as f:
+        return f.read()
+
+
+def write_state_object(s3_client, location, data):
+    """
+    Writes a state file kept between runs, to S3 when location is an s3:// URI, otherwise to local disk.
+    :param s3_client: S3 client to use.
+    :param location: s3://bucket/key URI or local path of the file.
+    :param data: the file contents.
+    """
+    if location.startswith("s3://"):
+        bucket, key = location[len("s3://"):].split("/", 1)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+        return
+    assert_dir_exists(os.path.dirname(os.path.abspath(location)))
+    with open(location, "wb") as f:
+        f.write(data)
+
+
+def list_state_shards(s3_client, location):
+    """
+    Lists the copies of a state file saved by the shards of a sharded run, see ProcessingShard.location.
+    :param s3_client: S3 client to use.
+    :param location: s3://bucket/key URI or local path of the state file.
+    :return: the locations of the shard copies.
+    """
+    prefix = location + ".shard-"
+    if location.startswith("s3://"):
+        bucket, key = prefix[len("s3://"):].split("/", 1)
+        paginator = s3_client.get_paginator('list_objects_v2')
+        return ["s3://{}/{}".format(bucket, obj['Key']) for page in paginator.paginate(Bucket=bucket, Prefix=key) for obj in page.get('Contents', [])]
+    return sorted(glob.glob(glob.escape(prefix) + "*"))
+
+
+def read_state_shards(s3_client, location):
+    """
+    Reads a state file together with every shard copy of it.
+    :return: list of the contents of the files found.
+    """
+    parts = [read_state_object(s3_client, part) for part in [location] + list_state_shards(s3_client, location)]
+    return [part for part in parts if part]
+
+
+class ProcessingShard(namedtuple('ProcessingShard', ['index', 'count'])):
+    """Useage:
+        shard = ProcessingShard.from_resource_config()
+        if shard.owns(key):
+            ...
+        checkpoint_location = shard.location('s3://my-example-bucket-9933668/state/checkpoint.jsonl')
+
+    One of count partitions of the drop bucket keys. Keys are assigned by a hash of the key, so every instance of a
+    processing job agrees on the partition without talking to the others.
+    """
+
+    RESOURCE_CONFIG = "/opt/ml/config/resourceconfig.json"
+
+    @classmethod
+    def from_resource_config(cls, path=RESOURCE_CONFIG):
+        """
+        Works out this instance's shard from the processing job's resource config, a single shard when not run by
+        SageMaker Processing.
+        """
+        if not os.path.exists(path):
+            return cls(index=0, count=1)
+        with open(path) as f:
+            config = json.load(f)
+        hosts = sorted(config['hosts'])
+        return cls(index=hosts.index(config['current_host']), count=len(hosts))
+
+    def owns(self, key):
+        if self.count == 1:
+            return True
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % self.count == self.index
+
+    def location(self, location):
+        """The location this shard saves its copy of a state file to, the state file itself when unsharded."""
+        if self.count == 1:
+            return location
+        return "{}.shard-{}".format(location, self.index)
+
+
+class ContentHashIndex(object):
+    """Useage:
+        index = ContentHashIndex.load(s3_client, 's3://my-example-bucket-9933668/state/dedup.index')
+        digest = ContentHashIndex.digest(file_byte_string)
+        if not index.seen(digest):
+            ...
+            index.add(digest)
+        index.save(s3_client, 's3://my-example-bucket-9933668/state/dedup.index')
+
+    Records the digests of every image already sent for labeling. The index file is a sorted run of fixed size
+    digests, loaded as a NumPy array straight over the file bytes and searched with a binary search, so millions of
+    entries load in little more than the time to read the file. Digests added during a run are merged in on save.
+    Copies saved by the shards of a sharded run are merged in on load.
+    """
+
+    def __init__(self, digests=b"", digest_size=16):
+        self.dtype = np.dtype("S{}".format(digest_size))
+        self._saved = np.frombuffer(digests, dtype=self.dtype)
+        self._added = set()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, s3_client, location, digest_size=16):
+        parts = read_state_shards(s3_client, location)
+        if len(parts) <= 1:
+            return cls(parts[0] if parts else b"", digest_size=digest_size)
+        dtype = np.dtype("S{}".format(digest_size))
+        merged = np.unique(np.concatenate([np.frombuffer(part, dtype=dtype) for part in parts]))
+        return cls(merged.tobytes(), digest_size=digest_size)
+
+    @staticmethod
+    def digest(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def __len__(self):
+        return len(self._saved) + len(self._added)
+
+    def seen(self, digest):
+        """True if digest is already in the index, counting the lookup as a hit or a miss."""
+        found = digest in self._added
+        if not found and len(self._saved):
+            query = np.array([digest], dtype=self.dtype)
+            position = np.searchsorted(self._saved, query)[0]
+            found = position < len(self._saved) and self._saved[position] == query[0]
+        if found:
+            self.hits += 1
         else:
-            raise S3ImagesInvalidExtension('Extension is invalid')
+            self.misses += 1
+        return bool(found)
+
+    def add(self, digest):
+        self._added.add(digest)
+
+    def save(self, s3_client, location):
+        added = np.array(sorted(self._added), dtype=self.dtype)
+        write_state_object(s3_client, location, np.union1d(self._saved, added).tobytes())
+
+
+class ProcessingCheckpoint(object):
+    """Useage:
+        checkpoint = ProcessingCheckpoint.load(s3_client, 's3://my-example-bucket-9933668/state/checkpoint.jsonl')
+        if not checkpoint.is_done(key, etag):
+            ...
+            checkpoint.mark_done(key, etag)
+        checkpoint.save(s3_client)
+
+    Records the drop images, by key and ETag, that are already in the GroundTruth input bucket, so a run restarted
+    after an interruption only deletes them rather than processing them again. A re-uploaded image gets a new ETag
+    and is processed as normal. The checkpoint is a JSON lines file, rewritten every save_interval images.
+    Copies saved by the shards of a sharded run are merged in on load, save_location is where this run saves to.
+    """
+
+    def __init__(self, location, done=None, save_interval=500):
+        self.location = location
+        self.save_interval = save_interval
+        self._done = done or {}
+        self._unsaved = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, s3_client, location, save_interval=500, save_location=None):
+        done = {}
+        for data in read_state_shards(s3_client, location):
+            for line in data.splitlines():
+                if line.strip():
+                    entry = json.loads(line)
+                    done[entry['key']] = entry['etag']
+        return cls(save_location or location, done, save_interval)
+
+    def __len__(self):
+        return len(self._done)
+
+    def is_done(self, key, etag):
+        return self._done.get(key) == etag
+
+    def mark_done(self, key, etag):
+        with self._lock:
+            self._done[key] = etag
+            self._unsaved += 1
+
+    def save_due(self):
+        return self._unsaved >= self.save_interval
+
+    def retain(self, keys):
+        """Forgets every image except keys, once the rest are deleted from the drop bucket."""
+        with self._lock:
+            self._done = {key: self._done[key] for key in keys if key in self._done}
+            self._unsaved += 1
+
+    def save(self, s3_client):
+        with self._lock:
+            lines = [json.dumps({'key': key, 'etag': etag}) for key, etag in self._done.items()]
+            self._unsaved = 0
+        write_state_object(s3_client, self.location, "".join(line + "\n" for line in lines).encode("utf-8"))
+
+
+def perceptual_hash(image):
+    """
+    Difference hash of an image - one bit per neighbouring pixel pair of a 9x8 greyscale thumbnail, so
+    re-encoded or slightly altered copies of a frame hash the same.
+    :return: the 8 byte hash.
+    """
+    thumbnail = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1]).tobytes()
+
 
 def assert_dir_exists(path):
     """
@@ -83,14 +710,16 @@ def assert_dir_exists(path):
             raise
 
 
-def download_dir(client, bucket, path, target):
+def download_dir(client, bucket, path, target, transfer=None):
     """
     Downloads recursively the given S3 path to the target directory.
     :param client: S3 client to use.
     :param bucket: the name of the bucket to download from
     :param path: The S3 directory to download.
     :param target: the local directory to download the files to.
+    :param transfer: optional S3TransferPool, when given the files are downloaded in parallel.
     """
+    downloads = []
 
     # Handle missing / at end of prefix
     if (path != "") and (not path.endswith('/')):
@@ -111,48 +740,608 @@ def download_dir(client, bucket, path, target):
                     if (path != ""):
                         local_file_dir = os.path.dirname(local_file_path)
                         assert_dir_exists(local_file_dir)
-                    client.download_file(bucket, key['Key'], local_file_path)
+                    if transfer is not None:
+                        downloads.append(transfer.submit(transfer.download_file, bucket, key['Key'], local_file_path))
+                    else:
+                        client.download_file(bucket, key['Key'], local_file_path)
         else:
             logger.info("Nothing to download! No files found in bucket: %s, path: %s", 
                         bucket,
                         path)
 
+    for download in downloads:
+        download.result()
 
-def crop_image(input_image):
+
+class CropGeometry(namedtuple('CropGeometry', ['width', 'height', 'top'])):
+    """The crop taken from the frames of one camera - a width x height window, centred horizontally, from row top."""
+
+    def rectangle(self, image_width, image_height):
+        """
+        Works out the crop rectangle for a frame of the given size.
+        :return: (left, top, right, bottom) rounded the same way Image.crop rounds them.
+        """
+        #get centre
+        centre_width = image_width/2
+
+        left_position = centre_width-(self.width/2)
+        right_position = centre_width+(self.width/2)
+
+        top_position = self.top
+        bottom_position = top_position+self.height
+
+        return tuple(int(round(position)) for position in (left_position, top_position, right_position, bottom_position))
+
+    def fits(self, image_width, image_height):
+        """True if the crop rectangle lies wholly inside a frame of the given size."""
+        left_position, top_position, right_position, bottom_position = self.rectangle(image_width, image_height)
+        return left_position >= 0 and top_position >= 0 and right_position <= image_width and bottom_position <= image_height
+
+
+#set to 512x512 for the Sem Seg Algorithm
+#our froth images are not quite central - lets get from pixel 10 at top
+DEFAULT_CROP_GEOMETRY = CropGeometry(width=512, height=512, top=10)
+
+
+def load_crop_geometries(crop_geometry_json):
+    """
+    Parses the per camera crop geometry, eg '{"default": {"width": 512, "height": 512, "top": 10}, "CAM01": {"top": 40}}'.
+    Settings missing for a camera are taken from "default", then from DEFAULT_CROP_GEOMETRY.
+    :param crop_geometry_json: JSON object keyed by camera name, or None.
+    :return: dict of camera name to CropGeometry, "default" holds the geometry for any other camera.
+    """
+    settings = json.loads(crop_geometry_json) if crop_geometry_json else {}
+    default_geometry = DEFAULT_CROP_GEOMETRY._replace(**settings.pop("default", {}))
+    geometries = {camera: default_geometry._replace(**camera_settings) for camera, camera_settings in settings.items()}
+    geometries["default"] = default_geometry
+    return geometries
+
+
+def crop_image(input_image, geometry=DEFAULT_CROP_GEOMETRY):
     #get image size
     width, height = input_image.size
-    print("old size is width: {}, height: {}".format(width, height))
+    logger.debug("old size is width: {}, height: {}".format(width, height))
 
-    #set to 512x512
-    preferred_dimension_height=512
-    preferred_dimension_width=512
-    
-    #get centre
-    centre_width = width/2
-    centre_height = height/2
-    
-    left_position = centre_width-(preferred_dimension_width/2)
-    right_position = centre_width+(preferred_dimension_width/2)
-    
-    #our froth images are not quite central - lets get from pixel 10 at top
-    top_position = 10
-    bottom_position = top_position+preferred_dimension_height
-    
-    crop_rectangle = (left_position, top_position, right_position, bottom_position)
+    crop_rectangle = geometry.rectangle(width, height)
     cropped_im = input_image.crop(crop_rectangle)
     new_width, new_height = cropped_im.size
-    print("new size is width: {}, height: {}".format(new_width, new_height))
+    logger.debug("new size is width: {}, height: {}".format(new_width, new_height))
     return cropped_im
 
+def open_for_crop(image_file, bottom_position):
+    """
+    Opens an image, limiting decoding to the rows above bottom_position where the format allows it.
+    Baseline JPEGs decode top down, so stopping the decoder once it reaches the bottom of the crop leaves the
+    pixels inside the crop identical to a full decode, while skipping the rest of the frame.
+    :param image_file: path or file object holding the raw image.
+    :param bottom_position: the bottom edge of the crop that will be taken from the image.
+    :return: the lazily decoded Image.
+    """
+    image = Image.open(image_file)
+    width, height = image.size
+    if image.format == "JPEG" and len(image.tile) == 1 and bottom_position < height:
+        decoder_name, extents, offset, decoder_args = image.tile[0]
+        image.tile = [(decoder_name, (0, 0, width, bottom_position), offset, decoder_args)]
+        image._size = (width, bottom_position)
+    return image
+
+def open_image(image_file, geometry=DEFAULT_CROP_GEOMETRY, fast_decode=True):
+    """
+    Opens a raw drop image ready for cropping.
+    :param fast_decode: only decode the rows of the image needed for the crop, see open_for_crop.
+    """
+    if fast_decode:
+        return open_for_crop(image_file, geometry.top + geometry.height)
+    return Image.open(image_file)
+
 # Pre-Process Images - Feature Engineering for Ground Truth
-def preprocess_images(s3ImagesClient, s3bucketname_groundtruth_job_input, image_path, image_name):
-    print("processing file: {}".format(image_name))
-    raw_image = Image.open(image_path)
+def preprocess_images(image_file, image_name, geometry=DEFAULT_CROP_GEOMETRY, fast_decode=True, profile=None):
+    """
+    Crops a raw drop image and encodes it ready for the GroundTruth input bucket.
+    :param image_file: path or file object holding the raw image.
+    :param image_name: name of the image, its extension picks the output format.
+    :param geometry: the CropGeometry for the camera that took the image.
+    :param fast_decode: only decode the rows of the image needed for the crop, see open_for_crop.
+    :param profile: save options per format, see ENCODING_PROFILES.
+    :return: buffer holding the encoded image.
+    """
+    logger.debug("processing file: {}".format(image_name))
+    raw_image = open_image(image_file, geometry, fast_decode)
+    try:
+        # Apply a crop to make the image square for Sem Seg Algorithm
+        croped_image = crop_image(raw_image, geometry)
+    finally:
+        # close() frees the pixels, a with block would only close the file
+        raw_image.close()
+    try:
+        return encode_image(croped_image, image_name, profile)
+    finally:
+        croped_image.close()
 
-    # Apply a crop to make the image square for Sem Seg Algorithm
-    croped_image = crop_image(raw_image)
-    
-    s3ImagesClient.to_s3(croped_image, s3bucketname_groundtruth_job_input, image_name)
+
+def quality_metadata(quality, rejected):
+    """The reason a crop was rejected and its measures, as S3 object metadata of its quarantined image."""
+    metadata = {'quality-rejected': rejected}
+    for measure in ("brightness", "contrast", "sharpness"):
+        if getattr(quality, measure) is not None:
+            metadata["quality-{}".format(measure)] = "{:.2f}".format(getattr(quality, measure))
+    return metadata
+
+
+def crop_and_encode_batch(images, geometry=DEFAULT_CROP_GEOMETRY, fast_decode=True, with_perceptual_hash=False, batch_metrics=None, quality_thresholds=None,
+                          encoding=DEFAULT_IMAGE_ENCODING):
+    """
+    Process pool worker - crops and encodes a batch of raw drop images from the same camera.
+    Frames sharing a size and mode are cropped into one stacked NumPy array with a single precomputed rectangle,
+    anything else goes through crop_image. Frames are decoded one at a time and every image is closed as soon as
+    it is done with, so only one decoded frame is held however large the batch. Errors are returned rather than
+    raised, so one corrupt image cannot kill the rest of the batch.
+    :param images: list of (image name, raw image bytes) tuples.
+    :param geometry: the CropGeometry for the camera that took the images.
+    :param fast_decode: only decode the rows of each image needed for the crop.
+    :param with_perceptual_hash: also return the perceptual_hash of each crop.
+    :param batch_metrics: StageMetrics to time the decode, crop and encode of each image into, the script's metrics by default.
+    :param quality_thresholds: optional QualityThresholds to measure each crop against, crops that fail them are not encoded.
+    :param encoding: ImageEncoding of the crops, with lossless_crop crops are copied rather than re-encoded where
+        possible, and not even decoded unless they are to be measured or hashed.
+    :return: list of (image name, encoded image bytes, error message, perceptual hash, FrameQuality) tuples, the
+        error being None on success, the hash None unless asked for and the quality None without quality_thresholds.
+    """
+    batch_metrics = batch_metrics or metrics
+    # crops copied by lossless_crop, by image name, waiting on their measures or hash
+    copied = {}
+
+    def encoded(image_name, cropped_image, quality=None):
+        if quality is not None and quality.rejected is not None:
+            copied.pop(image_name, None)
+            return (image_name, None, None, None, quality)
+        image_hash = None
+        if with_perceptual_hash:
+            with batch_metrics.timer("perceptual_hash"):
+                image_hash = perceptual_hash(cropped_image)
+        if image_name in copied:
+            return (image_name, copied.pop(image_name), None, image_hash, quality)
+        with batch_metrics.timer("encode") as timing:
+            encoded_bytes = encode_image(cropped_image, encoding.output_key(image_name), encoding.profile).getvalue()
+            timing.nbytes = len(encoded_bytes)
+        return (image_name, encoded_bytes, None, image_hash, quality)
+
+    def measure(frames):
+        if quality_thresholds is None:
+            return [None] * len(frames)
+        started = time.perf_counter()
+        qualities = measure_frames(frames, quality_thresholds)
+        for _ in qualities:
+            batch_metrics.record("quality", (time.perf_counter() - started) / len(qualities))
+        return qualities
+
+    results = []
+    frame_groups = {}
+    for image_name, image_bytes in images:
+        raw_image = None
+        try:
+            raw_image = open_image(BytesIO(image_bytes), geometry, fast_decode)
+            if quality_thresholds is not None and is_truncated(image_bytes, raw_image.format):
+                results.append((image_name, None, None, None, FrameQuality("truncated", None, None, None, None)))
+                continue
+            if encoding.lossless_crop:
+                with batch_metrics.timer("lossless_crop") as timing:
+                    copied_bytes = lossless_crop(image_bytes, raw_image, geometry.rectangle(*raw_image.size), get_safe_ext(encoding.output_key(image_name)))
+                    timing.nbytes = len(copied_bytes or b"")
+                if copied_bytes is not None:
+                    if quality_thresholds is None and not with_perceptual_hash:
+                        results.append((image_name, copied_bytes, None, None, None))
+                        continue
+                    copied[image_name] = copied_bytes
+            (width, height) = raw_image.size
+            if raw_image.mode in ARRAY_IMAGE_MODES and geometry.fits(width, height):
+                # only the header is read so far, each frame of the group is decoded as it is cropped
+                frame_groups.setdefault((raw_image.size, raw_image.mode), []).append((image_name, len(image_bytes), raw_image))
+                raw_image = None
+                continue
+            with batch_metrics.timer("decode", nbytes=len(image_bytes)):
+                raw_image.load()
+            with batch_metrics.timer("crop"):
+                cropped_image = crop_image(raw_image, geometry)
+            try:
+                quality = measure(np.asarray(cropped_image.convert("L"))[np.newaxis])[0]
+                results.append(encoded(image_name, cropped_image, quality))
+            finally:
+                cropped_image.close()
+        except Exception as e:
+            results.append((image_name, None, "{}: {}".format(type(e).__name__, e), None, None))
+        finally:
+            if raw_image is not None:
+                raw_image.close()
+
+    for ((width, height), mode), frames in frame_groups.items():
+        left_position, top_position, right_position, bottom_position = geometry.rectangle(width, height)
+        cropped = np.empty((len(frames), bottom_position - top_position, right_position - left_position) + ((len(mode),) if mode != "L" else ()), dtype=np.uint8)
+        cropped_frames = []
+        for index, (image_name, nbytes, raw_image) in enumerate(frames):
+            # one decoded frame at a time, closed as soon as its crop is copied out
+            try:
+                with batch_metrics.timer("decode", nbytes=nbytes):
+                    raw_image.load()
+                with batch_metrics.timer("crop"):
+                    cropped[index] = np.asarray(raw_image)[top_position:bottom_position, left_position:right_position]
+                cropped_frames.append((index, image_name, dict(raw_image.info)))
+            except Exception as e:
+                results.append((image_name, None, "{}: {}".format(type(e).__name__, e), None, None))
+            finally:
+                raw_image.close()
+        # every crop of the group is measured at once
+        qualities = measure(cropped[[index for index, _, _ in cropped_frames]])
+        for (index, image_name, info), quality in zip(cropped_frames, qualities):
+            try:
+                cropped_image = Image.fromarray(cropped[index], mode)
+                cropped_image.info = info
+                results.append(encoded(image_name, cropped_image, quality))
+                cropped_image.close()
+            except Exception as e:
+                results.append((image_name, None, "{}: {}".format(type(e).__name__, e), None, None))
+    return results
+
+
+def crop_and_encode_batch_with_metrics(images, geometry=DEFAULT_CROP_GEOMETRY, fast_decode=True, with_perceptual_hash=False, quality_thresholds=None,
+                                       encoding=DEFAULT_IMAGE_ENCODING):
+    """
+    Process pool worker - crop_and_encode_batch, also returning the batch's timings for the parent process to merge
+    into its metrics.
+    :return: (crop_and_encode_batch results, StageMetrics snapshot) tuple.
+    """
+    batch_metrics = StageMetrics(output_format="off")
+    results = crop_and_encode_batch(images, geometry, fast_decode, with_perceptual_hash, batch_metrics, quality_thresholds, encoding)
+    return results, batch_metrics.snapshot()
+
+
+def start_processor(processing_workers):
+    """
+    Starts the process pool for the crop/encode stage.
+    Workers are forked here, before any transfer or pipeline threads exist, as forking a threaded process is unsafe.
+    :param processing_workers: the number of worker processes, 0 crops on the pipeline thread instead.
+    :return: the ProcessPoolExecutor, or None when processing_workers is 0.
+    """
+    if processing_workers <= 0:
+        return None
+    processor = ProcessPoolExecutor(max_workers=processing_workers)
+    list(processor.map(int, range(processing_workers)))
+    return processor
+
+
+def submit_or_run(executor, fn, *args):
+    """
+    Submits fn to the executor, or runs it straight away when there is no executor.
+    :return: a Future for the result of fn.
+    """
+    if executor is not None:
+        return executor.submit(fn, *args)
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+
+def list_drop_keys(client, bucket, path="", shard=None):
+    """
+    Lists the images directly under the given S3 path, one page at a time.
+    :param client: S3 client to use.
+    :param bucket: the name of the bucket to list
+    :param path: The S3 directory to list.
+    :param shard: optional ProcessingShard, only its images are listed.
+    """
+    # Handle missing / at end of prefix
+    if (path != "") and (not path.endswith('/')):
+        path += '/'
+
+    paginator = client.get_paginator('list_objects_v2')
+    for result in metrics.time_each("list", paginator.paginate(Bucket=bucket, Prefix=path, Delimiter='/')):
+        for obj in result.get('Contents', []):
+            (filename, extension) = os.path.splitext(obj['Key'])
+            if extension in IMAGE_EXTENSIONS and (shard is None or shard.owns(obj['Key'])):
+                yield obj
+
+
+def start_stage(name, produce, outbox, cancelled, errors):
+    """
+    Starts a pipeline stage on its own thread.
+    Everything yielded by produce() is put on the bounded outbox queue, followed by an end of stream marker.
+    :param name: name of the stage, used for the thread name and logging.
+    :param produce: callable returning an iterator over the items of this stage.
+    :param outbox: bounded queue feeding the next stage.
+    :param cancelled: event set when the pipeline is shutting down early.
+    :param errors: list collecting any exception raised by the stage.
+    """
+    def run():
+        try:
+            for item in produce():
+                if not put_item(outbox, item, cancelled):
+                    return
+        except Exception as e:
+            logger.exception("Pipeline stage %s failed", name)
+            errors.append(e)
+            cancelled.set()
+        finally:
+            put_item(outbox, _END_OF_STREAM, cancelled)
+
+    stage = threading.Thread(target=run, name=name, daemon=True)
+    stage.start()
+    return stage
+
+
+def put_item(outbox, item, cancelled):
+    """
+    Blocks until there is room for item on the outbox, or the pipeline is cancelled.
+    :return: True if the item was queued.
+    """
+    while not cancelled.is_set():
+        try:
+            outbox.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def drain(inbox, cancelled):
+    """
+    Yields the items put on inbox until the end of stream marker is reached, or the pipeline is cancelled.
+    """
+    while not cancelled.is_set():
+        try:
+            item = inbox.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if item is _END_OF_STREAM:
+            return
+        yield item
+
+
+def process_drop_bucket(s3_client, transfer, processor, s3bucketname_drop, s3bucketname_groundtruth_job_input, queue_depth=32, fast_decode=True, batch_size=8, crop_geometries=None,
+                        dedup_index=None, perceptual_index=None, delete_duplicates=True, delete_batch_size=S3DeleteBatcher.MAX_BATCH_SIZE,
+                        checkpoint=None, publisher=None, shard=None, quality_gate=None, quarantine_prefix=QUARANTINE_PREFIX, encoding=DEFAULT_IMAGE_ENCODING,
+                        memory_budget=None, scheduler=None):
+    """
+    Streams every drop image through feature engineering and into the GroundTruth input bucket.
+    Listing, downloading, cropping and uploading run as overlapping stages joined by queues of at most
+    queue_depth items, so memory stays bounded however many images are waiting in the drop bucket. A memory_budget
+    also bounds the bytes held, each image counting its size in the drop bucket from its download until its crop is
+    uploaded or it is dropped, which keeps memory flat however large the images are.
+    The GETs, PUTs and batched deletes run in parallel on the transfer pool, and the crops on the processor's worker processes
+    in batches of images from the same camera. Images that fail to crop are logged and left in the drop bucket.
+    Images already in the dedup_index, or whose crop is already in the perceptual_index, are never sent for labeling.
+    A copy of an image still in flight in this run is left in the drop bucket for the next run to resolve.
+    With a checkpoint, images a previous interrupted run already uploaded are only deleted from the drop bucket.
+    With a publisher, each uploaded image is also fed straight to the streaming labeling topic, and is only treated
+    as done once SNS accepts it.
+    With a shard, only that shard's images are processed, so several instances can share the drop bucket.
+    With a quality_gate, images it rejects are moved under quarantine_prefix in the drop bucket rather than sent for labeling.
+    With a scheduler, the shard's listing is taken in full and the images are processed, uploaded and published in
+    the scheduler's order, and those it leaves out are moved under quarantine_prefix as sampled.
+    :param s3_client: S3 client to use for listing the drop bucket.
+    :param transfer: S3TransferPool running the GETs, PUTs and deletes.
+    :param processor: ProcessPoolExecutor running crop_and_encode_batch, or None to crop on the pipeline thread.
+    :param s3bucketname_drop: the name of the bucket holding the raw drop images
+    :param s3bucketname_groundtruth_job_input: the name of the GroundTruth input bucket
+    :param queue_depth: the maximum number of images held between two stages.
+    :param fast_decode: only decode the rows of each image needed for the crop.
+    :param batch_size: the number of images from one camera cropped together.
+    :param crop_geometries: dict of camera name to CropGeometry, see load_crop_geometries.
+    :param dedup_index: optional ContentHashIndex of the raw images already sent for labeling.
+    :param perceptual_index: optional ContentHashIndex of the perceptual hashes of the crops already sent for labeling.
+    :param delete_duplicates: delete duplicates from the drop bucket, rather than leaving them there.
+    :param delete_batch_size: the number of processed images deleted from the drop bucket per DeleteObjects request.
+    :param checkpoint: optional ProcessingCheckpoint, saved as images are uploaded.
+    :param publisher: optional SNSBatchPublisher for the streaming labeling topic.
+    :param shard: optional ProcessingShard of the drop bucket to process.
+    :param quality_gate: optional QualityGate the crops must pass.
+    :param quarantine_prefix: where in the drop bucket rejected images are moved to, as <prefix><reason>/<key>. It
+        must hold a / so the quarantined images are never listed again.
+    :param encoding: ImageEncoding of the crops uploaded to the GroundTruth input bucket.
+    :param memory_budget: optional MemoryBudget throttling the downloads.
+    :param scheduler: optional WorkScheduler ordering and sampling the drop images.
+    :return: the number of images processed.
+    """
+    cancelled = threading.Event()
+    errors = []
+    fetched = queue.Queue(maxsize=queue_depth)
+    cropping = queue.Queue(maxsize=queue_depth)
+    uploading = queue.Queue(maxsize=queue_depth)
+
+    etags = {}
+    if memory_budget is None:
+        memory_budget = MemoryBudget()
+    # bytes taken from the memory budget, by key
+    held_bytes = {}
+
+    # (key, copy) of the images the scheduler left out
+    set_aside = []
+
+    def set_aside_image(obj):
+        target_key = "{}{}/{}".format(quarantine_prefix, SAMPLED_OUT, obj['Key'])
+        set_aside.append((obj['Key'], transfer.submit(transfer.copy, s3bucketname_drop, obj['Key'], target_key)))
+
+    def pending_drop_objects():
+        for obj in list_drop_keys(s3_client, s3bucketname_drop, shard=shard):
+            if checkpoint is not None:
+                if checkpoint.is_done(obj['Key'], obj['ETag']):
+                    logger.debug("Skipping file: %s, already processed by a previous run", obj['Key'])
+                    metrics.increment("checkpoint_skips")
+                    deleter.add(obj['Key'])
+                    continue
+            yield obj
+
+    def scheduled_drop_objects():
+        scheduler.on_skipped = set_aside_image
+        with metrics.timer("schedule"):
+            for obj in pending_drop_objects():
+                scheduler.add(obj, get_camera_name(obj['Key']), obj['LastModified'].timestamp())
+        logger.info("Scheduled %s drop images, %s sampled out", len(scheduler), scheduler.sampled_out_count)
+        return scheduler.drain()
+
+    def fetch():
+        for obj in (pending_drop_objects() if scheduler is None else scheduled_drop_objects()):
+            if not memory_budget.try_acquire(obj['Size']):
+                metrics.increment("memory_throttled")
+                # the budget may be held by images preprocess is holding back for batching, have them sent off first
+                yield None, None
+                with metrics.timer("memory_wait"):
+                    if not memory_budget.acquire(obj['Size'], cancelled):
+                        return
+            held_bytes[obj['Key']] = obj['Size']
+            if checkpoint is not None:
+                etags[obj['Key']] = obj['ETag']
+            yield obj['Key'], transfer.submit(transfer.get, s3bucketname_drop, obj['Key'])
+
+    def release(key):
+        memory_budget.release(held_bytes.pop(key, 0))
+
+    if crop_geometries is None:
+        crop_geometries = load_crop_geometries(None)
+    batches = {}
+    # digests of the images between the dedup check and a confirmed upload, by key
+    content_digests = {}
+    perceptual_digests = {}
+    deleter = S3DeleteBatcher(transfer, s3bucketname_drop, batch_size=delete_batch_size)
+
+    def is_duplicate(index, in_flight, key, digest):
+        if digest in in_flight.values():
+            logger.debug("Skipping file: %s, a copy is already being processed", key)
+            metrics.increment("duplicates")
+            return True
+        if index.seen(digest):
+            logger.debug("Skipping file: %s, already sent for labeling", key)
+            metrics.increment("duplicates")
+            if delete_duplicates:
+                deleter.add(key)
+            return True
+        in_flight[key] = digest
+        return False
+
+    def submit_batch(camera_name):
+        geometry = crop_geometries.get(camera_name, crop_geometries["default"])
+        return submit_or_run(processor, crop_and_encode_batch_with_metrics, batches.pop(camera_name), geometry, fast_decode, perceptual_index is not None,
+                             quality_gate.thresholds if quality_gate is not None else None, encoding)
+
+    def preprocess():
+        for key, download in drain(fetched, cancelled):
+            if key is None:
+                # fetch is waiting on the memory budget
+                for held_camera_name in list(batches):
+                    yield submit_batch(held_camera_name)
+                continue
+            image_bytes = download.result()
+            if dedup_index is not None and is_duplicate(dedup_index, content_digests, key, ContentHashIndex.digest(image_bytes)):
+                release(key)
+                continue
+            camera_name = get_camera_name(key)
+            batches.setdefault(camera_name, []).append((key, image_bytes))
+            if len(batches[camera_name]) >= batch_size:
+                yield submit_batch(camera_name)
+            elif sum(len(batch) for batch in batches.values()) >= queue_depth:
+                # keep the images held back for batching within the queue depth
+                for held_camera_name in list(batches):
+                    yield submit_batch(held_camera_name)
+        for held_camera_name in list(batches):
+            yield submit_batch(held_camera_name)
+
+    def upload():
+        for crop in drain(cropping, cancelled):
+            results, batch_timings = crop.result()
+            metrics.merge(batch_timings)
+            for key, image_bytes, error, image_hash, quality in results:
+                if error is not None:
+                    logger.warning("Failed to process file: %s, leaving it in the drop bucket. %s", key, error)
+                    metrics.increment("errors")
+                    content_digests.pop(key, None)
+                    release(key)
+                    continue
+                rejected = quality_gate.review(get_camera_name(key), quality) if quality_gate is not None else None
+                if rejected is not None:
+                    content_digests.pop(key, None)
+                    etags.pop(key, None)
+                    yield key, transfer.submit(transfer.copy, s3bucketname_drop, key, "{}{}/{}".format(quarantine_prefix, rejected, key), quality_metadata(quality, rejected)), rejected
+                    continue
+                if perceptual_index is not None and is_duplicate(perceptual_index, perceptual_digests, key, image_hash):
+                    content_digests.pop(key, None)
+                    release(key)
+                    continue
+                # Do main activity - put prepared image in GroundTruth INPUT bucket
+                yield key, transfer.submit(transfer.put, s3bucketname_groundtruth_job_input, encoding.output_key(key), image_bytes), None
+
+    stages = [
+        start_stage("fetch", fetch, fetched, cancelled, errors),
+        start_stage("preprocess", preprocess, cropping, cancelled, errors),
+        start_stage("upload", upload, uploading, cancelled, errors),
+    ]
+
+    def complete(key):
+        if dedup_index is not None:
+            dedup_index.add(content_digests.pop(key))
+        if perceptual_index is not None:
+            perceptual_index.add(perceptual_digests.pop(key))
+        if checkpoint is not None:
+            checkpoint.mark_done(key, etags.pop(key))
+            if checkpoint.save_due():
+                checkpoint.save(s3_client)
+
+        # now delete s3 file from drop, only once it is safely in the GroundTruth INPUT bucket
+        deleter.add(key)
+        metrics.increment("processed")
+        logger.debug("Processed file: {}".format(key))
+
+    def quarantine(key, rejected):
+        # the copy is in place, out of the drop bucket with it
+        deleter.add(key)
+        metrics.increment("quarantined")
+        metrics.increment("quarantined_{}".format(rejected))
+        logger.debug("Quarantined file: %s, %s", key, rejected)
+
+    processed_count = 0
+    completed = False
+    try:
+        for key, upload, rejected in drain(uploading, cancelled):
+            upload.result()
+            release(key)
+            if rejected is not None:
+                quarantine(key, rejected)
+                continue
+            if publisher is not None:
+                source_ref = "s3://{}/{}".format(s3bucketname_groundtruth_job_input, encoding.output_key(key))
+                publisher.publish({"source-ref": source_ref}, on_published=functools.partial(complete, key))
+            else:
+                complete(key)
+            processed_count += 1
+        completed = True
+    finally:
+        cancelled.set()
+        for stage in stages:
+            stage.join()
+        for key, copy in set_aside:
+            try:
+                copy.result()
+                quarantine(key, SAMPLED_OUT)
+            except Exception as e:
+                logger.warning("Failed to set aside file: %s, leaving it in the drop bucket. %s", key, e)
+        if scheduler is not None:
+            logger.info("Schedule left out %s files, %s sampled out and %s over the per window cap",
+                        len(set_aside), scheduler.sampled_out_count, scheduler.capped_count)
+        if publisher is not None:
+            failed_count = publisher.flush()
+            logger.info("Published %s files to the streaming labeling topic, %s could not be published", publisher.published_count, failed_count)
+        # images already uploaded are still deleted when the pipeline fails part way
+        failed_keys = deleter.flush()
+        logger.info("Deleted %s files from drop bucket, %s could not be deleted", deleter.deleted_count, len(failed_keys))
+        if memory_budget.limit_bytes:
+            logger.info("Held at most %.1f MB of images, of a %.0f MB memory budget", memory_budget.peak_bytes / MEGABYTE, memory_budget.limit_bytes / MEGABYTE)
+        if checkpoint is not None:
+            if completed and not errors:
+                # everything processed is out of the drop bucket, bar the failed deletes
+                checkpoint.retain(failed_keys)
+            checkpoint.save(s3_client)
+
+    if errors:
+        raise errors[0]
+    return processed_count
 
 
 if __name__ == "__main__":
@@ -161,48 +1350,130 @@ if __name__ == "__main__":
     parser.add_argument("--project-prefix", type=str, required=True)
     parser.add_argument("--s3bucketname-drop", type=str, required=True)
     parser.add_argument("--s3bucketname-groundtruth-job-input", type=str, required=True)
+    parser.add_argument("--queue-depth", type=int, default=32)
+    parser.add_argument("--parallel-jobs", type=int, default=16)
+    parser.add_argument("--max-pool-connections", type=int, default=10)
+    parser.add_argument("--processing-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--full-decode", action="store_true", help="Decode every image in full rather than only the rows needed for the crop")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--crop-geometry", type=str, help='JSON crop settings per camera, eg {"CAM01": {"width": 512, "height": 512, "top": 10}}')
+    parser.add_argument("--dedup-index", type=str, help="s3:// URI or local path of the content hash index of images already sent for labeling")
+    parser.add_argument("--dedup-perceptual-index", type=str, help="s3:// URI or local path of the perceptual hash index, also skips near identical images")
+    parser.add_argument("--dedup-action", type=str, choices=["delete", "skip"], default="delete", help="What to do with duplicates found in the drop bucket")
+    parser.add_argument("--checkpoint", type=str, help="s3:// URI or local path of the checkpoint of images already processed, lets an interrupted run resume")
+    parser.add_argument("--checkpoint-interval", type=int, default=500)
+    parser.add_argument("--feed-mode", type=str, choices=["s3-notification", "sns-publish"], default="s3-notification",
+                        help="How new images reach the streaming labeling job - the input bucket's S3 notifications, or published here straight to the SNS topic")
+    parser.add_argument("--sns-topic-arn-streaming-labeling", type=str)
+    parser.add_argument("--feed-rate", type=float, default=0, help="Maximum images per second published to the streaming labeling topic, 0 is unlimited")
+    parser.add_argument("--shard-index", type=int, help="Shard of the drop bucket to process, taken from the processing job's instances by default")
+    parser.add_argument("--shard-count", type=int)
+    parser.add_argument("--metrics-format", type=str, choices=OUTPUT_FORMATS, default="emf", help="Write stage metrics as CloudWatch EMF or plain JSON lines")
+    parser.add_argument("--metrics-interval", type=int, default=60, help="Seconds between metrics flushes")
+    parser.add_argument("--encoding-profile", type=str, default="default", help="Encoder settings of the crops, one of {}, or JSON PIL save options per format, eg {{\"PNG\": {{\"compress_level\": 3}}}}".format(", ".join(ENCODING_PROFILES)))
+    parser.add_argument("--output-format", type=str, choices=IMAGE_OUTPUT_FORMATS, default="source", help="Format of the crops, source keeps the format of each drop image")
+    parser.add_argument("--lossless-crop", action="store_true", help="Copy crops without re-encoding where possible - whole frames as they are, JPEGs with jpegtran where the crop is on the MCU grid")
+    parser.add_argument("--quality-gate", type=str, help='JSON quality thresholds, enables the quality gate, eg {"min_brightness": 16, "min_sharpness": 5}, {} for the defaults, off to disable it')
+    parser.add_argument("--quarantine-prefix", type=str, default=QUARANTINE_PREFIX, help="Prefix in the drop bucket images rejected by the quality gate, or left out by the schedule, are moved to")
+    parser.add_argument("--schedule", type=str, help='JSON order and sampling of the drop images, eg {"order": "round-robin", "per_camera_window": 50}, off to process them as listed')
+    parser.add_argument("--memory-budget-mb", type=int, default=1024, help="Most MB of drop images held at once, from download until their crop is uploaded, 0 is unlimited")
+    parser.add_argument("--pending-backlog-size", type=int, default=0, help="Number of new drop images the pipeline execution was started for, 0 when not known")
+    parser.add_argument("--max-passes", type=int, default=5, help="Most times the drop bucket is listed, it is listed again after each pass that processed images, so images dropped while the step runs are picked up by this execution")
 
     args = parser.parse_args()
 
-    base_dir = "/opt/ml/processing"
-    
-    localImageProcessingPath = f"{base_dir}/image_processessing"
-    pathlib.Path(localImageProcessingPath).mkdir(parents=True, exist_ok=True)
-    
     project_prefix = args.project_prefix
     s3bucketname_drop =args.s3bucketname_drop
     s3bucketname_groundtruth_job_input = args.s3bucketname_groundtruth_job_input
+    metrics = StageMetrics(dimensions={'Project': project_prefix, 'Step': 'FeatureEngineering'}, output_format=args.metrics_format, flush_interval=args.metrics_interval)
+    log_startup(script_started, metrics)
     
+    shard = ProcessingShard.from_resource_config()
+    if args.shard_count is not None:
+        shard = ProcessingShard(index=args.shard_index or 0, count=args.shard_count)
+    assert 0 <= shard.index < shard.count, "--shard-index must be less than --shard-count"
+
+    assert "/" in args.quarantine_prefix, "--quarantine-prefix must hold a / so quarantined images are not listed with the drop images"
+    quality_gate = None
+    if args.quality_gate is not None and args.quality_gate != "off":
+        quality_gate = QualityGate(load_quality_thresholds(args.quality_gate))
+        logger.info("Quality gate: %s, rejected images are moved to %s", quality_gate.thresholds, args.quarantine_prefix)
+
+    scheduler = None
+    if args.schedule is not None and args.schedule != "off":
+        scheduler = WorkScheduler(load_schedule_policy(args.schedule))
+        logger.info("Schedule: %s, images left out are moved to %s%s/", scheduler.policy, args.quarantine_prefix, SAMPLED_OUT)
+
+    encoding = ImageEncoding(profile=load_encoding_profile(args.encoding_profile), output_format=args.output_format, lossless_crop=args.lossless_crop)
+    if encoding.lossless_crop and shutil.which("jpegtran") is None:
+        logger.info("jpegtran is not installed, only crops of whole frames are copied without re-encoding")
+
+    # Fork the crop/encode workers first, while this is still a single threaded process
+    processor = start_processor(args.processing_workers)
+
     # Create your own session
     my_session = boto3.session.Session()
 
     s3_client = boto3.client("s3", region_name="ap-southeast-2")
-    s3ImagesClient = S3Images(boto_session=my_session)
-    
-    # download drop images
-    logger.info("Downloading drop images from bucket: %s", 
-                s3bucketname_drop)
+    transfer = S3TransferPool(boto_session=my_session, max_workers=args.parallel_jobs, max_pool_connections=args.max_pool_connections)
     
-    download_dir(s3_client, s3bucketname_drop, "", localImageProcessingPath)
-    logger.debug("Drop Images downloaded.")
-        
-    logger.info("Loop through new drop files, process for GroundTruth")
-    # Scan through local files
-    for f1 in os.scandir(localImageProcessingPath):
-        (filename, extension) = os.path.splitext(f1.path)
-#         logger.info("filename: %s, extension: %s", filename, extension)
-        if extension in [".png", ".jpg", ".jpeg"]:
-            logger.info("file: %s", f1.name)
-            camera_name = f1.name.split(' ')[0]
-
-            # Do main activity - prepare image and put in GroundTruth INPUT bucket
-            preprocess_images(s3ImagesClient, s3bucketname_groundtruth_job_input, f1.path, f1.name)
-            
-            # now delete s3 file from drop
-            source_key = "{}".format(f1.name)
-            s3_client.delete_object(Bucket = s3bucketname_drop, Key = source_key)
-            logger.info("Processed file: {}".format(source_key))
-            # ...
+    dedup_index = None
+    perceptual_index = None
+    if args.dedup_index:
+        dedup_index = ContentHashIndex.load(s3_client, args.dedup_index)
+        logger.info("Loaded dedup index of %s images from %s", len(dedup_index), args.dedup_index)
+    if args.dedup_perceptual_index:
+        perceptual_index = ContentHashIndex.load(s3_client, args.dedup_perceptual_index, digest_size=8)
+        logger.info("Loaded perceptual dedup index of %s images from %s", len(perceptual_index), args.dedup_perceptual_index)
+
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = ProcessingCheckpoint.load(s3_client, args.checkpoint, save_interval=args.checkpoint_interval, save_location=shard.location(args.checkpoint))
+        logger.info("Resuming from checkpoint of %s processed images at %s", len(checkpoint), args.checkpoint)
+
+    publisher = None
+    if args.feed_mode == "sns-publish":
+        assert args.sns_topic_arn_streaming_labeling, "--sns-topic-arn-streaming-labeling is required with --feed-mode sns-publish"
+        publisher = SNSBatchPublisher(transfer, args.sns_topic_arn_streaming_labeling, max_messages_per_second=args.feed_rate)
+
+    # stream drop images through feature engineering
+    logger.info("Streaming drop images from bucket: %s, shard: %s of %s, pending backlog: %s, queue depth: %s, parallel jobs: %s, processing workers: %s", 
+                s3bucketname_drop,
+                shard.index + 1,
+                shard.count,
+                args.pending_backlog_size,
+                args.queue_depth,
+                args.parallel_jobs,
+                args.processing_workers)
+    processed_count = 0
+    memory_budget = MemoryBudget(args.memory_budget_mb * MEGABYTE)
+    try:
+        # the trigger doesn't start another execution while this one runs, images dropped meanwhile are ours to pick up
+        for drop_pass in range(1, args.max_passes + 1):
+            pass_count = process_drop_bucket(s3_client, transfer, processor, s3bucketname_drop, s3bucketname_groundtruth_job_input, queue_depth=args.queue_depth, fast_decode=not args.full_decode, batch_size=args.batch_size, crop_geometries=load_crop_geometries(args.crop_geometry),
+                                             dedup_index=dedup_index, perceptual_index=perceptual_index, delete_duplicates=args.dedup_action == "delete",
+                                             checkpoint=checkpoint, publisher=publisher, shard=shard, quality_gate=quality_gate, quarantine_prefix=args.quarantine_prefix,
+                                             encoding=encoding, memory_budget=memory_budget, scheduler=scheduler)
+            processed_count += pass_count
+            logger.info("Pass %s of the drop bucket processed %s files", drop_pass, pass_count)
+            if pass_count == 0:
+                break
+    finally:
+        transfer.shutdown()
+        if processor is not None:
+            processor.shutdown()
+        # only images confirmed uploaded are added, so the indexes are safe to save after a failure too
+        if dedup_index is not None:
+            dedup_index.save(s3_client, shard.location(args.dedup_index))
+            logger.info("Dedup index hits: %s, misses: %s", dedup_index.hits, dedup_index.misses)
+        if perceptual_index is not None:
+            perceptual_index.save(s3_client, shard.location(args.dedup_perceptual_index))
+            logger.info("Perceptual dedup index hits: %s, misses: %s", perceptual_index.hits, perceptual_index.misses)
+        metrics.flush()
+        # ru_maxrss is in kilobytes on Linux
+        logger.info("Peak RSS %.1f MB, of the crop/encode workers %.1f MB",
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0)
+    logger.info("%s drop files processed for GroundTruth", processed_count)
     logger.info("Files processed. Kick start chained GroundTruth job.")
     
     
@@ -1,55 +1,136 @@
 """Sets up a Chained Ground Truth Job for froth-anomaly-detection dataset."""
-import subprocess
+import time
+script_started = time.perf_counter()
+
 import sys
+import os
+
+#modules shared by the step scripts, the pipeline provides them at /opt/ml/processing/input/lib
+sys.path.extend([os.path.dirname(os.path.abspath(__file__)), "/opt/ml/processing/input/lib"])
+from step_startup import check_dependencies, log_startup
+check_dependencies(__file__)
 
 import argparse
+import atexit
 import logging
-import pathlib
-import requests
-import tempfile
 import io
 
-def install(package):
-    subprocess.call([sys.executable, "-m", "pip", "install", package])
-install('sagemaker')
-
 import boto3
 import boto3.session
-
-import sagemaker
+from botocore.config import Config
+import numpy as np
 
 import json
-import time
 from datetime import datetime
 
 import errno
+import hashlib
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from stage_metrics import OUTPUT_FORMATS, StageMetrics
+from task_policy import DEFAULT_TASK_SETTINGS, next_task_settings, observation_from_job
+from work_scheduler import WorkScheduler, get_camera_name, load_schedule_policy
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+#only collected until the script configures how metrics are written
+metrics = StageMetrics(output_format="off")
+
 # Helper functions
-def update_instruction_template(s3_client, save_fname, s3_bucket, s3_path, class_list, task_description, img_examples, test_template=False):
-    #Download the static template (uploaded via the DevOps automated build)
-    s3_client.download_file(s3_bucket, 'instruction-template.template', 'instruction-template.template')
-    template = open('instruction-template.template').read()
-    
-    #Update contents with dynamic content
-    dynamic_template = template.format(
-        *img_examples,
-        title_bar=task_description,
-        categories_str=str(class_list)
-        if test_template
-        else "{{ task.input.labels | to_json | escape }}",
-    )
+INSTRUCTION_TEMPLATE_KEY = 'instruction-template.template'
+
+#object metadata recording the hash of the rendered template an object was uploaded from
+RENDER_HASH_METADATA = 'render-sha256'
 
-    with open(save_fname, "w") as f:
-        f.write(dynamic_template)
-    if test_template is False:
-        print(dynamic_template)
 
-    #Upload back to S3 with new name
-    s3_client.upload_file(save_fname, s3_bucket, s3_path)
+class InstructionTemplateRenderer(object):
+    """Useage:
+        renderer = InstructionTemplateRenderer(s3_client, s3_bucket)
+        renderer.publish("instructions.html", renderer.render(class_list, task_description, img_examples, test_template=True))
+
+    Renders the static instruction template, uploaded via the DevOps automated build, with the job's dynamic
+    content. The template is downloaded once, and rendered variants are uploaded from memory only when the object
+    in S3 doesn't already hold the same content, by its recorded render hash or its ETag.
+    """
+
+    def __init__(self, s3_client, s3_bucket, template_key=INSTRUCTION_TEMPLATE_KEY):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.template_key = template_key
+        self._template = None
+
+    def template(self):
+        if self._template is None:
+            with metrics.timer("get") as timing:
+                body = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.template_key)['Body'].read()
+                timing.nbytes = len(body)
+            self._template = body.decode("utf-8")
+        return self._template
+
+    def render(self, class_list, task_description, img_examples, test_template=False):
+        """
+        :param test_template: render the class list in, for viewing the instructions outside of a labeling job,
+            rather than the liquid expression the job fills in.
+        :return: the rendered template as bytes.
+        """
+        return self.template().format(
+            *img_examples,
+            title_bar=task_description,
+            categories_str=str(class_list)
+            if test_template
+            else "{{ task.input.labels | to_json | escape }}",
+        ).encode("utf-8")
+
+    def is_current(self, s3_path, rendered):
+        """True if the object at s3_path already holds exactly the rendered content."""
+        try:
+            head = self.s3_client.head_object(Bucket=self.s3_bucket, Key=s3_path)
+        except self.s3_client.exceptions.ClientError as e:
+            #without s3:ListBucket a missing object is a 403 rather than a 404
+            if e.response['Error']['Code'] in ("403", "404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        if head.get('Metadata', {}).get(RENDER_HASH_METADATA) == hashlib.sha256(rendered).hexdigest():
+            return True
+        #the ETag of an object put in a single part is the MD5 of its content
+        return head.get('ETag', '').strip('"') == hashlib.md5(rendered).hexdigest()
+
+    def publish(self, s3_path, rendered):
+        """
+        Uploads the rendered template to s3_path, unless it is already there.
+        :return: True if it was uploaded.
+        """
+        if self.is_current(s3_path, rendered):
+            logger.info("{} is unchanged, not uploading".format(s3_path))
+            metrics.increment("template_uploads_skipped")
+            return False
+        with metrics.timer("put", len(rendered)):
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket,
+                Key=s3_path,
+                Body=rendered,
+                ContentType="text/html",
+                Metadata={RENDER_HASH_METADATA: hashlib.sha256(rendered).hexdigest()}
+            )
+        logger.info("Uploaded {} to s3://{}/{}".format(self.template_key, self.s3_bucket, s3_path))
+        return True
+
+
+def update_instruction_template(s3_client, s3_bucket, s3_path, class_list, task_description, img_examples, test_template=False, renderer=None):
+    """
+    Renders the instruction template with the job's dynamic content and uploads it to s3_path if it has changed.
+    :param renderer: InstructionTemplateRenderer to reuse the template download of, one is made if not given.
+    """
+    renderer = renderer or InstructionTemplateRenderer(s3_client, s3_bucket)
+    dynamic_template = renderer.render(class_list, task_description, img_examples, test_template)
+    if test_template is False:
+        logger.debug(dynamic_template.decode("utf-8"))
+    return renderer.publish(s3_path, dynamic_template)
 
         
 def get_matching_s3_objects(s3_client, bucket, prefix="", suffixes=[""]):
@@ -62,6 +143,7 @@ def get_matching_s3_objects(s3_client, bucket, prefix="", suffixes=[""]):
     :param suffix: Only fetch objects whose keys end with
         items in this suffix list (optional).
     """
+    suffixes = tuple(suffixes)
     paginator = s3_client.get_paginator("list_objects_v2")
 
     kwargs = {'Bucket': bucket}
@@ -76,17 +158,15 @@ def get_matching_s3_objects(s3_client, bucket, prefix="", suffixes=[""]):
     for key_prefix in prefixes:
         kwargs["Prefix"] = key_prefix
 
-        for page in paginator.paginate(**kwargs):
+        for page in metrics.time_each("list", paginator.paginate(**kwargs)):
             try:
                 contents = page["Contents"]
             except KeyError:
                 break
 
             for obj in contents:
-                key = obj["Key"]
-                for key_suffix in suffixes:
-                    if key.endswith(key_suffix):
-                        yield obj
+                if obj["Key"].endswith(suffixes):
+                    yield obj
 
 
 def get_matching_s3_keys(s3_client, bucket, prefix="", suffixes=[""]):
@@ -100,6 +180,455 @@ def get_matching_s3_keys(s3_client, bucket, prefix="", suffixes=[""]):
     for obj in get_matching_s3_objects(s3_client, bucket, prefix, suffixes):
         yield obj["Key"]
 
+#the keys this pipeline writes start with the camera name and a space, see get_camera_name
+CAMERA_DELIMITER = " "
+
+_END_OF_SHARD = object()
+
+
+def get_matching_s3_objects_in_range(s3_client, bucket, start_after=None, end_at=None, suffixes=[""]):
+    """
+    Generate the objects in an S3 bucket whose keys sort after start_after, up to and including end_at.
+    :param s3_client: Pass through the boto3 s3 client
+    :param bucket: Name of the S3 bucket.
+    :param start_after: Only fetch keys that sort after this key (optional).
+    :param end_at: Stop at the last key that sorts before or equal to this key (optional).
+    :param suffixes: Only fetch keys that end with one of these suffixes (optional).
+    """
+    suffixes = tuple(suffixes)
+    paginator = s3_client.get_paginator("list_objects_v2")
+    kwargs = {'Bucket': bucket}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+
+    for page in metrics.time_each("list", paginator.paginate(**kwargs)):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if end_at is not None and key > end_at:
+                return
+            if key.endswith(suffixes):
+                yield obj
+
+
+def find_camera_boundaries(s3_client, bucket, delimiter=CAMERA_DELIMITER):
+    """
+    Finds where to split the keyspace of a bucket for a parallel listing, at the start of each camera's keys. S3 rolls
+    the keys up to their first delimiter, so one listing of the cameras is all it takes, whatever the images number.
+    :return: the sorted camera prefixes, eg ["CAM01 ", "CAM02 "], empty when no key holds the delimiter.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    boundaries = []
+    for page in metrics.time_each("list", paginator.paginate(Bucket=bucket, Delimiter=delimiter)):
+        boundaries.extend(prefix["Prefix"] for prefix in page.get("CommonPrefixes", []))
+    return sorted(boundaries)
+
+
+def get_matching_s3_keys_in_range(s3_client, bucket, start_after=None, end_at=None, suffixes=[""]):
+    """
+    Generate the keys in an S3 bucket that sort after start_after, up to and including end_at.
+    """
+    for obj in get_matching_s3_objects_in_range(s3_client, bucket, start_after, end_at, suffixes):
+        yield obj["Key"]
+
+
+class S3MultipartWriter(object):
+    """Useage:
+        with S3MultipartWriter(s3_client, 'my-example-bucket-9933668', 'input.manifest') as writer:
+            writer.write('{"source-ref": "s3://my-example-bucket-9933668/pythonlogo.png"}\n')
+
+    Streams text into an S3 object without a local temp file. Text is buffered into parts of part_size bytes
+    (S3 requires 5MB or more, bar the last) and sent with a multipart upload, which is aborted if the block raises.
+    Output smaller than one part is sent with a single put_object instead.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=8 * 1024 * 1024):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self._buffer = io.BytesIO()
+        self._upload_id = None
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+    def write(self, text):
+        self._buffer.write(text.encode("utf-8"))
+        if self._buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self._parts) + 1
+        body = self._buffer.getvalue()
+        with metrics.timer("manifest_write", nbytes=len(body)):
+            response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                           PartNumber=part_number, Body=body)
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self._buffer = io.BytesIO()
+
+    def close(self):
+        if self._upload_id is None:
+            body = self._buffer.getvalue()
+            with metrics.timer("manifest_write", nbytes=len(body)):
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=body)
+            return
+        if self._buffer.tell():
+            self._upload_part()
+        with metrics.timer("manifest_write"):
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                              MultipartUpload={'Parts': self._parts})
+
+
+def build_input_manifest(s3_client, bucket, manifest_key, suffixes, max_workers=8, shard_boundaries=None, queue_depth=10000,
+                         scheduler=None):
+    """
+    Writes an input manifest with a source-ref line for every matching image in the bucket.
+    The bucket is listed in parallel, one shard of the keyspace per camera, and the lines are streamed
+    straight into the manifest object in S3. With a scheduler, the whole listing is taken first and the lines are
+    written in its order, the images it leaves out stay in the bucket, out of the manifest.
+    :param s3_client: Pass through the boto3 s3 client
+    :param bucket: Name of the S3 bucket holding the images, the manifest is written here too.
+    :param manifest_key: Key of the manifest to write.
+    :param suffixes: Only include keys that end with one of these suffixes.
+    :param max_workers: The number of shards listed at once.
+    :param shard_boundaries: Keys the keyspace is split at, each shard runs from one boundary up to and including the
+        next. By default the start of each camera's keys, see find_camera_boundaries.
+    :param queue_depth: The maximum number of manifest lines waiting to be written.
+    :param scheduler: optional WorkScheduler ordering and sampling the images.
+    :return: the number of images in the manifest.
+    """
+    if shard_boundaries is None:
+        shard_boundaries = find_camera_boundaries(s3_client, bucket)
+    boundaries = [None] + sorted(shard_boundaries) + [None]
+    shards = list(zip(boundaries[:-1], boundaries[1:]))
+    logger.info("Listing bucket {} in {} shards".format(bucket, len(shards)))
+    lines = queue.Queue(maxsize=queue_depth)
+    cancelled = threading.Event()
+
+    def put_line(line):
+        while not cancelled.is_set():
+            try:
+                lines.put(line, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def manifest_line(key):
+        return json.dumps({"source-ref": "s3://{}/{}".format(bucket, key)}) + "\n"
+
+    def list_shard(start_after, end_at):
+        try:
+            for obj in get_matching_s3_objects_in_range(s3_client, bucket, start_after, end_at, suffixes):
+                if cancelled.is_set():
+                    return
+                put_line(manifest_line(obj["Key"]) if scheduler is None else obj)
+        finally:
+            put_line(_END_OF_SHARD)
+
+    image_count = 0
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='manifest-shard') as executor:
+        listings = [executor.submit(list_shard, start_after, end_at) for start_after, end_at in shards]
+        try:
+            with S3MultipartWriter(s3_client, bucket, manifest_key) as writer:
+                finished_shards = 0
+                while finished_shards < len(shards):
+                    line = lines.get()
+                    if line is _END_OF_SHARD:
+                        finished_shards += 1
+                        continue
+                    if scheduler is not None:
+                        # an object to schedule, rather than a line
+                        scheduler.add(line["Key"], get_camera_name(line["Key"]), line["LastModified"].timestamp())
+                        continue
+                    writer.write(line)
+                    image_count += 1
+                for listing in listings:
+                    listing.result()
+                if scheduler is not None:
+                    for key in scheduler.drain():
+                        writer.write(manifest_line(key))
+                        image_count += 1
+        finally:
+            cancelled.set()
+    metrics.increment("manifest_entries", image_count)
+    if scheduler is not None:
+        metrics.increment("manifest_sampled_out", scheduler.sampled_out_count)
+        metrics.increment("manifest_capped", scheduler.capped_count)
+    return image_count
+
+
+def iter_labeling_jobs(sagemaker_client, project_prefix):
+    """
+    Generate the summaries of the project's labeling jobs, newest first, a page at a time.
+    :param sagemaker_client: Pass through the boto3 sagemaker client
+    :param project_prefix: Only fetch jobs whose name contains the project prefix.
+    """
+    paginator = sagemaker_client.get_paginator("list_labeling_jobs")
+    for page in paginator.paginate(SortBy='CreationTime', SortOrder='Descending', NameContains=project_prefix):
+        for job in page['LabelingJobSummaryList']:
+            yield job
+
+
+def get_job_state_pointer_key(project_prefix):
+    """The key of the job state index item pointing at the project's latest labeling job."""
+    return "{}#latest".format(project_prefix)
+
+
+def get_latest_job_from_index(dynamodb_client, table_name, sagemaker_client, project_prefix):
+    """
+    Looks up the project's latest labeling job through the job state index, then reads its current state
+    with describe_labeling_job.
+    :return: the job, in the shape of a list_labeling_jobs summary, or None if the index has no latest job.
+    """
+    response = dynamodb_client.get_item(
+        TableName=table_name,
+        Key={'LabelingJobArn': {'S': get_job_state_pointer_key(project_prefix)}},
+        ConsistentRead=True
+    )
+    if 'Item' not in response:
+        logger.info("No latest job in job state index {}, listing labeling jobs".format(table_name))
+        return None
+    latest_job_name = response['Item']['LatestLabelingJobName']['S']
+    try:
+        job = sagemaker_client.describe_labeling_job(LabelingJobName=latest_job_name)
+    except sagemaker_client.exceptions.ResourceNotFound:
+        logger.info("Latest job {} from job state index not found, listing labeling jobs".format(latest_job_name))
+        return None
+    job['WorkteamArn'] = job['HumanTaskConfig']['WorkteamArn']
+    logger.info("Latest job from job state index: {}, status={}".format(latest_job_name, job['LabelingJobStatus']))
+    return job
+
+
+def record_new_job_in_index(dynamodb_client, table_name, project_prefix, job_name, job_arn):
+    """
+    Adds a newly created labeling job to the job state index, and points the project's latest job at it.
+    """
+    dynamodb_client.put_item(TableName=table_name, Item={
+        'LabelingJobArn': {'S': job_arn},
+        'LabelingJobName': {'S': job_name},
+        'LabelingJobStatus': {'S': 'InProgress'},
+    })
+    dynamodb_client.put_item(TableName=table_name, Item={
+        'LabelingJobArn': {'S': get_job_state_pointer_key(project_prefix)},
+        'LatestLabelingJobArn': {'S': job_arn},
+        'LatestLabelingJobName': {'S': job_name},
+    })
+
+
+def split_s3_uri(s3_uri):
+    """
+    Splits s3://bucket/key into (bucket, key).
+    """
+    bucket, _, key = s3_uri[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def iter_manifest_lines(s3_client, manifest_s3_uri):
+    """
+    Generate the raw lines of a JSON lines manifest, streamed from S3 a line at a time so
+    multi-GB manifests are never held in memory. Blank lines are skipped.
+    :param s3_client: Pass through the boto3 s3 client
+    :param manifest_s3_uri: s3:// URI of the manifest.
+    """
+    bucket, key = split_s3_uri(manifest_s3_uri)
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    except s3_client.exceptions.NoSuchKey:
+        logger.info("No manifest found at {}".format(manifest_s3_uri))
+        return
+    for line in body.iter_lines():
+        if line.strip():
+            yield line
+
+
+def iter_manifest_entries(s3_client, manifest_s3_uri):
+    """
+    Generate the entries of a JSON lines manifest, see iter_manifest_lines.
+    :return: (raw line, parsed entry) tuples.
+    """
+    for line in iter_manifest_lines(s3_client, manifest_s3_uri):
+        yield line, json.loads(line)
+
+
+#a source-ref that is the first key of its line, without escapes, read without parsing the line
+_LEADING_SOURCE_REF = re.compile(rb'\s*\{\s*"source-ref"\s*:\s*"([^"\\]*)"')
+
+
+def source_ref_digest(line, entry=None):
+    """
+    16 byte digest of the source-ref of a manifest line, the same whether or not the line is already parsed.
+    :param entry: the parsed line, if it is, otherwise it is only parsed when the source-ref isn't its first key.
+    """
+    match = _LEADING_SOURCE_REF.match(line)
+    source_ref = match.group(1) if match else (entry if entry is not None else json.loads(line))["source-ref"].encode("utf-8")
+    return hashlib.blake2b(source_ref, digest_size=16).digest()
+
+
+def classify_manifest_entry(entry, label_attribute_name):
+    """
+    Works out the state of one line of a Ground Truth output manifest.
+    :return: "labeled", "failed" or "unlabeled".
+    """
+    metadata = entry.get("{}-metadata".format(label_attribute_name), {})
+    if "failure-reason" in metadata:
+        return "failed"
+    if label_attribute_name in entry:
+        return "labeled"
+    return "unlabeled"
+
+
+class BloomFilter(object):
+    """Useage:
+        bloom = BloomFilter(size_bytes=16 * 1024 * 1024)
+        maybe_seen = bloom.add_batch(digests)
+
+    Set membership in a fixed size bit array, whatever the number of items added. An item reported as not added
+    before never was, one reported as added before may be a false positive, about 1% of the time with the default
+    7 hashes while under 1 item per 10 bits. Items are 16 byte digests, whose two halves seed the hashes, added a
+    batch at a time with NumPy.
+    """
+
+    def __init__(self, size_bytes=16 * 1024 * 1024, hash_count=7):
+        self.bit_count = np.uint64(size_bytes * 8)
+        self.hash_count = hash_count
+        self._bits = np.zeros(size_bytes, dtype=np.uint8)
+
+    def add_batch(self, digests):
+        """
+        Adds a batch of digests. Copies of a digest within the batch are all reported as not added before.
+        :param digests: list of 16 byte digests.
+        :return: bool array, True where the digest may have been added before.
+        """
+        halves = np.frombuffer(b"".join(digests), dtype="<u8").reshape(-1, 2)
+        first = halves[:, 0]
+        second = halves[:, 1] | np.uint64(1)
+        seen = np.ones(len(halves), dtype=bool)
+        with np.errstate(over="ignore"):
+            for index in range(self.hash_count):
+                bits = (first + np.uint64(index) * second) % self.bit_count
+                positions = (bits >> np.uint64(3)).astype(np.intp)
+                masks = np.left_shift(1, (bits & np.uint64(7)).astype(np.uint8)).astype(np.uint8)
+                seen &= (self._bits[positions] & masks) != 0
+                np.bitwise_or.at(self._bits, positions, masks)
+        return seen
+
+
+def entry_precedence(entry, label_attribute_name):
+    """
+    Orders copies of the same source-ref, the greater wins: a labeled copy over an unlabeled or failed one, then
+    the most recently labeled, by the creation-date of its label.
+    """
+    metadata = entry.get("{}-metadata".format(label_attribute_name), {})
+    labeled = classify_manifest_entry(entry, label_attribute_name) == "labeled"
+    return (labeled, metadata.get("creation-date", "") if labeled else "")
+
+
+def compact_manifests(s3_client, output_manifest_s3_uri, labeled_manifest_s3_uri, remaining_manifest_s3_uri, label_attribute_name,
+                      bloom_bytes=16 * 1024 * 1024, scan_batch_size=65536):
+    """
+    Splits a prior job's output manifest into a consolidated labeled dataset and a compact manifest of the
+    work that remains, so chained jobs stop re-reading every object labeled by the jobs before them.
+    Both manifests are streamed in and out a line at a time. Entries are deduplicated by source-ref, whichever
+    manifest and order they are read in, a labeled copy wins over an unlabeled or failed one, and of the labeled
+    copies the most recently labeled, see entry_precedence, the first read winning a tie. Labeled entries from the
+    output manifest are written first, then those from the existing consolidated labeled dataset, which is
+    rewritten in place. Unlabeled and failed entries become bare source-refs in the remaining manifest, so they are
+    labeled afresh.
+    Deduplication reads the manifests up to three times. The first pass runs every source-ref through a BloomFilter
+    of bloom_bytes, keeping a digest only of those it may have seen before. When there are any, the second pass
+    picks the copy of each that wins, and the last writes the manifests. Memory is therefore the filter plus a
+    digest, the precedence and the position of the winning copy per repeated source-ref and per false positive,
+    about 1% of the entries up to 13 million entries with the default 16MB, rather than a digest per entry.
+    :param s3_client: Pass through the boto3 s3 client
+    :param output_manifest_s3_uri: s3:// URI of the prior job's output manifest.
+    :param labeled_manifest_s3_uri: s3:// URI of the consolidated labeled dataset, read then rewritten.
+    :param remaining_manifest_s3_uri: s3:// URI to write the manifest of the work remaining to.
+    :param label_attribute_name: the LabelAttributeName of the jobs in the chain.
+    :param bloom_bytes: size of the BloomFilter of the first pass.
+    :param scan_batch_size: the number of source-ref digests added to the filter at once.
+    :return: dict of entry counts - labeled, unlabeled, failed and duplicates.
+    """
+    counts = {"labeled": 0, "unlabeled": 0, "failed": 0, "duplicates": 0}
+    manifest_s3_uris = (output_manifest_s3_uri, labeled_manifest_s3_uri)
+
+    # digests of the source-refs that may be repeated, every repeat is here along with the filter's false positives
+    repeated = set()
+    bloom = BloomFilter(bloom_bytes)
+
+    def scan(batch):
+        # the filter only compares across batches, repeats within one are found here
+        batch_digests = set()
+        for digest, maybe_seen in zip(batch, bloom.add_batch(batch)):
+            if maybe_seen or digest in batch_digests:
+                repeated.add(digest)
+            batch_digests.add(digest)
+
+    with metrics.timer("manifest_dedup_scan"):
+        batch = []
+        for manifest_s3_uri in manifest_s3_uris:
+            for line in iter_manifest_lines(s3_client, manifest_s3_uri):
+                batch.append(source_ref_digest(line))
+                if len(batch) == scan_batch_size:
+                    scan(batch)
+                    batch = []
+        if batch:
+            scan(batch)
+    del bloom
+    logger.info("{} source-refs may be repeated across the manifests".format(len(repeated)))
+
+    def iter_numbered_entries():
+        """(position across both manifests, source-ref digest, raw line, whether it is from the output manifest) of every entry."""
+        position = 0
+        for manifest_s3_uri in manifest_s3_uris:
+            for line in iter_manifest_lines(s3_client, manifest_s3_uri):
+                digest = source_ref_digest(line)
+                yield position, digest, line, manifest_s3_uri == output_manifest_s3_uri
+                position += 1
+
+    # digest -> (precedence, position) of the copy that wins, of each repeated source-ref
+    winners = {}
+    if repeated:
+        with metrics.timer("manifest_dedup_rank"):
+            for position, digest, line, _ in iter_numbered_entries():
+                if digest in repeated:
+                    precedence = entry_precedence(json.loads(line), label_attribute_name)
+                    if digest not in winners or precedence > winners[digest][0]:
+                        winners[digest] = (precedence, position)
+
+    labeled_bucket, labeled_key = split_s3_uri(labeled_manifest_s3_uri)
+    remaining_bucket, remaining_key = split_s3_uri(remaining_manifest_s3_uri)
+    # neither writer makes its object visible until closed, after the old consolidated dataset is read in full
+    with S3MultipartWriter(s3_client, labeled_bucket, labeled_key) as labeled_writer, \
+            S3MultipartWriter(s3_client, remaining_bucket, remaining_key) as remaining_writer:
+        for position, digest, line, from_output_manifest in iter_numbered_entries():
+            if digest in winners and winners[digest][1] != position:
+                counts["duplicates"] += 1
+                continue
+            if not from_output_manifest:
+                counts["labeled"] += 1
+                labeled_writer.write(line.decode("utf-8") + "\n")
+                continue
+            entry = json.loads(line)
+            state = classify_manifest_entry(entry, label_attribute_name)
+            counts[state] += 1
+            if state == "labeled":
+                labeled_writer.write(line.decode("utf-8") + "\n")
+            else:
+                remaining_writer.write(json.dumps({"source-ref": entry["source-ref"]}) + "\n")
+    for state, count in counts.items():
+        metrics.increment("manifest_entries_{}".format(state), count)
+    return counts
+
+
 if __name__ == "__main__":
     logger.debug("-- START groundtruth script.")
     parser = argparse.ArgumentParser()
@@ -115,13 +644,16 @@ if __name__ == "__main__":
     parser.add_argument("--sns-topic-arn-streaming-labeling", type=str, required=True)
     parser.add_argument("--groundtruth-execution-role-arn", type=str, required=True)
     parser.add_argument("--groundtruth-private-workforce-arn", type=str)
+    parser.add_argument("--manifest-workers", type=int, default=8)
+    parser.add_argument("--job-state-table", type=str, help="DynamoDB table indexing the state of the project's labeling jobs")
+    parser.add_argument("--metrics-format", type=str, choices=OUTPUT_FORMATS, default="emf", help="Write stage metrics as CloudWatch EMF or plain JSON lines")
+    parser.add_argument("--metrics-interval", type=int, default=60, help="Seconds between metrics flushes")
+    parser.add_argument("--task-policy", type=str, choices=["adaptive", "fixed"], default="adaptive", help="Size MaxConcurrentTaskCount and the task time limits of chained jobs from the prior job's throughput, or keep the defaults")
+    parser.add_argument("--schedule", type=str, help='JSON order and sampling of the images in a new job\'s input manifest, eg {"order": "newest-first", "per_window": 1000}, off to list them as they are')
+    parser.add_argument("--compact-chain-manifest", type=str, choices=["on", "off"], default="off", help="on to start chained jobs from a compacted manifest of the remaining work, rather than the prior job's full output manifest")
 
     args = parser.parse_args()
 
-    base_dir = "/opt/ml/processing"
-    localGroundTruthPath = f"{base_dir}/groundtruth/"
-    pathlib.Path(localGroundTruthPath).mkdir(parents=True, exist_ok=True)
-    
     project_friendly_name = args.project_friendly_name
     project_prefix = args.project_prefix
     region = args.region
@@ -133,6 +665,11 @@ if __name__ == "__main__":
     groundtruth_execution_role_arn = args.groundtruth_execution_role_arn
     groundtruth_private_workforce_arn = args.groundtruth_private_workforce_arn
 
+    metrics = StageMetrics(dimensions={'Project': project_prefix, 'Step': 'GroundTruthChainJob'}, output_format=args.metrics_format, flush_interval=args.metrics_interval)
+    #this step has no single exit, write whatever was collected however it ends
+    atexit.register(metrics.flush)
+    log_startup(script_started, metrics)
+
     USING_PRIVATE_WORKFORCE = True
     USE_AUTO_LABELING = False
 
@@ -140,7 +677,7 @@ if __name__ == "__main__":
     boto_session = boto3.Session(region_name=region)
     sagemaker_client = boto_session.client("sagemaker")
     runtime_client = boto_session.client("sagemaker-runtime")
-    s3_client = boto_session.client("s3")
+    s3_client = boto_session.client("s3", config=Config(max_pool_connections=max(10, args.manifest_workers)))
         
     bucket_region = s3_client.head_bucket(Bucket=s3bucketname_groundtruth_job_input)["ResponseMetadata"]["HTTPHeaders"][
         "x-amz-bucket-region"
@@ -150,14 +687,14 @@ if __name__ == "__main__":
     ), "Your S3 bucket {} and this script need to be in the same region.".format(s3bucketname_groundtruth_job_input)
 
     
-    # 2. Find existing GroundTruth labeling Jobs    
-    counter=0
-    labelingjobs = sagemaker_client.list_labeling_jobs(
-        SortBy='CreationTime',
-        SortOrder='Descending',
-        NameContains=project_prefix,
-        MaxResults=10
-    )
+    # 2. Find existing GroundTruth labeling Jobs, newest first
+    labelingjobs = iter_labeling_jobs(sagemaker_client, project_prefix)
+    if args.job_state_table:
+        dynamodb_client = boto_session.client("dynamodb")
+        l_latestLabelingJob = get_latest_job_from_index(dynamodb_client, args.job_state_table, sagemaker_client, project_prefix)
+        if l_latestLabelingJob is not None and l_latestLabelingJob['LabelingJobStatus'] != "Failed":
+            #The latest job decides the action on its own, only failed jobs send us searching back through older jobs
+            labelingjobs = [l_latestLabelingJob]
 
     l_job_action = "NO_ACTION"
     l_priorLabelingJobName = None
@@ -165,39 +702,46 @@ if __name__ == "__main__":
     l_priorLabelingJobOutputManifestS3Uri = None
     l_priorLabelingWorkteamArn = None
     l_priorCreationDateTime = None
+    l_priorObservation = None
+    l_pendingItems = 0
     l_new_job_manifest_name = None
 
+    l_jobs_found=False
     l_valid_job_found=False
-    if len(labelingjobs['LabelingJobSummaryList'])>0:
+    for jobs in labelingjobs:
+        l_jobs_found=True
         l_job_action="INVALID_JOBS"
-        for jobs in labelingjobs['LabelingJobSummaryList']:
-            if (jobs['LabelingJobStatus']=="InProgress"):
-                print("There is already a job (assumed streaming labeling job) in progress, there is nothing to do. Complete this pipeline step")
-                l_job_action = "NO_ACTION"
-                l_valid_job_found=True
-                break
-            assert (jobs['LabelingJobStatus']!="Stopping"
-            ), "Please wait for job to stop first"
-            if (jobs['LabelingJobStatus']=="Completed" or jobs['LabelingJobStatus']=="Stopped"):
-                #use this job for chaining
-                l_valid_job_found=True
-                l_job_action = "NEW_CHAIN_JOB"
-                l_priorLabelingJobName = labelingjobs['LabelingJobSummaryList'][counter]['LabelingJobName']
-                l_priorLabelingJobArn = labelingjobs['LabelingJobSummaryList'][counter]['LabelingJobArn']
-                l_priorLabelingJobOutputManifestS3Uri = labelingjobs['LabelingJobSummaryList'][counter]['LabelingJobOutput']['OutputDatasetS3Uri']
-                l_priorLabelingWorkteamArn = labelingjobs['LabelingJobSummaryList'][counter]['WorkteamArn']
-                l_priorCreationDateTime = labelingjobs['LabelingJobSummaryList'][counter]['CreationTime']
-
-                logger.info('Job to clone from: {}'.format(l_priorLabelingJobName))
-                logger.info('Total Labeled: {}'.format(labelingjobs['LabelingJobSummaryList'][counter]['LabelCounters']['TotalLabeled']))
-                logger.info('Total Unlabeled: {}'.format(labelingjobs['LabelingJobSummaryList'][counter]['LabelCounters']['Unlabeled']))
-                logger.info('JobOutputManifest: {}'.format(l_priorLabelingJobOutputManifestS3Uri))
-                logger.info('WorkTeamArn: {}'.format(l_priorLabelingWorkteamArn))
-                break
-            counter+=1
+        if (jobs['LabelingJobStatus']=="InProgress"):
+            print("There is already a job (assumed streaming labeling job) in progress, there is nothing to do. Complete this pipeline step")
+            l_job_action = "NO_ACTION"
+            l_valid_job_found=True
+            break
+        assert (jobs['LabelingJobStatus']!="Stopping"
+        ), "Please wait for job to stop first"
+        if (jobs['LabelingJobStatus']=="Completed" or jobs['LabelingJobStatus']=="Stopped"):
+            #use this job for chaining
+            l_valid_job_found=True
+            l_job_action = "NEW_CHAIN_JOB"
+            l_priorLabelingJobName = jobs['LabelingJobName']
+            l_priorLabelingJobArn = jobs['LabelingJobArn']
+            l_priorLabelingJobOutputManifestS3Uri = jobs['LabelingJobOutput']['OutputDatasetS3Uri']
+            l_priorLabelingWorkteamArn = jobs['WorkteamArn']
+            l_priorCreationDateTime = jobs['CreationTime']
+            if 'HumanTaskConfig' not in jobs and args.task_policy == "adaptive":
+                #list_labeling_jobs summaries don't hold the task settings the job ran with
+                jobs = sagemaker_client.describe_labeling_job(LabelingJobName=l_priorLabelingJobName)
+            l_priorObservation = observation_from_job(jobs)
+            l_pendingItems = l_priorObservation.unlabeled + l_priorObservation.failed
+
+            logger.info('Job to clone from: {}'.format(l_priorLabelingJobName))
+            logger.info('Total Labeled: {}'.format(jobs['LabelCounters']['TotalLabeled']))
+            logger.info('Total Unlabeled: {}'.format(jobs['LabelCounters']['Unlabeled']))
+            logger.info('JobOutputManifest: {}'.format(l_priorLabelingJobOutputManifestS3Uri))
+            logger.info('WorkTeamArn: {}'.format(l_priorLabelingWorkteamArn))
+            break
 
     if not l_valid_job_found:
-        if len(labelingjobs['LabelingJobSummaryList'])==0:
+        if not l_jobs_found:
             logger.info("No prior labeling job with preject_prefix={} found. Assuming this is first time and need to create first job.".format(project_prefix))
             l_job_action = "NEW_JOB"
         else:
@@ -205,16 +749,17 @@ if __name__ == "__main__":
             l_job_action = "NEW_JOB"
 
         #As this is our first time running the job we need to generate a input.manifest, from the current images put in the streaminglabeling-input bucket
-        result = get_matching_s3_keys(s3_client, s3bucketname_groundtruth_job_input, prefix="", suffixes=["png","jpg","jpeg"])
-            
-        #Create and upload the input manifest.
+        #Create and upload the input manifest, streamed straight to s3.
         l_new_job_manifest_name = "input.manifest"
-        with open("{}{}".format(localGroundTruthPath, l_new_job_manifest_name), "w") as f:
-            for r in result:
-                img_path = "s3://{}/{}".format(s3bucketname_groundtruth_job_input, r)
-                f.write('{"source-ref": "' + img_path + '"}\n')
-        s3_client.upload_file("{}{}".format(localGroundTruthPath, l_new_job_manifest_name), s3bucketname_groundtruth_job_input, l_new_job_manifest_name)
-        print('input.manifest file generated and uploaded to s3')
+        scheduler = None
+        if args.schedule is not None and args.schedule != "off":
+            scheduler = WorkScheduler(load_schedule_policy(args.schedule))
+        image_count = build_input_manifest(s3_client, s3bucketname_groundtruth_job_input, l_new_job_manifest_name,
+                                           suffixes=["png","jpg","jpeg","webp"], max_workers=args.manifest_workers, scheduler=scheduler)
+        logger.info('input.manifest file of {} images generated and uploaded to s3'.format(image_count))
+        if scheduler is not None:
+            logger.info('Schedule {} left {} images out of the manifest, {} sampled out and {} over the per window cap'.format(
+                scheduler.policy, scheduler.sampled_out_count + scheduler.capped_count, scheduler.sampled_out_count, scheduler.capped_count))
 
 
     if l_job_action == "NEW_JOB" or l_job_action == "NEW_CHAIN_JOB":
@@ -230,9 +775,8 @@ if __name__ == "__main__":
 
         logger.info("Labels set: {}".format(CLASS_LIST))
         json_body = {"labels": [{"label": label} for label in CLASS_LIST]}
-        with open("{}class_labels.json".format(localGroundTruthPath), "w") as f:
-            json.dump(json_body, f)
-        s3_client.upload_file("{}class_labels.json".format(localGroundTruthPath), s3bucketname_groundtruth_job_input, "class_labels.json")
+        #uploaded from memory, the step needs nothing written locally
+        s3_client.put_object(Bucket=s3bucketname_groundtruth_job_input, Key="class_labels.json", Body=json.dumps(json_body).encode("utf-8"))
         logger.info('class_labels.json file generated and uploaded to s3')
 
         new_job_name = None
@@ -276,8 +820,10 @@ if __name__ == "__main__":
         ]
 
         # We are going to use the template last uploaded to S3, we will update some dynamic settings, and prepare for use in this job.
-        update_instruction_template(s3_client, "{}instructions.html".format(localGroundTruthPath), s3bucketname_groundtruth_job_labelinginstructions, "instructions.html", CLASS_LIST, task_description, img_examples, test_template=True)
-        update_instruction_template(s3_client, "{}instructions.template".format(localGroundTruthPath), s3bucketname_groundtruth_job_labelinginstructions, "instructions.template", CLASS_LIST, task_description, img_examples, test_template=False)
+        # The template is downloaded once for both, and each is only uploaded if it has changed since the last job.
+        instruction_renderer = InstructionTemplateRenderer(s3_client, s3bucketname_groundtruth_job_labelinginstructions)
+        update_instruction_template(s3_client, s3bucketname_groundtruth_job_labelinginstructions, "instructions.html", CLASS_LIST, task_description, img_examples, test_template=True, renderer=instruction_renderer)
+        update_instruction_template(s3_client, s3bucketname_groundtruth_job_labelinginstructions, "instructions.template", CLASS_LIST, task_description, img_examples, test_template=False, renderer=instruction_renderer)
 
         # Specify ARNs for resources needed to run an image classification job.
         ac_arn_map = {
@@ -305,18 +851,25 @@ if __name__ == "__main__":
         )
         public_workteam_arn = "arn:aws:sagemaker:{}:394669845002:workteam/public-crowd/default".format(region)
 
+        # Feed work at the rate the workforce sustained on the job we chain from, see task_policy.py
+        task_settings = dict(DEFAULT_TASK_SETTINGS)
+        if args.task_policy == "adaptive" and l_priorObservation is not None:
+            task_settings = next_task_settings(l_priorObservation, l_pendingItems)
+            logger.info("Task settings from prior job ({} labeled, {} failed, {} unlabeled in {:.1f}h): {}".format(
+                l_priorObservation.labeled, l_priorObservation.failed, l_priorObservation.unlabeled,
+                l_priorObservation.elapsed_seconds / 3600.0, task_settings))
 
         human_task_config = {
             "AnnotationConsolidationConfig": {
                 "AnnotationConsolidationLambdaArn": acs_arn,
             },
             "PreHumanTaskLambdaArn": prehuman_arn,
-            "MaxConcurrentTaskCount": 1000,  # 200 images will be sent at a time to the workteam.
+            "MaxConcurrentTaskCount": task_settings["MaxConcurrentTaskCount"],  # Images sent at a time to the workteam, 1000 by default.
             "NumberOfHumanWorkersPerDataObject": 1,  # 3 separate workers will be required to label each image.
-            "TaskAvailabilityLifetimeInSeconds": 864000 ,  # Your worteam has 10 days to complete all pending tasks.
+            "TaskAvailabilityLifetimeInSeconds": task_settings["TaskAvailabilityLifetimeInSeconds"],  # Time the workteam has to pick up pending tasks, 10 days by default.
             "TaskDescription": task_description,
             "TaskKeywords": task_keywords,
-            "TaskTimeLimitInSeconds": 600,  # Each image must be labeled within 10 minutes.
+            "TaskTimeLimitInSeconds": task_settings["TaskTimeLimitInSeconds"],  # Time to label each image, 10 minutes by default.
             "TaskTitle": task_title,
             "UiConfig": {
                 "UiTemplateS3Uri": "s3://{}/instructions.template".format(s3bucketname_groundtruth_job_labelinginstructions),
@@ -355,6 +908,16 @@ if __name__ == "__main__":
         if l_job_action=="NEW_JOB":
             #If NEW_JOB, Point our ManifestS3Uri to our newly generated input.manifest
             l_manifestS3Uri="s3://{}/{}".format(s3bucketname_groundtruth_job_input, l_new_job_manifest_name)
+        elif args.compact_chain_manifest == "on":
+            #If NEW_CHAIN_JOB, compact the output of the last successful job so the new job is only given the work that remains
+            l_manifestS3Uri = "s3://{}/{}/manifests/{}-remaining.manifest".format(s3bucketname_groundtruth_job_output, project_prefix, new_job_name)
+            l_labeledManifestS3Uri = "s3://{}/{}/manifests/labeled.manifest".format(s3bucketname_groundtruth_job_output, project_prefix)
+            manifest_counts = compact_manifests(s3_client, l_priorLabelingJobOutputManifestS3Uri, l_labeledManifestS3Uri, l_manifestS3Uri, LabelAttributeName)
+            logger.info("Compacted manifest {}: {}".format(l_priorLabelingJobOutputManifestS3Uri, manifest_counts))
+            logger.info("Consolidated labeled dataset: {}".format(l_labeledManifestS3Uri))
+            if manifest_counts["unlabeled"] + manifest_counts["failed"] == 0:
+                #Nothing left to label, the new job is only fed by streaming
+                l_manifestS3Uri = None
         else:
             #If NEW_CHAIN_JOB, Point our Input ManifestS3Uri to the output of the last successful job to continue the chain
             l_manifestS3Uri="{}".format(l_priorLabelingJobOutputManifestS3Uri)
@@ -384,14 +947,19 @@ if __name__ == "__main__":
             "Tags": tags,
         }
 
+        if l_manifestS3Uri is None:
+            del ground_truth_request["InputConfig"]["DataSource"]["S3DataSource"]
+
         #Note: Automated labeling isn't supported for the Streaming Mode task type. You can't provide a value for the LabelingJobAlgorithmSpecificationArn field
         if USE_AUTO_LABELING:
             ground_truth_request["LabelingJobAlgorithmsConfig"] = {
                 "LabelingJobAlgorithmSpecificationArn": labeling_algorithm_specification_arn
             }
 
-        sagemaker_client.create_labeling_job(**ground_truth_request)
+        new_job_arn = sagemaker_client.create_labeling_job(**ground_truth_request)['LabelingJobArn']
         logger.info("New GroundTruth Job started.")
+        if args.job_state_table:
+            record_new_job_in_index(dynamodb_client, args.job_state_table, project_prefix, new_job_name, new_job_arn)
 
 
     else:
@@ -0,0 +1,60 @@
+"""Bounds the memory the feature engineering step holds, with a byte budget that throttles intake."""
+import threading
+
+MEGABYTE = 1024 * 1024
+
+
+class MemoryBudget(object):
+    """Useage:
+        budget = MemoryBudget(limit_bytes=512 * MEGABYTE)
+        if budget.acquire(obj['Size'], cancelled):
+            ...
+            budget.release(obj['Size'])
+
+    Counts the bytes of the images a process holds, blocking intake while taking in another image would go over the
+    limit until enough are released. An image larger than the whole limit is let in once nothing else is held, so it
+    is processed alone rather than never. A limit of 0 is unlimited.
+    """
+
+    def __init__(self, limit_bytes=0):
+        self.limit_bytes = limit_bytes
+        self.held_bytes = 0
+        self.peak_bytes = 0
+        self._released = threading.Condition()
+
+    def _fits(self, nbytes):
+        return not self.limit_bytes or self.held_bytes == 0 or self.held_bytes + nbytes <= self.limit_bytes
+
+    def _take(self, nbytes):
+        self.held_bytes += nbytes
+        self.peak_bytes = max(self.peak_bytes, self.held_bytes)
+
+    def try_acquire(self, nbytes):
+        """
+        Takes nbytes out of the budget if they fit without waiting.
+        :return: True if they were taken.
+        """
+        with self._released:
+            if not self._fits(nbytes):
+                return False
+            self._take(nbytes)
+            return True
+
+    def acquire(self, nbytes, cancelled=None):
+        """
+        Waits until nbytes fit in the budget and takes them, or until cancelled is set.
+        :param cancelled: optional threading.Event that abandons the wait.
+        :return: True if the bytes were taken.
+        """
+        with self._released:
+            while not self._fits(nbytes):
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                self._released.wait(timeout=0.5)
+            self._take(nbytes)
+            return True
+
+    def release(self, nbytes):
+        with self._released:
+            self.held_bytes -= nbytes
+            self._released.notify_all()
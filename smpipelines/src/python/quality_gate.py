@@ -0,0 +1,132 @@
+"""Quality gate for drop images - rejects truncated, blank, black, blurred and static frames before they reach labeling."""
+import json
+from collections import namedtuple
+
+import numpy as np
+
+#ITU-R 601 luma, as PIL's convert("L")
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+#side of the greyscale thumbnail consecutive frames are compared on
+THUMBNAIL_SIZE = 32
+
+QUARANTINE_PREFIX = "quarantine/"
+
+
+class QualityThresholds(namedtuple('QualityThresholds', ['min_brightness', 'max_brightness', 'min_contrast', 'min_sharpness',
+                                                         'min_frame_difference', 'downsample'])):
+    """
+    Limits a crop must be within to be sent for labeling, all on the 0-255 greyscale of the crop, downsampled by
+    taking every downsample'th pixel. A limit of 0 is not checked.
+    min_brightness, max_brightness: bounds on the mean, black and blown out frames fall outside them.
+    min_contrast: minimum standard deviation, blank frames fall below it.
+    min_sharpness: minimum variance of the Laplacian, blurred and out of focus frames fall below it.
+    min_frame_difference: minimum mean absolute difference from the camera's last accepted frame, a stalled or
+        static camera's frames fall below it.
+    """
+
+
+DEFAULT_QUALITY_THRESHOLDS = QualityThresholds(min_brightness=16, max_brightness=240, min_contrast=4, min_sharpness=5,
+                                               min_frame_difference=1, downsample=4)
+
+FrameQuality = namedtuple('FrameQuality', ['rejected', 'brightness', 'contrast', 'sharpness', 'thumbnail'])
+FrameQuality.__doc__ = """Quality of one crop - the reason it was rejected or None, its measures, and its thumbnail."""
+
+
+def load_quality_thresholds(quality_gate_json):
+    """
+    Parses the quality thresholds, eg '{"min_brightness": 30, "min_sharpness": 20}', any missing are the defaults.
+    :return: QualityThresholds
+    """
+    return DEFAULT_QUALITY_THRESHOLDS._replace(**json.loads(quality_gate_json or "{}"))
+
+
+def is_truncated(image_bytes, image_format):
+    """
+    True if an encoded JPEG or PNG is missing its end marker - PIL only loads these because the script sets
+    LOAD_TRUNCATED_IMAGES, filling the missing rows with grey.
+    """
+    if image_format == "JPEG":
+        return not image_bytes.rstrip(b"\x00").endswith(b"\xff\xd9")
+    if image_format == "PNG":
+        return b"IEND" not in image_bytes[-16:]
+    return False
+
+
+def to_greyscale(frames, downsample=1):
+    """
+    :param frames: uint8 array of stacked frames, (n, height, width) greyscale or (n, height, width, bands).
+    :return: float32 (n, height / downsample, width / downsample) greyscale of the frames.
+    """
+    frames = frames[:, ::downsample, ::downsample]
+    if frames.ndim == 3:
+        return frames.astype(np.float32)
+    return frames[..., :3].astype(np.float32) @ LUMA_WEIGHTS if frames.shape[-1] >= 3 else frames[..., 0].astype(np.float32)
+
+
+def measure_frames(frames, thresholds):
+    """
+    Measures a stack of crops all at once and checks them against the thresholds, bar min_frame_difference, which
+    needs the camera's previous frame, see QualityGate.
+    :param frames: uint8 array of stacked crops, see to_greyscale.
+    :return: list of FrameQuality, one per frame.
+    """
+    grey = to_greyscale(frames, max(1, thresholds.downsample))
+    brightness = grey.mean(axis=(1, 2))
+    contrast = grey.std(axis=(1, 2))
+    if grey.shape[1] > 2 and grey.shape[2] > 2:
+        laplacian = (4 * grey[:, 1:-1, 1:-1] - grey[:, :-2, 1:-1] - grey[:, 2:, 1:-1] - grey[:, 1:-1, :-2] - grey[:, 1:-1, 2:])
+        sharpness = laplacian.var(axis=(1, 2))
+    else:
+        sharpness = np.zeros(len(grey), dtype=np.float32)
+    rows = np.linspace(0, grey.shape[1] - 1, THUMBNAIL_SIZE).astype(np.intp)
+    columns = np.linspace(0, grey.shape[2] - 1, THUMBNAIL_SIZE).astype(np.intp)
+    thumbnails = grey[:, rows][:, :, columns].astype(np.uint8)
+
+    qualities = []
+    for index in range(len(grey)):
+        rejected = None
+        if thresholds.min_brightness and brightness[index] < thresholds.min_brightness:
+            rejected = "dark"
+        elif thresholds.max_brightness and brightness[index] > thresholds.max_brightness:
+            rejected = "bright"
+        elif thresholds.min_contrast and contrast[index] < thresholds.min_contrast:
+            rejected = "blank"
+        elif thresholds.min_sharpness and sharpness[index] < thresholds.min_sharpness:
+            rejected = "blurred"
+        qualities.append(FrameQuality(rejected, float(brightness[index]), float(contrast[index]), float(sharpness[index]), thumbnails[index]))
+    return qualities
+
+
+def frame_difference(thumbnail, previous_thumbnail):
+    """Mean absolute difference of two thumbnails, 0-255."""
+    return float(np.abs(thumbnail.astype(np.int16) - previous_thumbnail.astype(np.int16)).mean())
+
+
+class QualityGate(object):
+    """Useage:
+        gate = QualityGate(load_quality_thresholds('{"min_sharpness": 20}'))
+        qualities = measure_frames(stacked_crops, gate.thresholds)
+        reason = gate.review(camera_name, qualities[0])
+
+    Makes the final call on each crop, in the order the camera took them. Crops measure_frames rejected stay
+    rejected, any other is rejected as static when it barely differs from the last crop accepted from the same
+    camera. With the drop bucket sharded, consecutive frames are those of the same shard.
+    """
+
+    def __init__(self, thresholds=DEFAULT_QUALITY_THRESHOLDS):
+        self.thresholds = thresholds
+        self._last_thumbnails = {}
+
+    def review(self, camera_name, quality):
+        """
+        :return: the reason the crop is rejected, or None if it can be sent for labeling.
+        """
+        if quality.rejected is not None:
+            return quality.rejected
+        previous_thumbnail = self._last_thumbnails.get(camera_name)
+        if (self.thresholds.min_frame_difference and previous_thumbnail is not None
+                and frame_difference(quality.thumbnail, previous_thumbnail) < self.thresholds.min_frame_difference):
+            return "static"
+        self._last_thumbnails[camera_name] = quality.thumbnail
+        return None
@@ -0,0 +1,225 @@
+"""Timers, counters and latency histograms for the pipeline step scripts, flushed as structured JSON or CloudWatch EMF lines."""
+import bisect
+import contextlib
+import json
+import sys
+import threading
+import time
+
+#upper bounds of the latency buckets in seconds, 10 per decade from 10us to 1000s
+LATENCY_BUCKETS = [10 ** (exponent / 10.0) for exponent in range(-50, 31)]
+
+OUTPUT_FORMATS = ["emf", "json", "off"]
+
+
+class LatencyHistogram(object):
+    """Useage:
+        histogram = LatencyHistogram()
+        histogram.record(0.012, nbytes=153000)
+        histogram.percentile(99)
+
+    Counts latencies into fixed logarithmic buckets, so recording is a binary search and an increment, and
+    histograms from other threads or processes merge by adding their counts.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.nbytes = 0
+
+    def record(self, seconds, nbytes=0):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.nbytes += nbytes
+
+    def merge(self, state):
+        """Adds in the counts of another histogram, as returned by to_dict."""
+        if not state['count']:
+            return
+        for index, bucket_count in enumerate(state['counts']):
+            self.counts[index] += bucket_count
+        self.count += state['count']
+        self.total += state['total']
+        self.min = state['min'] if self.min is None else min(self.min, state['min'])
+        self.max = state['max'] if self.max is None else max(self.max, state['max'])
+        self.nbytes += state['nbytes']
+
+    def percentile(self, percentile):
+        """
+        Estimates a percentile as the upper bound of the bucket it falls in, never more than the largest latency seen.
+        :return: the latency in seconds, or None when nothing has been recorded.
+        """
+        if not self.count:
+            return None
+        rank = percentile / 100.0 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                upper_bound = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.max
+                return min(upper_bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'counts': list(self.counts), 'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max, 'nbytes': self.nbytes}
+
+    def buckets_ms(self):
+        """The non empty buckets, keyed by their upper bound in milliseconds."""
+        return {"{:.4g}".format(LATENCY_BUCKETS[index] * 1000 if index < len(LATENCY_BUCKETS) else float("inf")): bucket_count
+                for index, bucket_count in enumerate(self.counts) if bucket_count}
+
+
+class _Timing(object):
+    def __init__(self):
+        self.nbytes = 0
+
+
+class StageMetrics(object):
+    """Useage:
+        metrics = StageMetrics(dimensions={'Project': 'myproject', 'Step': 'FeatureEngineering'}, output_format='emf')
+        with metrics.timer('get') as timing:
+            data = s3_client.get_object(...)['Body'].read()
+            timing.nbytes = len(data)
+        metrics.increment('duplicates')
+        ...
+        metrics.flush()
+
+    Aggregates the latency of each stage into a LatencyHistogram, and counters, from any number of threads. Every
+    flush_interval seconds, checked as metrics are recorded, one line per stage and one for the counters is written
+    to the stream, as CloudWatch embedded metric format (EMF) or plain JSON, then the interval starts afresh.
+    With output_format "off" metrics are only collected, for snapshot and merge.
+    """
+
+    def __init__(self, namespace="GroundTruthStreamingLabeling", dimensions=None, output_format="emf", flush_interval=60, stream=None):
+        assert output_format in OUTPUT_FORMATS, "output_format must be one of {}".format(", ".join(OUTPUT_FORMATS))
+        self.namespace = namespace
+        self.dimensions = dict(dimensions or {})
+        self.output_format = output_format
+        self.flush_interval = flush_interval
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._histograms = {}
+        self._counters = {}
+        self._interval_start = time.time()
+
+    @contextlib.contextmanager
+    def timer(self, stage, nbytes=0):
+        """Times the with block as one item through stage, set nbytes on the timing once the size is known."""
+        timing = _Timing()
+        timing.nbytes = nbytes
+        started = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            self.record(stage, time.perf_counter() - started, timing.nbytes)
+
+    def time_each(self, stage, iterable):
+        """Generate the items of iterable, timing how long each takes to produce, such as the pages of a listing."""
+        items = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            self.record(stage, time.perf_counter() - started)
+            yield item
+
+    def record(self, stage, seconds, nbytes=0):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = LatencyHistogram()
+            histogram.record(seconds, nbytes)
+        self._flush_if_due()
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+        self._flush_if_due()
+
+    def snapshot(self):
+        """
+        Takes the metrics collected so far, leaving this collector empty.
+        :return: picklable dict, see merge.
+        """
+        with self._lock:
+            state = {'histograms': {stage: histogram.to_dict() for stage, histogram in self._histograms.items()},
+                     'counters': dict(self._counters)}
+            self._histograms = {}
+            self._counters = {}
+        return state
+
+    def merge(self, state):
+        """Adds in metrics collected elsewhere, such as in a worker process, as returned by snapshot."""
+        with self._lock:
+            for stage, histogram_state in state['histograms'].items():
+                histogram = self._histograms.get(stage)
+                if histogram is None:
+                    histogram = self._histograms[stage] = LatencyHistogram()
+                histogram.merge(histogram_state)
+            for counter, amount in state['counters'].items():
+                self._counters[counter] = self._counters.get(counter, 0) + amount
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        if self.output_format != "off" and time.time() - self._interval_start >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes the metrics of the interval so far and starts a new interval."""
+        if self.output_format == "off":
+            return
+        with self._lock:
+            histograms, counters, interval_start = self._histograms, self._counters, self._interval_start
+            self._reset()
+        interval = max(time.time() - interval_start, 1e-9)
+        lines = [self._stage_line(stage, histogram, interval) for stage, histogram in sorted(histograms.items())]
+        if counters:
+            lines.append(self._counters_line(counters, interval))
+        if lines:
+            stream = self.stream or sys.stdout
+            with self._lock:
+                stream.write("".join(json.dumps(line) + "\n" for line in lines))
+                stream.flush()
+
+    def _stage_line(self, stage, histogram, interval):
+        values = {
+            'Count': histogram.count,
+            'ItemsPerSecond': round(histogram.count / interval, 3),
+            'Bytes': histogram.nbytes,
+            'LatencyP50': round(histogram.percentile(50) * 1000, 3),
+            'LatencyP99': round(histogram.percentile(99) * 1000, 3),
+            'LatencyMax': round(histogram.max * 1000, 3),
+        }
+        units = {'Count': "Count", 'ItemsPerSecond': "Count/Second", 'Bytes': "Bytes",
+                 'LatencyP50': "Milliseconds", 'LatencyP99': "Milliseconds", 'LatencyMax': "Milliseconds"}
+        properties = {'Stage': stage, 'IntervalSeconds': round(interval, 3), 'LatencyHistogramMs': histogram.buckets_ms()}
+        return self._line(values, units, properties, ["Stage"])
+
+    def _counters_line(self, counters, interval):
+        return self._line(dict(counters), {counter: "Count" for counter in counters}, {'IntervalSeconds': round(interval, 3)}, [])
+
+    def _line(self, values, units, properties, extra_dimensions):
+        line = dict(self.dimensions)
+        line.update(properties)
+        line.update(values)
+        if self.output_format == "emf":
+            line['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(self.dimensions) + extra_dimensions],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in values],
+                }],
+            }
+        return line
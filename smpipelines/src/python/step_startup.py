@@ -0,0 +1,134 @@
+"""Startup of the pipeline step scripts - checks the declared dependency set is already installed, and measures how long startup takes."""
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger()
+
+REQUIREMENTS_FILE = "requirements.txt"
+
+#prebaked: the processing image must already have every dependency, install-missing: pip install only those it lacks
+DEPENDENCY_MODES = ["prebaked", "install-missing"]
+
+_REQUIREMENT = re.compile(r"^([A-Za-z0-9_.\-]+)\s*(?:>=\s*([0-9][0-9A-Za-z.]*))?$")
+
+
+def version_tuple(version):
+    """1.20.5 -> (1, 20, 5), ignoring any pre-release or local suffix."""
+    return tuple(int(part) for part in re.findall(r"\d+", version.split("+")[0])[:4])
+
+
+def installed_version(distribution_name):
+    """
+    :return: the installed version of a distribution, or None if it is not installed.
+    """
+    try:
+        from importlib import metadata
+        try:
+            return metadata.version(distribution_name)
+        except metadata.PackageNotFoundError:
+            return None
+    except ImportError:
+        # Python 3.7, as in the SKLearn processing image
+        import pkg_resources
+        try:
+            return pkg_resources.get_distribution(distribution_name).version
+        except pkg_resources.DistributionNotFound:
+            return None
+
+
+def read_requirements(path):
+    """
+    Reads a requirements file of bare names and name>=version lines.
+    :return: list of (requirement, distribution name, minimum version or None) tuples.
+    """
+    requirements = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            match = _REQUIREMENT.match(line)
+            assert match, "Unsupported requirement in {}: {}".format(path, line)
+            requirements.append((line, match.group(1), match.group(2)))
+    return requirements
+
+
+def find_requirements(script_file):
+    """The requirements file next to the script, or in the shared module directory the pipeline provides."""
+    for directory in [os.path.dirname(os.path.abspath(script_file)), "/opt/ml/processing/input/lib"]:
+        path = os.path.join(directory, REQUIREMENTS_FILE)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def missing_dependencies(requirements):
+    """
+    :return: the requirements that are not installed, or installed at too old a version.
+    """
+    missing = []
+    for requirement, name, minimum_version in requirements:
+        version = installed_version(name)
+        if version is None or (minimum_version and version_tuple(version) < version_tuple(minimum_version)):
+            missing.append(requirement)
+    return missing
+
+
+def check_dependencies(script_file, mode=None):
+    """
+    Checks the dependencies declared in requirements.txt are installed, before the script imports them. Nothing is
+    fetched from PyPI unless the SMP_DEPENDENCY_MODE environment variable, or mode, is install-missing, and then
+    only the missing dependencies are.
+    :param script_file: __file__ of the step script.
+    :param mode: one of DEPENDENCY_MODES, taken from SMP_DEPENDENCY_MODE by default, prebaked if unset.
+    """
+    mode = mode or os.environ.get("SMP_DEPENDENCY_MODE", "prebaked")
+    assert mode in DEPENDENCY_MODES, "SMP_DEPENDENCY_MODE must be one of {}".format(", ".join(DEPENDENCY_MODES))
+    path = find_requirements(script_file)
+    if path is None:
+        logger.warning("No %s found for %s, not checking dependencies", REQUIREMENTS_FILE, script_file)
+        return
+    missing = missing_dependencies(read_requirements(path))
+    if not missing:
+        return
+    if mode != "install-missing":
+        raise RuntimeError("Dependencies missing from the processing image: {}. Bake them into the image, or set "
+                           "SMP_DEPENDENCY_MODE=install-missing to pip install them at startup".format(", ".join(missing)))
+    logger.warning("Installing dependencies missing from the processing image: %s", ", ".join(missing))
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "--quiet"] + missing)
+
+
+def process_age():
+    """
+    :return: seconds since this process started, read from /proc, or None where there is no /proc.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # the fields after the command name, which may itself hold spaces, start at field 3 - starttime is field 22
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / float(os.sysconf("SC_CLK_TCK")))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def log_startup(script_started, metrics=None):
+    """
+    Logs how long the script took to get going, split into interpreter start and the script's own imports and setup.
+    :param script_started: time.perf_counter() taken on the script's first line.
+    :param metrics: optional StageMetrics to record the startup time into, as the startup stage.
+    :return: seconds from process start, or from the script's first line where that is unknown, to now.
+    """
+    script_seconds = time.perf_counter() - script_started
+    age = process_age()
+    total_seconds = max(age, script_seconds) if age is not None else script_seconds
+    logger.info("Startup took %.3fs - interpreter %.3fs, imports and setup %.3fs",
+                total_seconds, total_seconds - script_seconds, script_seconds)
+    if metrics is not None:
+        metrics.record("startup", total_seconds)
+    return total_seconds
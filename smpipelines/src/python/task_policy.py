@@ -0,0 +1,153 @@
+"""Adapts the task settings of the next chained labeling job to the throughput the workforce sustained on the last one.
+
+Useage, replaying historical describe_labeling_job snapshots, one JSON object per line:
+    python task_policy.py snapshots.jsonl
+"""
+import argparse
+import json
+import math
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+#the settings used when there is nothing to adapt from, as every job was created with before
+DEFAULT_TASK_SETTINGS = {
+    'MaxConcurrentTaskCount': 1000,
+    'TaskTimeLimitInSeconds': 600,
+    'TaskAvailabilityLifetimeInSeconds': 864000,
+}
+
+#(min, max) CreateLabelingJob accepts for a private workforce
+TASK_SETTING_LIMITS = {
+    'MaxConcurrentTaskCount': (1, 5000),
+    'TaskTimeLimitInSeconds': (30, 28800),
+    'TaskAvailabilityLifetimeInSeconds': (60, 864000),
+}
+
+JobObservation = namedtuple("JobObservation", ["labeled", "failed", "unlabeled", "elapsed_seconds", "settings"])
+JobObservation.__doc__ = """What a finished labeling job did with the task settings it was created with."""
+
+
+def parse_time(value):
+    """describe_labeling_job times are datetimes from boto3, and ISO 8601 strings once saved as JSON."""
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def observation_from_job(job):
+    """
+    :param job: a describe_labeling_job response, or a list_labeling_jobs summary, whose task settings are taken as
+        the defaults as summaries don't hold them.
+    :return: JobObservation
+    """
+    counters = job.get('LabelCounters') or {}
+    created, last_modified = parse_time(job.get('CreationTime')), parse_time(job.get('LastModifiedTime'))
+    human_task_config = job.get('HumanTaskConfig') or {}
+    return JobObservation(
+        #without automated labeling, which streaming jobs can't use, every label is from the workforce
+        labeled=counters.get('HumanLabeled', counters.get('TotalLabeled', 0)),
+        failed=counters.get('FailedNonRetryableError', 0),
+        unlabeled=counters.get('Unlabeled', 0),
+        elapsed_seconds=(last_modified - created).total_seconds() if created and last_modified else 0,
+        settings={key: human_task_config.get(key, default) for key, default in DEFAULT_TASK_SETTINGS.items()},
+    )
+
+
+def clamp_setting(key, value):
+    low, high = TASK_SETTING_LIMITS[key]
+    return int(min(max(math.ceil(value), low), high))
+
+
+def next_task_settings(observation, pending_items=0, headroom=2.0, failure_threshold=0.05, expiry_threshold=0.05,
+                       min_concurrent_tasks=10, min_lifetime_seconds=86400):
+    """
+    Chooses MaxConcurrentTaskCount, TaskTimeLimitInSeconds and TaskAvailabilityLifetimeInSeconds for the next job.
+
+    The workforce's sustained rate is the labels it completed per second of the last job. By Little's law the tasks
+    it has in hand at that rate are rate * time limit, and headroom times that are sent out so no worker waits for
+    work. When the last job left nothing unlabeled the workforce was waiting on work, its rate was the supply and not
+    what it could sustain, so concurrency is never reduced then. Tasks that fail, mostly because they ran out of time,
+    lengthen the time limit. Tasks left unlabeled expired before anyone took them, which lengthens how long tasks
+    stay available. Availability always covers headroom times as long as the pending work takes at the sustained rate,
+    and at least min_lifetime_seconds, a day by default, as the rate is averaged over the hours nobody is working.
+
+    :param observation: JobObservation of the last job, or None for the first job.
+    :param pending_items: items the next job starts with, the last job's unlabeled and failed items when chaining.
+    :return: dict of the three settings, the defaults when there is no rate to go on.
+    """
+    if observation is None:
+        return dict(DEFAULT_TASK_SETTINGS)
+    settings = dict(observation.settings)
+    if observation.labeled <= 0 or observation.elapsed_seconds <= 0:
+        return settings
+
+    rate = observation.labeled / observation.elapsed_seconds
+    attempted = observation.labeled + observation.failed
+    failure_rate = observation.failed / attempted
+    expiry_rate = observation.unlabeled / (attempted + observation.unlabeled)
+
+    time_limit = settings['TaskTimeLimitInSeconds']
+    if failure_rate > failure_threshold:
+        time_limit *= 1.5
+    time_limit = clamp_setting('TaskTimeLimitInSeconds', time_limit)
+
+    concurrent_tasks = max(rate * time_limit * headroom, min_concurrent_tasks)
+    if observation.unlabeled == 0:
+        concurrent_tasks = max(concurrent_tasks, settings['MaxConcurrentTaskCount'])
+    concurrent_tasks = clamp_setting('MaxConcurrentTaskCount', concurrent_tasks)
+
+    lifetime = max(pending_items, concurrent_tasks) / rate * headroom
+    if expiry_rate > expiry_threshold:
+        lifetime = max(lifetime, settings['TaskAvailabilityLifetimeInSeconds'] * 1.5)
+    lifetime = clamp_setting('TaskAvailabilityLifetimeInSeconds', max(lifetime, min_lifetime_seconds))
+
+    return {
+        'MaxConcurrentTaskCount': concurrent_tasks,
+        'TaskTimeLimitInSeconds': time_limit,
+        'TaskAvailabilityLifetimeInSeconds': lifetime,
+    }
+
+
+def replay_task_policy(jobs, **policy_options):
+    """
+    Replays the policy over a chain of jobs, oldest first, as the chain job would have run after each.
+    :param jobs: describe_labeling_job responses or summaries, such as historical counter snapshots.
+    :return: generator of (job, observation, settings for the job chained from it) tuples.
+    """
+    for job in jobs:
+        observation = observation_from_job(job)
+        pending_items = observation.unlabeled + observation.failed
+        yield job, observation, next_task_settings(observation, pending_items, **policy_options)
+
+
+def read_snapshots(path):
+    """Reads a JSON array of jobs, or one JSON job per line."""
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("snapshots", type=str, help="describe_labeling_job responses saved as JSON, oldest first")
+    parser.add_argument("--headroom", type=float, default=2.0)
+    parser.add_argument("--failure-threshold", type=float, default=0.05)
+    parser.add_argument("--expiry-threshold", type=float, default=0.05)
+    args = parser.parse_args()
+
+    for job, observation, settings in replay_task_policy(read_snapshots(args.snapshots), headroom=args.headroom, failure_threshold=args.failure_threshold,
+                                                         expiry_threshold=args.expiry_threshold):
+        hours = observation.elapsed_seconds / 3600.0
+        json.dump({
+            'LabelingJobName': job.get('LabelingJobName'),
+            'LabelsPerHour': round(observation.labeled / hours, 2) if hours else None,
+            'Labeled': observation.labeled,
+            'Failed': observation.failed,
+            'Unlabeled': observation.unlabeled,
+            'Settings': observation.settings,
+            'NextSettings': settings,
+        }, sys.stdout)
+        sys.stdout.write("\n")
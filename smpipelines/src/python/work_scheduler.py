@@ -0,0 +1,161 @@
+"""Orders and samples the images sent for labeling, so under a backlog the frames that matter most are labeled first."""
+import heapq
+import itertools
+import json
+import random
+from collections import Counter, deque, namedtuple
+
+SCHEDULE_ORDERS = ["listing", "newest-first", "oldest-first", "round-robin"]
+
+#reason images left out by the schedule are quarantined under, as <quarantine prefix>sampled/<key>
+SAMPLED_OUT = "sampled"
+
+
+class SchedulePolicy(namedtuple('SchedulePolicy', ['order', 'window_seconds', 'per_camera_window', 'per_window', 'seed'])):
+    """
+    How images are ordered and sampled before they reach the labeling job. An image's time is when it landed in its
+    bucket, its LastModified, and time is split into windows of window_seconds from the epoch.
+    order: listing keeps the order the images were listed in, newest-first and oldest-first go by time, round-robin
+        takes the newest image left of each camera in turn, so no one camera's burst holds up the others.
+    per_camera_window: keeps a uniform random sample of at most this many images of each camera in each window, 0 keeps them all.
+    per_window: keeps at most this many images of each window across all cameras, the first in order, 0 keeps them all.
+    seed: of the per_camera_window sample, the same listing always keeps the same images.
+    """
+
+
+DEFAULT_SCHEDULE_POLICY = SchedulePolicy(order="listing", window_seconds=3600, per_camera_window=0, per_window=0, seed=0)
+
+
+def load_schedule_policy(schedule_json):
+    """
+    Parses the schedule, eg '{"order": "round-robin", "per_camera_window": 50}', anything missing is the default.
+    :return: SchedulePolicy
+    """
+    policy = DEFAULT_SCHEDULE_POLICY._replace(**json.loads(schedule_json or "{}"))
+    assert policy.order in SCHEDULE_ORDERS, "order must be one of {}".format(", ".join(SCHEDULE_ORDERS))
+    assert policy.window_seconds > 0, "window_seconds must be positive"
+    return policy
+
+
+def get_camera_name(image_name):
+    return image_name.split(' ')[0]
+
+
+class WorkScheduler(object):
+    """Useage:
+        scheduler = WorkScheduler(load_schedule_policy('{"order": "round-robin", "per_camera_window": 50}'))
+        for obj in listing:
+            scheduler.add(obj['Key'], get_camera_name(obj['Key']), obj['LastModified'].timestamp())
+        for key in scheduler.drain():
+            ...
+
+    Images are held in a heap ordered by time, or a heap per camera for round-robin, so each comes out in O(log n)
+    however many are pending, and the backlog is never sorted as a whole. Sampling keeps a fixed size reservoir per
+    camera and window, so with per_camera_window set what is held is bounded by the sample, not the backlog.
+    Images left out by sampling or by the per_window cap are passed to on_skipped, when given, as they are left out.
+    """
+
+    def __init__(self, policy=DEFAULT_SCHEDULE_POLICY, on_skipped=None):
+        self.policy = policy
+        self.on_skipped = on_skipped
+        self.sampled_out_count = 0
+        self.capped_count = 0
+        self._sequence = itertools.count()
+        self._random = random.Random(policy.seed)
+        # (camera, window) -> [images seen, reservoir of (seconds, sequence, camera, item)]
+        self._reservoirs = {}
+        self._window_counts = Counter()
+        # listing order is a FIFO, newest-first and oldest-first a single heap, round-robin a heap per camera
+        # and the cameras with images left, in turn
+        self._fifo = deque()
+        self._heap = []
+        self._camera_heaps = {}
+        self._cameras = deque()
+        self._pending_count = 0
+
+    def __len__(self):
+        """The number of images held, waiting to be drained."""
+        return self._pending_count + sum(len(reservoir) for _, reservoir in self._reservoirs.values())
+
+    def window(self, seconds):
+        return int(seconds // self.policy.window_seconds)
+
+    def add(self, item, camera, seconds):
+        """
+        :param item: the image, handed back by drain.
+        :param camera: the camera that took it, see get_camera_name.
+        :param seconds: its time, as seconds since the epoch.
+        """
+        entry = (seconds, next(self._sequence), camera, item)
+        sample_size = self.policy.per_camera_window
+        if not sample_size:
+            self._push(entry)
+            return
+        stratum = self._reservoirs.setdefault((camera, self.window(seconds)), [0, []])
+        stratum[0] += 1
+        reservoir = stratum[1]
+        if len(reservoir) < sample_size:
+            reservoir.append(entry)
+            return
+        #reservoir sampling, every image of the stratum is kept with the same chance
+        index = self._random.randrange(stratum[0])
+        if index < sample_size:
+            entry, reservoir[index] = reservoir[index], entry
+        self.sampled_out_count += 1
+        self._skip(entry)
+
+    def _skip(self, entry):
+        if self.on_skipped is not None:
+            self.on_skipped(entry[3])
+
+    def _push(self, entry):
+        seconds, sequence, camera, _ = entry
+        self._pending_count += 1
+        if self.policy.order == "listing":
+            self._fifo.append(entry)
+        elif self.policy.order == "newest-first":
+            heapq.heappush(self._heap, (-seconds, sequence, entry))
+        elif self.policy.order == "oldest-first":
+            heapq.heappush(self._heap, (seconds, sequence, entry))
+        else:
+            camera_heap = self._camera_heaps.setdefault(camera, [])
+            if not camera_heap:
+                self._cameras.append(camera)
+            heapq.heappush(camera_heap, (-seconds, sequence, entry))
+
+    def _pop(self):
+        if self.policy.order == "listing":
+            entry = self._fifo.popleft()
+        elif self.policy.order != "round-robin":
+            entry = heapq.heappop(self._heap)[2]
+        else:
+            camera = self._cameras.popleft()
+            camera_heap = self._camera_heaps[camera]
+            entry = heapq.heappop(camera_heap)[2]
+            if camera_heap:
+                self._cameras.append(camera)
+            else:
+                del self._camera_heaps[camera]
+        self._pending_count -= 1
+        return entry
+
+    def drain(self):
+        """
+        Yields the images held, in order, bar those the per_window cap leaves out. Images added while draining are
+        yielded in their turn. A per_camera_window sample is over the images added before drain is called, the
+        windows start a new sample for any added after.
+        """
+        for _, reservoir in self._reservoirs.values():
+            for entry in reservoir:
+                self._push(entry)
+        self._reservoirs = {}
+        while self._pending_count:
+            entry = self._pop()
+            if self.policy.per_window:
+                window = self.window(entry[0])
+                if self._window_counts[window] >= self.policy.per_window:
+                    self.capped_count += 1
+                    self._skip(entry)
+                    continue
+                self._window_counts[window] += 1
+            yield entry[3]